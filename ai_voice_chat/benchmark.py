@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import wave
+import asyncio
+import argparse
+import platform
+import threading
+import numpy as np
+from mock_ollama import MockOllama
+from modules import Logger
+
+logger = Logger(name='benchmark').get_logger()
+
+# summary metrics that are better when lower, compared between runs
+COMPARED = ['time_to_first_audio', 'turn_time', 'executor_queue_depth']
+
+def read_wav(path):
+    '''
+        Audio of a wav file as the (sample_rate, samples) tuple the fastrtc handler receives
+    '''
+    with wave.open(path, 'rb') as file:
+        sample_rate = file.getframerate()
+        channels = file.getnchannels()
+        width = file.getsampwidth()
+        frames = file.readframes(file.getnframes())
+    dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[width]
+    samples = np.frombuffer(frames, dtype=dtype).reshape(-1, channels).T
+    return sample_rate, samples
+
+def transcript_of(path):
+    '''
+        Text next to a wav file (speech.wav -> speech.txt), used as transcript by the stand-in speech to text model
+    '''
+    text_path = os.path.splitext(path)[0] + '.txt'
+    if os.path.exists(text_path):
+        with open(text_path, encoding='utf-8') as file:
+            return file.read().strip()
+    return 'Give me some motivation for today.'
+
+class StandInSTT:
+    def __init__(self, real_time_factor, transcripts):
+        '''
+            Speech to text stand-in, takes real_time_factor seconds per second of audio
+        '''
+        self.real_time_factor = real_time_factor
+        self.transcripts = transcripts
+
+    def stt(self, audio):
+        sample_rate, samples = audio
+        time.sleep(samples.shape[-1] / sample_rate * self.real_time_factor)
+        return self.transcripts.get(id(samples), 'Give me some motivation for today.')
+
+class StandInTTS:
+    def __init__(self, real_time_factor, sample_rate=24000, chunk_seconds=0.5, chars_per_second=15.0):
+        '''
+            Text to speech stand-in, yields silence as long as the text takes to speak at real_time_factor
+        '''
+        self.real_time_factor = real_time_factor
+        self.sample_rate = sample_rate
+        self.chunk_seconds = chunk_seconds
+        self.chars_per_second = chars_per_second
+
+    def stream_tts_sync(self, text, options=None):
+        remaining = max(len(text) / self.chars_per_second, self.chunk_seconds)
+        while remaining > 0:
+            seconds = min(self.chunk_seconds, remaining)
+            time.sleep(seconds * self.real_time_factor)
+            yield self.sample_rate, np.zeros(int(seconds * self.sample_rate), dtype=np.float32)
+            remaining -= seconds
+
+class QueueSampler:
+    def __init__(self, executor, interval=0.01):
+        '''
+            Samples the number of jobs waiting in a ThreadPoolExecutor
+        '''
+        self.executor = executor
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='queue-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples.append(self.executor._work_queue.qsize())
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def percentiles(values):
+    if not values:
+        return {'count': 0, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(max(values))}
+
+def configure_environment(args):
+    '''
+        Point main.py at the mock server, its config is read when it is imported
+    '''
+    mock = None
+    endpoint = args.endpoint
+    if not endpoint:
+        mock = MockOllama(
+            models=[args.model, 'nomic-embed-text'],
+            token_rate=args.token_rate,
+            first_token_latency=args.first_token_latency,
+            reply_tokens=args.reply_tokens,
+            load_latency=args.load_latency
+        )
+        endpoint = mock.start()
+    os.environ['OLLAMA_ENDPOINT'] = endpoint
+    os.environ['MODEL_NAME'] = args.model
+    os.environ.setdefault('SYSTEM_PROMPT', 'You are a motivational and compassionate chatbot.')
+    os.environ.setdefault('METRICS_TRACE_PATH', '')
+    return mock, endpoint
+
+async def run_turn(main, audio, conversation_id):
+    start = time.perf_counter()
+    first_audio = None
+    chunks = 0
+    async for chunk in main.response(audio, [], None, conversation_id):
+        if first_audio is None:
+            first_audio = time.perf_counter() - start
+        chunks += 1
+        main.release_audio(chunk)
+    return {'conversation_id': conversation_id, 'time_to_first_audio': first_audio, 'turn_time': time.perf_counter() - start, 'audio_chunks': chunks}
+
+async def run_turns(main, audios, repeat):
+    turns = []
+    for iteration in range(repeat):
+        # every pass over the files is one conversation, so the prompt grows like in a real session
+        for path, audio in audios:
+            # every turn runs in its own task like in the app, so the turn manager can cancel it
+            turn = await asyncio.create_task(run_turn(main, audio, f'benchmark-{iteration}'))
+            turn['file'] = path
+            turns.append(turn)
+            logger.info('%s: first audio %.3fs, turn %.3fs', os.path.basename(path), turn['time_to_first_audio'] or -1, turn['turn_time'])
+    return turns
+
+def start_app(args, audios):
+    '''
+        Import main.py against the mock server (or args.endpoint) and wait until it is ready
+    '''
+    mock, endpoint = configure_environment(args)
+    import main
+    from modules import StartupOrchestrator
+
+    if args.stand_in_models:
+        # real models are replaced by timed stand-ins, the rest of the pipeline is unchanged
+        transcripts = {id(audio[1]): transcript_of(path) for path, audio in audios}
+        main.startup = StartupOrchestrator(logger=Logger)
+        main.startup.add('stt', lambda: StandInSTT(args.stt_rtf, transcripts))
+        main.startup.add('tts', lambda: StandInTTS(args.tts_rtf))
+        main.startup.add('llm', main.configure_services)
+        if main.embedding_service:
+            main.startup.add('embeddings', main.configure_embeddings, required=False)
+        main.startup.add('audio_cache', main.warm_audio_cache, depends_on=['tts'], required=False)
+    main.startup.start()
+    if not main.startup.wait(timeout=args.startup_timeout):
+        raise Exception(f'startup failed: {main.startup.status()}')
+    return main, mock, endpoint
+
+def add_app_arguments(parser):
+    parser.add_argument('--endpoint', help='benchmark a real ollama server instead of the mock')
+    parser.add_argument('--model', default='mock-model')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='mock decode speed in tokens per second')
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help='mock seconds before the first token')
+    parser.add_argument('--reply-tokens', type=int, default=40, help='mock reply length')
+    parser.add_argument('--load-latency', type=float, default=0.0, help='mock seconds to load a model that is not loaded')
+    parser.add_argument('--stand-in-models', action='store_true', help='replace moonshine and kokoro with timed stand-ins')
+    parser.add_argument('--stt-rtf', type=float, default=0.1, help='stand-in speech to text real-time factor')
+    parser.add_argument('--tts-rtf', type=float, default=0.2, help='stand-in text to speech real-time factor')
+    parser.add_argument('--startup-timeout', type=float, default=600.0)
+
+def run(args):
+    audios = [(path, read_wav(path)) for path in args.wav]
+    main, mock, endpoint = start_app(args, audios)
+
+    with QueueSampler(main.executor) as sampler:
+        turns = asyncio.run(run_turns(main, audios, args.repeat))
+    failed = [turn for turn in turns if turn['time_to_first_audio'] is None]
+
+    report = {
+        'name': args.name,
+        'time': time.time(),
+        'config': {
+            'endpoint': 'mock' if mock else endpoint,
+            'model': args.model,
+            'stand_in_models': args.stand_in_models,
+            'token_rate': args.token_rate if mock else None,
+            'first_token_latency': args.first_token_latency if mock else None,
+            'files': args.wav,
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+        },
+        'summary': {
+            'time_to_first_audio': percentiles([turn['time_to_first_audio'] for turn in turns if turn['time_to_first_audio'] is not None]),
+            'turn_time': percentiles([turn['turn_time'] for turn in turns]),
+            'executor_queue_depth': percentiles(sampler.samples),
+            'turns_without_audio': len(failed),
+        },
+        'stages': main.metrics.to_json()['stages'],
+        'counters': main.metrics.to_json()['counters'],
+        'turns': turns,
+    }
+    if mock:
+        mock.stop()
+    return report
+
+def print_summary(report):
+    print(f"{'metric':<24}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for metric in COMPARED:
+        values = report['summary'][metric]
+        print(f"{metric:<24}" + ''.join(f"{values[key]:>10.3f}" if values[key] is not None else f"{'-':>10}" for key in ('p50', 'p95', 'p99', 'max')))
+    print(f"turns without audio: {report['summary']['turns_without_audio']}")
+
+def compare(baseline, candidate, threshold):
+    '''
+        Print the change of every compared percentile, returns the regressions larger than threshold percent
+    '''
+    regressions = []
+    print(f"{'metric':<30}{'baseline':>12}{'candidate':>12}{'change':>10}")
+    for metric in COMPARED:
+        for key in ('p50', 'p95', 'p99'):
+            before = baseline['summary'][metric][key]
+            after = candidate['summary'][metric][key]
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else 0.0
+            flag = ''
+            if change > threshold and after - before > 1e-3:
+                flag = ' !'
+                regressions.append(f'{metric} {key}')
+            print(f"{f'{metric} {key}':<30}{before:>12.3f}{after:>12.3f}{change:>9.1f}%{flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End to end latency benchmark of the voice pipeline')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='feed wav files through the response handler')
+    run_parser.add_argument('wav', nargs='+', help='recorded speech, a .txt file next to a wav is its transcript for --stand-in-models')
+    run_parser.add_argument('--name', default='run')
+    run_parser.add_argument('--output', help='write the report to this json file')
+    run_parser.add_argument('--repeat', type=int, default=3, help='passes over the files')
+    add_app_arguments(run_parser)
+
+    compare_parser = commands.add_parser('compare', help='compare a run against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help='percent slowdown reported as regression')
+
+    args = parser.parse_args()
+    try:
+        if args.command == 'run':
+            report = run(args)
+            print_summary(report)
+            if args.output:
+                with open(args.output, 'w', encoding='utf-8') as file:
+                    json.dump(report, file, indent=2)
+                logger.info('wrote report to %s', args.output)
+        else:
+            with open(args.baseline, encoding='utf-8') as file:
+                baseline = json.load(file)
+            with open(args.candidate, encoding='utf-8') as file:
+                candidate = json.load(file)
+            regressions = compare(baseline, candidate, args.threshold)
+            if regressions:
+                print(f"regressions: {', '.join(regressions)}")
+                sys.exit(1)
+    except Exception as e:
+        logger.error('benchmark failed: \n %s', e)
+        sys.exit(1)
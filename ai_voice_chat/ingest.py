@@ -0,0 +1,39 @@
+import os
+import sys
+import asyncio
+from modules import OllamaWrapper, Logger, EmbeddingService, VectorIndex, Retriever
+from ollama import Client
+
+# --- CONFIG ---
+OLLAMA_ENDPOINTS = [endpoint.strip() for endpoint in str(os.getenv("OLLAMA_ENDPOINT")).split(",")]
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+INDEX_PATH = os.getenv("INDEX_PATH", "index")
+
+logger = Logger(name='ingest').get_logger()
+
+async def ingest(paths):
+    '''
+        Add text files to the vector index used by main.py for retrieval
+    '''
+    ollama_wrapper = OllamaWrapper(ollama_endpoint=OLLAMA_ENDPOINTS, client=Client, logger=Logger)
+    if not ollama_wrapper.pull_model(EMBEDDING_MODEL):
+        raise Exception(f'unable to pull model: {EMBEDDING_MODEL}')
+    retriever = Retriever(
+        embedding_service=EmbeddingService(ollama_wrapper=ollama_wrapper, model_name=EMBEDDING_MODEL, logger=Logger),
+        index=VectorIndex(path=INDEX_PATH),
+        logger=Logger
+    )
+    documents = []
+    for path in paths:
+        with open(path, encoding='utf-8') as file:
+            documents.append(file.read())
+    added = await retriever.add_documents(documents, metadata=[{'source': path} for path in paths])
+    logger.info('added %s chunks from %s files, index holds %s chunks', added, len(paths), len(retriever.index))
+
+if __name__ == "__main__":
+    try:
+        if len(sys.argv) < 2:
+            raise Exception('usage: python ingest.py <file> [<file> ...]')
+        asyncio.run(ingest(sys.argv[1:]))
+    except Exception as e:
+        logger.error('unable to ingest documents: \n %s', e)
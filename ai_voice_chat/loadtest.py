@@ -0,0 +1,144 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from fastrtc.utils import Context, current_context
+from benchmark import read_wav, start_app, add_app_arguments, percentiles, QueueSampler
+from modules import Logger
+
+logger = Logger(name='loadtest').get_logger()
+
+class Session(threading.Thread):
+    def __init__(self, main, audios, session_id, deadline, think_time):
+        '''
+            One synthetic user: speaks an utterance, waits for the whole reply to play, thinks, speaks again
+
+            Speaking and listening take as long as the audio lasts, so sessions load the app like people do.
+        '''
+        super().__init__(name=session_id, daemon=True)
+        self.main = main
+        self.audios = audios
+        self.session_id = session_id
+        self.deadline = deadline
+        self.think_time = think_time
+        self.turns = []
+
+    def run(self):
+        # fastrtc sets the connection context before calling the handler
+        current_context.set(Context(webrtc_id=self.session_id))
+        random.seed(self.session_id)
+        # sessions do not start speaking at the same moment
+        time.sleep(random.uniform(0, self.think_time))
+        while time.perf_counter() < self.deadline:
+            path, audio = random.choice(self.audios)
+            sample_rate, samples = audio
+            time.sleep(samples.shape[-1] / sample_rate)
+            start = time.perf_counter()
+            first_audio = None
+            played = 0.0
+            for chunk_rate, chunk in self.main.sync_response(audio):
+                if first_audio is None:
+                    first_audio = time.perf_counter() - start
+                played += chunk.shape[-1] / chunk_rate
+            generated = time.perf_counter() - start
+            self.turns.append({'time_to_first_audio': first_audio, 'turn_time': generated, 'audio_seconds': played})
+            # the user listens to the rest of the reply before answering
+            remaining = (first_audio or 0.0) + played - generated
+            time.sleep(max(remaining, 0.0) + random.uniform(0.5, 1.5) * self.think_time)
+
+def run_stage(main, audios, sessions, duration, think_time, executors, stage):
+    '''
+        Run sessions concurrent users for duration seconds
+    '''
+    deadline = time.perf_counter() + duration
+    users = [Session(main, audios, f'load-{stage}-{position}', deadline, think_time) for position in range(sessions)]
+    samplers = {name: QueueSampler(executor) for name, executor in executors.items()}
+    for sampler in samplers.values():
+        sampler.start()
+    start = time.perf_counter()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.perf_counter() - start
+    for sampler in samplers.values():
+        sampler.stop()
+
+    turns = [turn for user in users for turn in user.turns]
+    queues = {}
+    for name, sampler in samplers.items():
+        samples = sampler.samples
+        queues[name] = dict(percentiles(samples), busy=sum(1 for depth in samples if depth > 0) / len(samples) if samples else 0.0)
+    return {
+        'sessions': sessions,
+        'turns': len(turns),
+        'turns_per_minute': len(turns) / elapsed * 60,
+        'turns_without_audio': sum(1 for turn in turns if turn['time_to_first_audio'] is None),
+        'time_to_first_audio': percentiles([turn['time_to_first_audio'] for turn in turns if turn['time_to_first_audio'] is not None]),
+        'turn_time': percentiles([turn['turn_time'] for turn in turns]),
+        'queues': queues,
+    }
+
+def analyse(stages, starvation_busy, degradation):
+    '''
+        Mark stages whose executors had jobs waiting in more than starvation_busy of the samples,
+        or whose p95 time to first audio is more than degradation times that of the first stage
+    '''
+    baseline = stages[0]['time_to_first_audio']['p95'] if stages else None
+    for stage in stages:
+        stage['starved'] = sorted(name for name, queue in stage['queues'].items() if queue['busy'] > starvation_busy)
+        p95 = stage['time_to_first_audio']['p95']
+        stage['degraded'] = bool(baseline and p95 and p95 > degradation * baseline)
+    starved = next((stage['sessions'] for stage in stages if stage['starved']), None)
+    degraded = next((stage['sessions'] for stage in stages if stage['degraded']), None)
+    return {'starvation_from_sessions': starved, 'degraded_from_sessions': degraded}
+
+def print_stages(stages, verdict):
+    print(f"{'sessions':>8}{'turns/min':>11}{'ttfa p50':>10}{'ttfa p95':>10}{'ttfa p99':>10}{'turn p95':>10}  queues (p95 depth, busy)")
+    for stage in stages:
+        ttfa, turn = stage['time_to_first_audio'], stage['turn_time']
+        queues = ', '.join(f"{name} {queue['p95'] or 0:.0f} {queue['busy']:.0%}" for name, queue in stage['queues'].items())
+        flags = ''.join([' STARVED' if stage['starved'] else '', ' DEGRADED' if stage['degraded'] else ''])
+        print(
+            f"{stage['sessions']:>8}{stage['turns_per_minute']:>11.1f}"
+            + ''.join(f"{value:>10.3f}" if value is not None else f"{'-':>10}" for value in (ttfa['p50'], ttfa['p95'], ttfa['p99'], turn['p95']))
+            + f"  {queues}{flags}"
+        )
+    print(f"executor starvation begins at: {verdict['starvation_from_sessions'] or 'not reached'} sessions")
+    print(f"latency degraded from: {verdict['degraded_from_sessions'] or 'not reached'} sessions")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Concurrent session load test of the voice app')
+    parser.add_argument('wav', nargs='+', help='recorded speech, a .txt file next to a wav is its transcript for --stand-in-models')
+    parser.add_argument('--sessions', default='1,2,4,8,16', help='comma separated concurrent session counts, one stage each')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds per stage')
+    parser.add_argument('--think-time', type=float, default=2.0, help='average seconds between hearing a reply and speaking again')
+    parser.add_argument('--starvation-busy', type=float, default=0.1, help='fraction of samples with queued jobs that counts as starvation')
+    parser.add_argument('--degradation', type=float, default=2.0, help='p95 time to first audio growth over one session that counts as degraded')
+    parser.add_argument('--output', help='write the report to this json file')
+    add_app_arguments(parser)
+    args = parser.parse_args()
+    try:
+        audios = [(path, read_wav(path)) for path in args.wav]
+        main, mock, endpoint = start_app(args, audios)
+        from modules import ollamawrapper
+        main.app_loop.start()
+        executors = {'main': main.executor, 'ollama': ollamawrapper._executor}
+        stages = []
+        for stage, sessions in enumerate(int(count) for count in args.sessions.split(',')):
+            logger.info('running %s sessions for %ss', sessions, args.duration)
+            stages.append(run_stage(main, audios, sessions, args.duration, args.think_time, executors, stage))
+        verdict = analyse(stages, args.starvation_busy, args.degradation)
+        main.app_loop.stop()
+        if mock:
+            mock.stop()
+        print_stages(stages, verdict)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as file:
+                json.dump({'config': vars(args), 'verdict': verdict, 'stages': stages}, file, indent=2)
+            logger.info('wrote report to %s', args.output)
+    except Exception as e:
+        logger.error('load test failed: \n %s', e)
+        sys.exit(1)
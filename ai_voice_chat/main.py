@@ -1,34 +1,217 @@
 import os
 import asyncio
 from fastrtc import (
-    ReplyOnPause,
     Stream,
     AdditionalOutputs,
     get_stt_model, get_tts_model,
     KokoroTTSOptions
 )
-from modules import OllamaWrapper, Logger
+from modules import (
+    OllamaWrapper, Logger, ConversationEngine, SentenceChunker, BackgroundLoop,
+    EmbeddingService, VectorIndex, Retriever, AudioCache, StartupOrchestrator, TurnManager, Metrics,
+    SpeechWorkerPool, StreamingTranscriber, StreamingReplyOnPause, ResponseCache, ModelRouter, EmbeddingClassifier,
+    FramePool, PooledReplyOnPause, iterate_in_thread, parse_keep_alive
+)
 from ollama import Client
-from pydantic_ai.models.openai import OpenAIModel
-from pydantic_ai.providers.openai import OpenAIProvider
 import time
+import threading
+from contextlib import aclosing
 from concurrent.futures import ThreadPoolExecutor
 
 # --- CONFIG ---
-OLLAMA_ENDPOINT = str(os.getenv("OLLAMA_ENDPOINT"))
+OLLAMA_ENDPOINTS = [endpoint.strip() for endpoint in str(os.getenv("OLLAMA_ENDPOINT")).split(",")]  # comma separated
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
 MODEL_NAME = str(os.getenv("MODEL_NAME"))
+FALLBACK_MODEL_NAME = os.getenv("FALLBACK_MODEL_NAME")  # served while MODEL_NAME downloads, if already downloaded
+SMALL_MODEL_NAME = os.getenv("SMALL_MODEL_NAME")  # short turns are routed to it when set
+ROUTER_SHORT_WORDS = int(os.getenv("ROUTER_SHORT_WORDS", "12"))
+ROUTER_SHORT_HISTORY_TOKENS = int(os.getenv("ROUTER_SHORT_HISTORY_TOKENS", "1024"))
+ROUTER_COMPLEX_KEYWORDS = os.getenv("ROUTER_COMPLEX_KEYWORDS")  # comma separated, prompts containing one go to MODEL_NAME
+ROUTER_CLASSIFIER = os.getenv("ROUTER_CLASSIFIER", "false").lower() == "true"  # decide by embedding similarity to examples
+ROUTER_LATENCY_SLO = float(os.getenv("ROUTER_LATENCY_SLO", "0"))  # seconds to first token, disabled when 0
+ROUTER_LATENCY_WINDOW = float(os.getenv("ROUTER_LATENCY_WINDOW", "60"))
+MODEL_PULL_TIMEOUT = float(os.getenv("MODEL_PULL_TIMEOUT", "600"))
+MODEL_KEEP_ALIVE = parse_keep_alive(os.getenv("MODEL_KEEP_ALIVE", "-1"))  # seconds or a duration like 30m, negative keeps it loaded
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))  # unlimited when 0
+MODEL_MEMORY_KIND = os.getenv("MODEL_MEMORY_KIND", "vram")
+MODEL_RESIDENCY_INTERVAL = float(os.getenv("MODEL_RESIDENCY_INTERVAL", "30"))
 SYSTEM_PROMPT = str(os.getenv("SYSTEM_PROMPT"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2048"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+INDEX_PATH = os.getenv("INDEX_PATH")  # retrieval is disabled when unset
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "false").lower() == "true"  # answer near duplicate prompts from a cache
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.9"))  # cosine similarity of the prompts
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # never expire when 0
+RESPONSE_CACHE_ENTRIES = int(os.getenv("RESPONSE_CACHE_ENTRIES", "1000"))
+RESPONSE_CACHE_AUDIO_MB = int(os.getenv("RESPONSE_CACHE_AUDIO_MB", "64"))
+TTS_CHUNK_MIN_CHARS = int(os.getenv("TTS_CHUNK_MIN_CHARS", "40"))
+TTS_CHUNK_MAX_CHARS = int(os.getenv("TTS_CHUNK_MAX_CHARS", "250"))
+TTS_CHUNK_FLUSH_TIMEOUT = float(os.getenv("TTS_CHUNK_FLUSH_TIMEOUT", "0.6"))
+TTS_AUDIO_BUFFER = int(os.getenv("TTS_AUDIO_BUFFER", "4"))
+TTS_CACHE_MB = int(os.getenv("TTS_CACHE_MB", "64"))
+SPEECH_WORKERS = os.getenv("SPEECH_WORKERS", "false").lower() == "true"  # run stt and tts in worker processes
+STT_WORKERS = int(os.getenv("STT_WORKERS", "1"))
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "2"))
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", "4"))
+STREAMING_STT = os.getenv("STREAMING_STT", "false").lower() == "true"  # transcribe while the user speaks
+STREAMING_STT_SEGMENT_SECONDS = float(os.getenv("STREAMING_STT_SEGMENT_SECONDS", "3.0"))
+SPEECH_BUFFER_SECONDS = float(os.getenv("SPEECH_BUFFER_SECONDS", "30"))  # pooled buffer per utterance, longer ones grow
+SPEECH_BUFFERS = int(os.getenv("SPEECH_BUFFERS", "8"))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+METRICS_TRACE_PATH = os.getenv("METRICS_TRACE_PATH")  # per-turn trace dump is disabled when unset
 
-logger = Logger(name='main').get_logger()
-ollama_wrapper = OllamaWrapper(ollama_endpoint=OLLAMA_ENDPOINT, client=Client, logger=Logger)
-ollama_model = OpenAIModel(model_name=MODEL_NAME, provider=OpenAIProvider(base_url=f'{OLLAMA_ENDPOINT}/v1', api_key='fake-api-key'))
+# --- CANNED RESPONSES ---
+NO_PROMPT_MESSAGE = "no prompt provided"
+NO_RESPONSE_MESSAGE = "No response generated"
+SYNTHESIS_ERROR_MESSAGE = "Error during response synthesis"
+WARMING_UP_MESSAGE = "I am still warming up, please try again in a moment"
+STARTUP_FAILED_MESSAGE = "I was unable to start, please check the logs"
 
-tts_client = get_tts_model(model="kokoro")
-stt_model = get_stt_model(model="moonshine/base")
+# --- ROUTER EXAMPLES ---
+SIMPLE_PROMPTS = ["hi", "thank you", "motivate me", "how are you", "say something nice", "I feel tired today", "good morning"]
+COMPLEX_PROMPTS = [
+    "explain how habits are formed and how to change them",
+    "help me plan a weekly schedule to train for a marathon",
+    "compare studying in the morning with studying at night",
+    "what are the pros and cons of changing careers at forty",
+    "walk me through preparing for a job interview step by step",
+]
 
-executor = ThreadPoolExecutor(max_workers=4)  # For blocking IO
+logger = Logger(name='main').get_logger()
+ollama_wrapper = OllamaWrapper(
+    ollama_endpoint=OLLAMA_ENDPOINTS,
+    client=Client,
+    logger=Logger,
+    health_interval=OLLAMA_HEALTH_INTERVAL,
+    memory_budget=MODEL_MEMORY_BUDGET_MB * 1024 * 1024 or None,
+    memory_kind=MODEL_MEMORY_KIND,
+    residency_interval=MODEL_RESIDENCY_INTERVAL,
+    pull_timeout=MODEL_PULL_TIMEOUT
+)
+conversation_engine = ConversationEngine(
+    ollama_wrapper=ollama_wrapper,
+    model_name=MODEL_NAME,
+    system_prompt=SYSTEM_PROMPT,
+    logger=Logger,
+    token_budget=CONTEXT_TOKEN_BUDGET
+)
+embedding_service = EmbeddingService(
+    ollama_wrapper=ollama_wrapper, model_name=EMBEDDING_MODEL, logger=Logger
+) if INDEX_PATH or RESPONSE_CACHE or ROUTER_CLASSIFIER else None
+retriever = Retriever(
+    embedding_service=embedding_service,
+    index=VectorIndex(path=INDEX_PATH),
+    logger=Logger
+) if INDEX_PATH else None
+response_cache = ResponseCache(
+    embed=embedding_service.embed_one,
+    threshold=RESPONSE_CACHE_THRESHOLD,
+    ttl=RESPONSE_CACHE_TTL or None,
+    max_entries=RESPONSE_CACHE_ENTRIES,
+    max_audio_bytes=RESPONSE_CACHE_AUDIO_MB * 1024 * 1024,
+    logger=Logger
+) if RESPONSE_CACHE else None
+ollama_wrapper.response_cache = response_cache
+# the small model only takes turns once it is downloaded and loaded
+model_router = ModelRouter(
+    large_model=MODEL_NAME,
+    short_words=ROUTER_SHORT_WORDS,
+    short_history_tokens=ROUTER_SHORT_HISTORY_TOKENS,
+    classifier=EmbeddingClassifier(embedding_service.embed, SIMPLE_PROMPTS, COMPLEX_PROMPTS) if ROUTER_CLASSIFIER else None,
+    latency_slo=ROUTER_LATENCY_SLO or None,
+    latency_window=ROUTER_LATENCY_WINDOW,
+    complex_keywords=ROUTER_COMPLEX_KEYWORDS.split(',') if ROUTER_COMPLEX_KEYWORDS is not None else None,
+    logger=Logger
+) if SMALL_MODEL_NAME else None
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)  # For blocking IO
+speech_workers = SpeechWorkerPool(stt_workers=STT_WORKERS, tts_workers=TTS_WORKERS, logger=Logger) if SPEECH_WORKERS else None
+speech_frames = FramePool(frame_samples=int(16000 * SPEECH_BUFFER_SECONDS), max_frames=SPEECH_BUFFERS)  # utterance buffers
+audio_allocations = {'count': 0, 'bytes': 0}  # audio buffer allocations when the last turn ended
+synthesized_allocations = {'count': 0, 'bytes': 0}  # synthesized chunks that are new arrays instead of pooled frames
+streaming_stt = StreamingTranscriber(
+    stt=lambda audio: startup.result('stt').stt(audio),
+    executor=executor,
+    is_ready=lambda: startup.is_ready('stt'),
+    segment_seconds=STREAMING_STT_SEGMENT_SECONDS,
+    logger=Logger
+) if STREAMING_STT else None
+app_loop = BackgroundLoop(name='voice-chat-loop')  # Shared event loop for all sessions
+turn_manager = TurnManager(logger=Logger)  # A new utterance cancels the session's in-flight response
+text_chunker = SentenceChunker(
+    min_chars=TTS_CHUNK_MIN_CHARS,
+    max_chars=TTS_CHUNK_MAX_CHARS,
+    flush_timeout=TTS_CHUNK_FLUSH_TIMEOUT
+)
 
 tts_options_default = KokoroTTSOptions(voice="af_heart", speed=1.0, lang="en-us")
+audio_cache = AudioCache(max_bytes=TTS_CACHE_MB * 1024 * 1024)
+metrics = Metrics(enabled=METRICS_ENABLED, trace_path=METRICS_TRACE_PATH, logger=Logger)
+turn_manager.add_cancel_listener(lambda turn, latency: metrics.observe('cancel_latency_seconds', latency))
+
+def log_stream_stats(stats):
+    '''
+        Log llm stream timings
+    '''
+    logger.info(
+        f"llm stream: model={stats.model} time to first token={stats.time_to_first_token} "
+        f"tokens/sec={stats.tokens_per_second} completed={stats.completed}"
+    )
+    metrics.observe('llm_time_to_first_token_seconds', stats.time_to_first_token)
+    metrics.observe('llm_tokens_per_second', stats.tokens_per_second)
+    if model_router:
+        model_router.observe(stats.model, stats.time_to_first_token)
+        size = 'small' if stats.model == model_router.small_model else 'large' if stats.model == model_router.large_model else None
+        if size:
+            metrics.observe(f'{size}_model_time_to_first_token_seconds', stats.time_to_first_token)
+
+ollama_wrapper.add_stream_listener(log_stream_stats)
+
+def record_residency_event(event):
+    '''
+        Record model load durations, cold loads during a turn show up in its trace
+    '''
+    if event.action == 'load':
+        metrics.observe('model_load_seconds', event.seconds)
+
+ollama_wrapper.residency.add_event_listener(record_residency_event)
+
+def activate_model(model_name, previous=None):
+    '''
+        Serve turns with model_name, loaded ahead so the next turn does not wait for it, previous may be unloaded again
+    '''
+    ollama_wrapper.residency.configure(model_name, keep_alive=MODEL_KEEP_ALIVE, pinned=True)
+    if not ollama_wrapper.residency.preload(model_name):
+        logger.warning('unable to preload model %s, the first turn will load it', model_name)
+    conversation_engine.model_name = model_name
+    if model_router:
+        model_router.large_model = model_name
+    if previous:
+        ollama_wrapper.residency.configure(previous)
+    logger.info('serving turns with model %s', model_name)
+
+def switch_when_pulled(pulls):
+    '''
+        Switch from the fallback model to MODEL_NAME once it is downloaded
+    '''
+    if all([task.result() for task in pulls]):
+        activate_model(MODEL_NAME, previous=FALLBACK_MODEL_NAME)
+    else:
+        logger.error('unable to pull model %s, staying on %s', MODEL_NAME, FALLBACK_MODEL_NAME)
+
+def enable_small_model(pulls):
+    '''
+        Route short turns to SMALL_MODEL_NAME once it is downloaded, loaded ahead like the main model
+    '''
+    if not all([task.result() for task in pulls]):
+        logger.error('unable to pull model %s, every turn goes to %s', SMALL_MODEL_NAME, conversation_engine.model_name)
+        return
+    ollama_wrapper.residency.configure(SMALL_MODEL_NAME, keep_alive=MODEL_KEEP_ALIVE, pinned=True)
+    if not ollama_wrapper.residency.preload(SMALL_MODEL_NAME):
+        logger.warning('unable to preload model %s, the first short turn will load it', SMALL_MODEL_NAME)
+    model_router.small_model = SMALL_MODEL_NAME
+    logger.info('routing short turns to model %s', SMALL_MODEL_NAME)
 
 def configure_services():
     '''
@@ -38,79 +221,312 @@ def configure_services():
     try:
         if not MODEL_NAME:
             raise Exception('no model name was found')
-        if not ollama_wrapper.pull_model(MODEL_NAME):
+        # both models download at the same time
+        model_pulls = ollama_wrapper.start_pull(MODEL_NAME)
+        if model_router:
+            # turns go to the main model until the small model is ready
+            small_pulls = ollama_wrapper.start_pull(SMALL_MODEL_NAME)
+            threading.Thread(target=enable_small_model, args=(small_pulls,), name='small-model', daemon=True).start()
+        if model_pulls and FALLBACK_MODEL_NAME and ollama_wrapper.has_model(FALLBACK_MODEL_NAME):
+            logger.info('serving with model %s while %s downloads', FALLBACK_MODEL_NAME, MODEL_NAME)
+            activate_model(FALLBACK_MODEL_NAME)
+            threading.Thread(target=switch_when_pulled, args=(model_pulls,), name='model-switch', daemon=True).start()
+        elif all([task.result() for task in model_pulls]):
+            activate_model(MODEL_NAME)
+        else:
             raise Exception(f'unable to pull model: {MODEL_NAME}')
+        ollama_wrapper.residency.start()
         logger.info('services are properly configured')
     except Exception as e:
         logger.error('unable to configure services: \n %s', e)
+        raise
+
+def configure_embeddings():
+    '''
+        Pull and preload the embedding model, without it retrieval, the response cache and the router classifier
+        find nothing but turns are still answered
+    '''
+    if not all([task.result() for task in ollama_wrapper.start_pull(EMBEDDING_MODEL)]):
+        raise Exception(f'unable to pull model: {EMBEDDING_MODEL}')
+    ollama_wrapper.residency.configure(EMBEDDING_MODEL, keep_alive=MODEL_KEEP_ALIVE, pinned=True, embed=True)
+    ollama_wrapper.residency.preload(EMBEDDING_MODEL)
 
-configure_services()
+def warm_audio_cache():
+    '''
+        Pre-synthesize canned responses so they never wait on Kokoro
+    '''
+    added = audio_cache.warm(
+        [NO_RESPONSE_MESSAGE, SYNTHESIS_ERROR_MESSAGE, WARMING_UP_MESSAGE, STARTUP_FAILED_MESSAGE],
+        tts_options_default,
+        lambda text, options: stored_audio(tts_stream(text, options))
+    )
+    logger.info(f"warmed audio cache with {added} phrases")
 
-async def async_stt(audio):
+# Everything slow loads concurrently in the background, the UI starts right away
+startup = StartupOrchestrator(logger=Logger)
+if speech_workers:
+    startup.add('stt', speech_workers.start_stt)
+    startup.add('tts', speech_workers.start_tts)
+else:
+    startup.add('stt', lambda: get_stt_model(model="moonshine/base"))
+    startup.add('tts', lambda: get_tts_model(model="kokoro"))
+startup.add('llm', configure_services)
+if embedding_service:
+    startup.add('embeddings', configure_embeddings, required=False)
+startup.add('audio_cache', warm_audio_cache, depends_on=['tts'], required=False)
+
+async def read_speech(fn, *args):
     '''
-        Async speech to text
+        Run fn on the executor, a cancelled turn still waits for it as fn reads the pooled speech buffer
     '''
+    future = asyncio.get_running_loop().run_in_executor(executor, fn, *args)
     try:
-        loop = asyncio.get_event_loop()
-        text = await loop.run_in_executor(executor, stt_model.stt, audio)
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait({future})
+        raise
+
+async def async_stt(audio, conversation_id='default'):
+    '''
+        Async speech to text, only the tail is left to transcribe when streaming transcription covered the rest
+    '''
+    try:
+        utterance = streaming_stt.take(conversation_id) if streaming_stt else None
+        if utterance is not None:
+            transcript = await read_speech(streaming_stt.finish, utterance, audio)
+            if transcript is not None:
+                logger.info(
+                    f"streaming transcription: audio={transcript.audio_seconds:.2f}s tail={transcript.tail_seconds:.2f}s "
+                    f"finalize={transcript.finalize_seconds:.3f}s saved={transcript.saved_seconds}"
+                )
+                metrics.observe('stt_saved_seconds', transcript.saved_seconds)
+                return transcript.text
+        text = await read_speech(startup.result('stt').stt, audio)
         return text
     except Exception as e:
         logger.error(f"STT error: {e}")
         return ""
 
+def tts_stream(text, options, priority=0):
+    '''
+        Blocking audio chunks for text, worker processes synthesize lower priority values first
+    '''
+    if speech_workers:
+        return startup.result('tts').stream_tts_sync(text, options=options, priority=priority)
+    return startup.result('tts').stream_tts_sync(text, options=options)
+
+def release_audio(chunk):
+    '''
+        Give the pooled frame of a synthesized chunk back once nothing reads it any more
+    '''
+    if speech_workers and isinstance(chunk, tuple):
+        speech_workers.frames.release(chunk[1])
+
+def stored_audio(chunks):
+    '''
+        Generator: copies of synthesized chunks that are kept beyond playback, pooled frames go back right away
+    '''
+    for chunk in chunks:
+        sample_rate, samples = chunk
+        yield sample_rate, samples.copy()
+        release_audio(chunk)
+
+def timed_chunks(chunks, timing):
+    '''
+        Generator: chunks, adding the time spent waiting for each one to timing['seconds']
+    '''
+    iterator = iter(chunks)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                timing['seconds'] += time.perf_counter() - start
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+async def synthesize(text, options, priority=0):
+    '''
+        Async generator: audio chunks for text, served from the audio cache when possible
+    '''
+    cached = audio_cache.get(text, options)
+    if cached is not None:
+        for chunk in cached:
+            yield chunk
+        return
+
+    chunks = [] if audio_cache.cacheable(text) else None
+    # only the producer is timed, not the wait for playback
+    timing = {'seconds': 0.0}
+    audio_seconds = 0.0
+    # a dedicated thread, the producer waits for playback and would hold a worker speech to text needs
+    async for chunk in iterate_in_thread(
+        lambda: timed_chunks(tts_stream(text, options, priority), timing),
+        executor=None,
+        maxsize=TTS_AUDIO_BUFFER,
+        discard=release_audio
+    ):
+        sample_rate, samples = chunk
+        audio_seconds += len(samples) / sample_rate
+        if not speech_workers:
+            synthesized_allocations['count'] += 1
+            synthesized_allocations['bytes'] += samples.nbytes
+        if chunks is not None:
+            # stored audio must not keep the pooled frame it was delivered in
+            chunks.append((sample_rate, samples.copy()))
+        yield chunk
+    if audio_seconds:
+        metrics.observe('tts_real_time_factor', timing['seconds'] / audio_seconds)
+    if chunks:
+        audio_cache.put(text, options, chunks)
+
 async def async_tts_stream(text, options):
     '''
         Generate and send text to speech in async stream
     '''
     try:
-        loop = asyncio.get_event_loop()
-        for chunk in await loop.run_in_executor(executor, lambda: list(tts_client.stream_tts_sync(text, options=options))):
+        async for chunk in synthesize(text, options):
             yield chunk
     except Exception as e:
         logger.error(f"TTS stream error: {e}")
 
 async def async_tts_stream_chunks(chunk_generator, options):
     '''
-        Given a text chunk generator (async), streams audio as chunks appear
+        Given a token generator (async), groups tokens into sentences and streams audio as sentences appear
     '''
-    loop = asyncio.get_event_loop()
+    tts_calls = 0
     try:
-        async for chunk in chunk_generator:
-            try:
-                for audio_chunk in await loop.run_in_executor(
-                    executor,
-                    lambda: list(tts_client.stream_tts_sync(chunk, options=options))
-                ):
-                    yield audio_chunk
-            except Exception as tts_e:
-                logger.error(f"TTS error on chunk: {tts_e}")
+        async with aclosing(text_chunker.chunk(chunk_generator)) as chunks:
+            async for chunk in chunks:
+                tts_calls += 1
+                first_sentence = time.perf_counter() if tts_calls == 1 else None
+                try:
+                    # the first sentence decides when the user hears something, later ones can wait
+                    async with aclosing(synthesize(chunk, options, priority=0 if tts_calls == 1 else 1)) as audio:
+                        async for audio_chunk in audio:
+                            if first_sentence is not None:
+                                metrics.observe('tts_time_to_first_chunk_seconds', time.perf_counter() - first_sentence)
+                                first_sentence = None
+                            yield audio_chunk
+                except Exception as tts_e:
+                    logger.error(f"TTS error on chunk: {tts_e}")
     except Exception as e:
         logger.error(f"TTS stream chunks error: {e}")
+    finally:
+        logger.info(f"tts calls for response: {tts_calls}")
+
+async def speak_reply(llm_stream, options, conversation_id):
+    '''
+        Async generator: audio of the llm reply, a reply replayed from the response cache reuses the audio stored with it
+    '''
+    if response_cache is None:
+        async with aclosing(async_tts_stream_chunks(llm_stream, options)) as audio:
+            async for chunk in audio:
+                yield chunk
+        return
+
+    # the cache lookup is done once the stream produced something
+    first = await anext(llm_stream, None)
+    if first is None:
+        return
+    recent = response_cache.recent(conversation_id)
+    hit = recent is not None and recent[1]
+    metrics.increment('response_cache_hits_total' if hit else 'response_cache_misses_total')
+    audio_key = AudioCache.key('', options)
+    audio = response_cache.audio(recent[0], audio_key) if hit else None
+    if audio is not None:
+        logger.info('replaying cached reply audio')
+        # the replayed text still has to reach the conversation history
+        async for _ in llm_stream:
+            pass
+        for chunk in audio:
+            yield chunk
+        return
+
+    async def reply():
+        yield first
+        async for chunk in llm_stream:
+            yield chunk
 
-async def generate_response(audio, chatbot=None):
+    chunks = []
+    async with aclosing(async_tts_stream_chunks(reply(), options)) as audio:
+        async for chunk in audio:
+            # stored audio must not keep the pooled frame it was delivered in
+            chunks.append((chunk[0], chunk[1].copy()))
+            yield chunk
+    recent = response_cache.recent(conversation_id)
+    if recent is not None and chunks:
+        response_cache.put_audio(recent[0], audio_key, chunks)
+
+def observe_audio_allocations():
+    '''
+        Record the audio arrays allocated since the last turn ended: frame pool buffers and synthesized chunks outside
+        a pool, every Kokoro chunk without speech workers
+    '''
+    pools = [speech_frames] + ([speech_workers.frames] if speech_workers else [])
+    count = sum(pool.allocations for pool in pools) + synthesized_allocations['count']
+    nbytes = sum(pool.allocated_bytes for pool in pools) + synthesized_allocations['bytes']
+    if speech_workers:
+        count += speech_workers.pickled_chunks
+        nbytes += speech_workers.pickled_bytes
+    metrics.observe('audio_allocations_per_turn', count - audio_allocations['count'])
+    metrics.observe('audio_allocated_mb_per_turn', (nbytes - audio_allocations['bytes']) / (1024 * 1024))
+    audio_allocations.update(count=count, bytes=nbytes)
+
+def session_id():
+    '''
+        Id of the webrtc connection the current handler call belongs to
+    '''
+    try:
+        from fastrtc.utils import get_current_context
+        return get_current_context().webrtc_id
+    except Exception:
+        return 'default'
+
+async def generate_response(audio, chatbot=None, conversation_id='default'):
     '''
         Async generator: handles STT, yields new chatbot state, then streams LLM tokens
     '''
     try:
         chatbot = chatbot or []
-        messages = [{"role": msg["role"], "content": msg["content"]} for msg in chatbot]
 
-        start = time.time()
-        text = await async_stt(audio)
+        start = time.perf_counter()
+        text = await async_stt(audio, conversation_id)
+        transcription_time = time.perf_counter() - start
+        metrics.observe('stt_seconds', transcription_time)
         if not text:
-            yield "no prompt provided"
+            yield NO_PROMPT_MESSAGE
             return
 
-        logger.info(f"transcription time: {time.time() - start}")
+        logger.info(f"transcription time: {transcription_time}")
         logger.info(f"prompt: {text}")
 
         chatbot.append({"role": "user", "content": text})
         yield AdditionalOutputs(chatbot)
-        messages.append({"role": "user", "content": text})
 
-        logger.info('calling llm with: %s', str(messages))
+        context = None
+        if retriever:
+            start = time.perf_counter()
+            results = await retriever.retrieve(text)
+            metrics.observe('retrieval_seconds', time.perf_counter() - start)
+            logger.info(f"retrieved {len(results)} document chunks")
+            context = Retriever.format_context(results) or None
+
+        model_name = None
+        if model_router:
+            decision = await model_router.route(text, conversation_engine.history_tokens(conversation_id))
+            metrics.increment(f'router_{decision.size}_model_turns_total')
+            model_name = decision.model
+
+        logger.info('calling llm for conversation: %s', conversation_id)
         try:
-            llm_stream = ollama_wrapper.generate_completion_stream(MODEL_NAME, str(messages))
+            llm_stream = conversation_engine.stream_reply(conversation_id, text, context=context, model_name=model_name)
             yield llm_stream  # yield async generator for downstream TTS streaming
         except Exception as llm_e:
             logger.error(f"LLM streaming error: {llm_e}")
@@ -123,18 +539,48 @@ async def response(
     audio,
     chatbot=None,
     tts_options=None,
-    generating_response=False
+    conversation_id='default'
 ):
     '''
-        Generate response to provided speech
+        Generate response to provided speech, cancelling the conversation's previous response if it is still running
+    '''
+    turn = turn_manager.begin(conversation_id)
+    trace = metrics.begin_turn(conversation_id)
+    try:
+        async with aclosing(respond(audio, chatbot, tts_options, conversation_id)) as chunks:
+            async for chunk in chunks:
+                if trace is not None:
+                    metrics.observe('end_to_end_seconds', metrics.mark('first_audio'))
+                yield chunk
+    finally:
+        if turn.cancelled:
+            metrics.increment('turns_cancelled_total')
+        # the turn owns the utterance buffer the handler gave it
+        speech_frames.release(audio[1])
+        observe_audio_allocations()
+        metrics.end_turn(trace)
+
+async def respond(audio, chatbot, tts_options, conversation_id):
+    '''
+        Async generator: audio chunks of the response to provided speech
     '''
     try:
         chatbot = chatbot or []
         tts_options = tts_options or tts_options_default
 
-        if not generating_response:
-            generating_response = True
-            gen = generate_response(audio=audio, chatbot=chatbot)
+        if not startup.ready:
+            if startup.failed:
+                logger.error(f"received speech but startup failed: {startup.status()}")
+            else:
+                logger.info(f"received speech while warming up: {startup.status()}")
+            if startup.is_ready('tts'):
+                message = STARTUP_FAILED_MESSAGE if startup.failed else WARMING_UP_MESSAGE
+                async for chunk in async_tts_stream(message, tts_options):
+                    yield chunk
+            return
+
+        # closed right away on barge-in, not when they are garbage collected
+        async with aclosing(generate_response(audio=audio, chatbot=chatbot, conversation_id=conversation_id)) as gen:
             # First yield is chatbot update
             try:
                 chatbot_update = await gen.__anext__()
@@ -145,9 +591,9 @@ async def response(
             # Second yield is the LLM stream generator
             try:
                 llm_stream = await gen.__anext__()
-                if llm_stream is None:
+                if llm_stream is None or isinstance(llm_stream, str):
                     logger.warning("No LLM stream, sending fallback message.")
-                    async for chunk in async_tts_stream("No response generated", tts_options):
+                    async for chunk in async_tts_stream(NO_RESPONSE_MESSAGE, tts_options):
                         yield chunk
                     return
             except Exception as e:
@@ -155,51 +601,52 @@ async def response(
                 return
 
             logger.info(f"received LLM stream, streaming TTS")
-            # Stream LLM chunks to TTS and yield audio
-            try:
-                async for audio_chunk in async_tts_stream_chunks(llm_stream, tts_options):
-                    yield audio_chunk
-            except Exception as e:
-                logger.error(f"Error streaming LLM/TTS chunks: {e}")
-                async for chunk in async_tts_stream("Error during response synthesis", tts_options):
-                    yield chunk
-
-            generating_response = False
-        else:
-            try:
-                async for chunk in async_tts_stream("still working on the previous request", tts_options):
-                    yield chunk
-            except Exception as e:
-                logger.error(f"Error in fallback TTS: {e}")
+            # the stream holds the conversation lock and records the partial reply once it is closed
+            async with aclosing(llm_stream):
+                # Stream LLM chunks to TTS and yield audio
+                try:
+                    async with aclosing(speak_reply(llm_stream, tts_options, conversation_id)) as audio:
+                        async for audio_chunk in audio:
+                            yield audio_chunk
+                except Exception as e:
+                    logger.error(f"Error streaming LLM/TTS chunks: {e}")
+                    async for chunk in async_tts_stream(SYNTHESIS_ERROR_MESSAGE, tts_options):
+                        yield chunk
 
         logger.info('responding successful')
     except Exception as e:
         logger.error(f"General error in response handler: {e}")
 
+def sync_response(audio, chatbot=None, tts_options=None):
+    '''
+        Generator: the handler fastrtc calls from its worker threads, runs the response on the shared event loop
+    '''
+    try:
+        # fastrtc has copied a chunk into its own frame by the time it asks for the next one
+        for chunk in app_loop.iterate(response(audio, chatbot, tts_options, session_id()), discard=release_audio):
+            yield chunk
+            release_audio(chunk)
+    except Exception as e:
+        logger.error(f"Critical sync_response error: {e}")
+        return
+
 def run():
     '''
         Handle main program
     '''
     logger.info('starting main program')
-
-    def sync_response(audio, chatbot=None, tts_options=None, generating_response=False):
+    startup.start()
+    ollama_wrapper.pool.start_health_checks()
+    if METRICS_ENABLED and METRICS_PORT:
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            gen = response(audio, chatbot, tts_options, generating_response)
-            while True:
-                try:
-                    chunk = loop.run_until_complete(gen.__anext__())
-                    yield chunk
-                except StopAsyncIteration:
-                    break
-        except Exception as e:
-            logger.error(f"Critical sync_response error: {e}")
-            return
+            metrics.serve(port=METRICS_PORT)
+        except OSError as e:
+            logger.error(f"unable to serve metrics: {e}")
 
     try:
         stream = Stream(
-            handler=ReplyOnPause(sync_response, input_sample_rate=16000),
+            handler=StreamingReplyOnPause(sync_response, streaming_stt, speech_frames, input_sample_rate=16000)
+            if streaming_stt else PooledReplyOnPause(sync_response, speech_frames, input_sample_rate=16000),
             modality="audio",
             mode="send-receive",
             ui_args={
@@ -214,9 +661,18 @@ def run():
                 ]
             },
         )
+        app_loop.start()
         stream.ui.launch()
     except Exception as e:
         logger.error(f"Fatal error starting Stream UI: {e}")
+    finally:
+        app_loop.stop()
+        if speech_workers:
+            speech_workers.stop()
+        metrics.stop()
+        ollama_wrapper.pool.stop_health_checks()
+        ollama_wrapper.residency.stop()
+        ollama_wrapper.pulls.stop()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,285 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from modules import Logger
+
+REPLY = (
+    "You are doing better than you think. Every small step you take today builds the strength you need for tomorrow. "
+    "Take a deep breath, focus on what you can control, and keep moving forward. I believe in you."
+)
+
+logger = Logger(name='mock_ollama').get_logger()
+
+class MockOllama:
+    def __init__(
+        self,
+        models=('mock-model', 'nomic-embed-text'),
+        token_rate=50.0,
+        first_token_latency=0.2,
+        reply_tokens=40,
+        embedding_dim=384,
+        embedding_latency=0.01,
+        load_latency=0.0,
+        model_size=4 * 1024 ** 3,
+        pull_size=0,
+        pull_rate=100e6,
+        interrupt_pulls=0
+    ):
+        '''
+            Stand-in ollama server for benchmarks, answers with a canned reply at a fixed token rate
+
+            Serves /api/tags, /api/ps, /api/generate, /api/chat, /api/embed, /api/pull and /api/delete.
+            first_token_latency stands in for prompt evaluation, token_rate is the decode speed in tokens per second.
+            The first request for a model that is not loaded waits load_latency seconds, keep_alive 0 unloads it.
+            Pulling a missing model downloads pull_size bytes at pull_rate bytes per second with progress, the first
+            interrupt_pulls pulls drop the connection half way and the next pull resumes where it stopped.
+        '''
+        self.models = list(models)
+        self.token_rate = token_rate
+        self.first_token_latency = first_token_latency
+        self.reply_tokens = reply_tokens
+        self.embedding_dim = embedding_dim
+        self.embedding_latency = embedding_latency
+        self.load_latency = load_latency
+        self.model_size = model_size
+        self.loaded = set()
+        self.pull_size = pull_size
+        self.pull_rate = pull_rate
+        self.interrupt_pulls = interrupt_pulls
+        self.downloaded = {}
+        self.requests = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def tokens(self):
+        words = REPLY.split(' ')
+        return [(word if position == 0 else f' {word}') for position, word in enumerate(words * (self.reply_tokens // len(words) + 1))][:self.reply_tokens]
+
+    def load(self, model, keep_alive):
+        '''
+            Load model like a request to ollama does, returns the load duration in nanoseconds
+        '''
+        if keep_alive == 0:
+            self.loaded.discard(model)
+            return 0
+        if model in self.loaded:
+            return 0
+        time.sleep(self.load_latency)
+        self.loaded.add(model)
+        return int(self.load_latency * 1e9)
+
+    def pull(self, model):
+        '''
+            Progress messages of pulling model, like ollama reports them
+        '''
+        yield {'status': 'pulling manifest'}
+        digest = 'sha256:' + hashlib.sha256(model.encode()).hexdigest()
+        step = max(int(self.pull_rate * 0.1), 1)
+        while model not in self.models and self.downloaded.get(model, 0) < self.pull_size:
+            time.sleep(0.1)
+            self.downloaded[model] = min(self.downloaded.get(model, 0) + step, self.pull_size)
+            yield {'status': f'pulling {digest[7:19]}', 'digest': digest, 'total': self.pull_size, 'completed': self.downloaded[model]}
+            if self.interrupt_pulls and self.downloaded[model] >= self.pull_size / 2:
+                self.interrupt_pulls -= 1
+                raise ConnectionResetError('interrupted pull')
+        if model not in self.models:
+            self.models.append(model)
+        yield {'status': 'verifying sha256 digest'}
+        yield {'status': 'success'}
+
+    def embedding(self, text):
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        return [((digest[position % len(digest)] + position) % 256) / 128.0 - 1.0 for position in range(self.embedding_dim)]
+
+    def start(self, host='127.0.0.1', port=0):
+        '''
+            Serve on a daemon thread, returns the endpoint url
+        '''
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='mock-ollama', daemon=True).start()
+        endpoint = f'http://{host}:{self._server.server_address[1]}'
+        logger.info('mock ollama serving on %s', endpoint)
+        return endpoint
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+def _untagged(model):
+    # models are served without their default tag, like ollama resolves name to name:latest
+    return model[:-len(':latest')] if model and model.endswith(':latest') else model
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+def _handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _json(self, payload, status=200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def _stream(self, lines):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for line in lines:
+                    data = (json.dumps(line) + '\n').encode()
+                    self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                    self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading, like a cancelled turn
+                self.close_connection = True
+
+        def do_GET(self):
+            if self.path == '/api/tags':
+                self._json({'models': [
+                    {'name': model, 'model': model, 'modified_at': _now(), 'size': 0, 'digest': hashlib.sha256(model.encode()).hexdigest()}
+                    for model in mock.models
+                ]})
+            elif self.path == '/api/ps':
+                self._json({'models': [
+                    {'name': model, 'model': model, 'size': mock.model_size, 'size_vram': mock.model_size, 'digest': hashlib.sha256(model.encode()).hexdigest()}
+                    for model in sorted(mock.loaded)
+                ]})
+            elif self.path in ('/', '/api/version'):
+                self._json({'version': 'mock'})
+            else:
+                self._json({'error': 'not found'}, 404)
+
+        def do_DELETE(self):
+            if self.path != '/api/delete':
+                self._json({'error': 'not found'}, 404)
+                return
+            model = _untagged(self._body().get('model'))
+            if model in mock.models:
+                mock.models.remove(model)
+            self._json({'status': 'success'})
+
+        def do_POST(self):
+            request = self._body()
+            model = _untagged(request.get('model'))
+            request['model'] = model
+            with mock._lock:
+                mock.requests += 1
+                mock.in_flight += 1
+            try:
+                if self.path == '/api/pull':
+                    if request.get('stream', True):
+                        self._stream(mock.pull(model))
+                    else:
+                        for _ in mock.pull(model):
+                            pass
+                        self._json({'status': 'success'})
+                elif model not in mock.models:
+                    self._json({'error': f"model '{model}' not found"}, 404)
+                elif self.path == '/api/embed':
+                    load_duration = mock.load(model, request.get('keep_alive'))
+                    texts = request.get('input') or []
+                    texts = [texts] if isinstance(texts, str) else texts
+                    if texts:
+                        time.sleep(mock.embedding_latency)
+                    self._json({'model': model, 'embeddings': [mock.embedding(text) for text in texts], 'load_duration': load_duration})
+                elif self.path in ('/api/generate', '/api/chat'):
+                    self._reply(request, chat=self.path == '/api/chat')
+                else:
+                    self._json({'error': 'not found'}, 404)
+            finally:
+                with mock._lock:
+                    mock.in_flight -= 1
+
+        def _reply(self, request, chat):
+            model = request['model']
+            load_duration = mock.load(model, request.get('keep_alive'))
+            # a generate call without prompt only loads the model, like configure_system
+            tokens = mock.tokens() if (chat or request.get('prompt')) and request.get('keep_alive') != 0 else []
+            prompt_chars = len(json.dumps(request.get('messages') or request.get('prompt') or ''))
+
+            def message(text, done):
+                line = {'model': model, 'created_at': _now(), 'done': done}
+                if chat:
+                    line['message'] = {'role': 'assistant', 'content': text}
+                else:
+                    line['response'] = text
+                if done:
+                    line.update({
+                        'done_reason': 'stop',
+                        'load_duration': load_duration,
+                        'prompt_eval_count': prompt_chars // 4,
+                        'prompt_eval_duration': int(mock.first_token_latency * 1e9),
+                        'eval_count': len(tokens),
+                        'eval_duration': int(len(tokens) / mock.token_rate * 1e9),
+                        'total_duration': int((mock.first_token_latency + len(tokens) / mock.token_rate) * 1e9),
+                    })
+                return line
+
+            def lines():
+                start = time.perf_counter()
+                time.sleep(mock.first_token_latency)
+                for position, token in enumerate(tokens):
+                    # pace against the start so sleep overshoot does not add up
+                    delay = start + mock.first_token_latency + position / mock.token_rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    yield message(token, False)
+                yield message('', True)
+
+            if request.get('stream', True):
+                self._stream(lines())
+            else:
+                time.sleep(mock.first_token_latency + len(tokens) / mock.token_rate)
+                self._json(message(''.join(tokens), True))
+
+    return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stand-in ollama server for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--models', default='mock-model,nomic-embed-text', help='comma separated model names')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='tokens per second')
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help='seconds before the first token')
+    parser.add_argument('--reply-tokens', type=int, default=40)
+    parser.add_argument('--embedding-dim', type=int, default=384)
+    parser.add_argument('--load-latency', type=float, default=0.0, help='seconds to load a model that is not loaded')
+    parser.add_argument('--pull-size', type=int, default=0, help='bytes downloaded when a missing model is pulled')
+    parser.add_argument('--pull-rate', type=float, default=100e6, help='pull download speed in bytes per second')
+    args = parser.parse_args()
+    mock = MockOllama(
+        models=args.models.split(','),
+        token_rate=args.token_rate,
+        first_token_latency=args.first_token_latency,
+        reply_tokens=args.reply_tokens,
+        embedding_dim=args.embedding_dim,
+        load_latency=args.load_latency,
+        pull_size=args.pull_size,
+        pull_rate=args.pull_rate
+    )
+    mock.start(args.host, args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        mock.stop()
@@ -1,4 +1,23 @@
-__all__ = ["OllamaWrapper", "Logger"]
+__all__ = ["OllamaWrapper", "StreamStats", "EndpointPool", "ModelResidency", "parse_keep_alive", "PullManager", "PullTask", "Logger", "ConversationEngine", "EmbeddingService", "VectorIndex", "SearchResult", "Retriever", "SentenceChunker", "AudioCache", "StartupOrchestrator", "TurnManager", "Metrics", "SpeechWorkerPool", "StreamingTranscriber", "StreamingReplyOnPause", "ResponseCache", "CachedResponse", "ModelRouter", "EmbeddingClassifier", "RouteDecision", "FramePool", "FrameBuffer", "PooledReplyOnPause", "BackgroundLoop", "iterate_in_thread"]
 
-from .ollamawrapper import OllamaWrapper
-from .logger import Logger
\ No newline at end of file
+from .ollamawrapper import OllamaWrapper, StreamStats
+from .endpointpool import EndpointPool
+from .residency import ModelResidency, parse_keep_alive
+from .pullmanager import PullManager, PullTask
+from .logger import Logger
+from .textchunker import SentenceChunker
+from .streambridge import iterate_in_thread
+from .eventloop import BackgroundLoop
+from .conversation import ConversationEngine
+from .embeddings import EmbeddingService
+from .vectorindex import VectorIndex, SearchResult
+from .retriever import Retriever
+from .audiocache import AudioCache
+from .startup import StartupOrchestrator
+from .turns import TurnManager
+from .metrics import Metrics
+from .audioframes import FramePool, FrameBuffer, PooledReplyOnPause
+from .speechworkers import SpeechWorkerPool
+from .streamingstt import StreamingTranscriber, StreamingReplyOnPause
+from .responsecache import ResponseCache, CachedResponse
+from .modelrouter import ModelRouter, EmbeddingClassifier, RouteDecision
\ No newline at end of file
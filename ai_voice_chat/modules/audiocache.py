@@ -0,0 +1,105 @@
+from typing import Callable, Iterable, List, Optional, Tuple, Any
+from collections import OrderedDict
+import numpy as np
+import threading
+
+AudioChunk = Tuple[int, np.ndarray]
+
+class _Entry:
+    __slots__ = ('sample_rate', 'audio', 'bounds')
+
+    def __init__(self, chunks: List[AudioChunk]) -> None:
+        # one contiguous buffer per phrase, chunk boundaries kept so playback starts as soon as before
+        self.sample_rate: int = chunks[0][0]
+        arrays = [np.asarray(audio).reshape(-1) for _, audio in chunks]
+        self.audio: np.ndarray = np.ascontiguousarray(np.concatenate(arrays))
+        self.bounds: np.ndarray = np.cumsum([0] + [len(array) for array in arrays])
+
+    @property
+    def nbytes(self) -> int:
+        return self.audio.nbytes + self.bounds.nbytes
+
+    def chunks(self) -> List[AudioChunk]:
+        return [(self.sample_rate, self.audio[start:end]) for start, end in zip(self.bounds[:-1], self.bounds[1:])]
+
+class AudioCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_text_chars: int = 120) -> None:
+        '''
+            LRU cache of synthesized speech keyed by text, voice, speed and language
+
+            Each phrase is stored as one contiguous numpy buffer. Entries are evicted least recently used first once the
+            cached audio exceeds max_bytes. Only texts up to max_text_chars characters are cached, longer llm output
+            rarely repeats.
+        '''
+        self.max_bytes: int = max_bytes
+        self.max_text_chars: int = max_text_chars
+        self.hits: int = 0
+        self.misses: int = 0
+        self.nbytes: int = 0
+        self._entries: 'OrderedDict[tuple, _Entry]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str, options: Any) -> tuple:
+        return (
+            ' '.join(text.split()),
+            getattr(options, 'voice', None),
+            getattr(options, 'speed', None),
+            getattr(options, 'lang', None)
+        )
+
+    def cacheable(self, text: str) -> bool:
+        return 0 < len(text) <= self.max_text_chars
+
+    def get(self, text: str, options: Any) -> Optional[List[AudioChunk]]:
+        '''
+            Cached audio chunks for text spoken with options, or None
+        '''
+        key = self.key(text, options)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return entry.chunks()
+
+    def put(self, text: str, options: Any, chunks: List[AudioChunk]) -> bool:
+        '''
+            Store synthesized audio chunks, returns False if the text or audio is not cacheable
+        '''
+        if not chunks or not self.cacheable(text):
+            return False
+        entry = _Entry(chunks)
+        if entry.nbytes > self.max_bytes:
+            return False
+        key = self.key(text, options)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._entries[key] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return True
+
+    def warm(self, texts: Iterable[str], options: Any, synthesize: Callable[[str, Any], Iterable[AudioChunk]]) -> int:
+        '''
+            Synthesize and store texts that are not cached yet, returns the number of phrases added
+        '''
+        added = 0
+        for text in texts:
+            key = self.key(text, options)
+            with self._lock:
+                if key in self._entries:
+                    continue
+            if self.put(text, options, list(synthesize(text, options))):
+                added += 1
+        return added
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.nbytes}
@@ -0,0 +1,251 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from fastrtc import ReplyOnPause
+from fastrtc.utils import create_message
+import numpy as np
+import threading
+
+AudioChunk = Tuple[int, np.ndarray]
+
+INT16_SCALE = np.float32(1.0 / 32768.0)
+
+def convert_into(samples: np.ndarray, out: np.ndarray) -> np.ndarray:
+    '''
+        Write samples into the float32 array out, int16 samples are scaled to [-1, 1) in the same pass, returns out
+    '''
+    if samples.dtype == np.int16:
+        np.multiply(samples, INT16_SCALE, out=out)
+    elif samples.dtype.kind == 'f':
+        np.copyto(out, samples, casting='same_kind')
+    else:
+        raise TypeError(f'unsupported audio data type: {samples.dtype}')
+    return out
+
+class Resampler:
+    def __init__(self, max_plans: int = 8) -> None:
+        '''
+            Linear interpolation resampling into caller provided float32 arrays
+
+            The frames of a stream have the same length, so sample positions, weights and scratch arrays are computed
+            once per (length, rate, rate) and reused, at most max_plans of them. The dtype conversion shares the pass.
+            Not thread safe, use one per stream.
+        '''
+        self.max_plans: int = max_plans
+        self._plans: Dict[Tuple[int, int, int], Tuple[np.ndarray, ...]] = {}
+
+    @staticmethod
+    def length(samples: int, from_rate: int, to_rate: int) -> int:
+        return samples * to_rate // from_rate
+
+    def _plan(self, samples: int, from_rate: int, to_rate: int) -> Tuple[np.ndarray, ...]:
+        key = (samples, from_rate, to_rate)
+        plan = self._plans.get(key)
+        if plan is None:
+            if len(self._plans) >= self.max_plans:
+                self._plans.clear()
+            positions = np.arange(self.length(samples, from_rate, to_rate), dtype=np.float64) * (from_rate / to_rate)
+            left = np.minimum(positions.astype(np.intp), samples - 1)
+            right = np.minimum(left + 1, samples - 1)
+            weights = (positions - left).astype(np.float32)
+            plan = self._plans[key] = (left, right, weights, np.empty(samples, np.float32), np.empty(len(left), np.float32))
+        return plan
+
+    def resample_into(self, samples: np.ndarray, from_rate: int, to_rate: int, out: np.ndarray) -> np.ndarray:
+        '''
+            Write samples at from_rate into the float32 array out at to_rate, out holds length() samples, returns out
+        '''
+        if from_rate == to_rate:
+            return convert_into(samples, out)
+        left, right, weights, source, scratch = self._plan(len(samples), from_rate, to_rate)
+        convert_into(samples, source)
+        np.take(source, left, out=out)
+        np.take(source, right, out=scratch)
+        np.subtract(scratch, out, out=scratch)
+        np.multiply(scratch, weights, out=scratch)
+        np.add(out, scratch, out=out)
+        return out
+
+class FramePool:
+    def __init__(self, frame_samples: int, max_frames: int = 8, dtype: Any = np.float32) -> None:
+        '''
+            Ring of reusable audio buffers of frame_samples samples each
+
+            acquire(n) returns a view of the first n samples of the next free buffer, going around the ring from the last
+            buffer handed out. The buffer stays taken until its owner passes the view, or any other view of the buffer,
+            to release(), after that it must not be read any more.
+            Buffers are allocated on first need up to max_frames, requests beyond that or larger than frame_samples get
+            a one-off array. Every allocation is counted, once the pool holds its working set there are none.
+        '''
+        self.frame_samples: int = frame_samples
+        self.max_frames: int = max_frames
+        self.dtype: np.dtype = np.dtype(dtype)
+        self.allocations: int = 0
+        self.allocated_bytes: int = 0
+        self.reuses: int = 0
+        self._frames: List[np.ndarray] = []
+        self._busy: List[bool] = []
+        self._next: int = 0
+        self._lock = threading.Lock()
+
+    def _allocate(self, samples: int) -> np.ndarray:
+        array = np.empty(samples, dtype=self.dtype)
+        self.allocations += 1
+        self.allocated_bytes += array.nbytes
+        return array
+
+    def acquire(self, samples: int) -> np.ndarray:
+        '''
+            Array of samples samples, its content is undefined
+        '''
+        with self._lock:
+            if samples <= self.frame_samples:
+                for step in range(len(self._frames)):
+                    index = (self._next + step) % len(self._frames)
+                    if not self._busy[index]:
+                        self._busy[index] = True
+                        self._next = (index + 1) % len(self._frames)
+                        self.reuses += 1
+                        return self._frames[index][:samples]
+                if len(self._frames) < self.max_frames:
+                    self._frames.append(self._allocate(self.frame_samples))
+                    self._busy.append(True)
+                    return self._frames[-1][:samples]
+            return self._allocate(samples)
+
+    def release(self, array: np.ndarray) -> bool:
+        '''
+            Give back the buffer array is a view of, False if array is not from this pool
+        '''
+        base = array if array.base is None else array.base
+        with self._lock:
+            for index, frame in enumerate(self._frames):
+                if frame is base:
+                    self._busy[index] = False
+                    return True
+        return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'frames': len(self._frames),
+                'busy': sum(self._busy),
+                'reuses': self.reuses,
+                'allocations': self.allocations,
+                'allocated_bytes': self.allocated_bytes,
+            }
+
+class FrameBuffer:
+    def __init__(self, pool: FramePool, sample_rate: int, resampler: Optional[Resampler] = None) -> None:
+        '''
+            Contiguous float32 PCM at sample_rate, accumulated frame by frame in a pooled buffer
+
+            Frames are converted (and resampled) straight into the buffer, view() hands out parts of it without copying.
+            A buffer that outgrows the pooled one moves to an array twice as large. The buffer is taken from the pool
+            until release().
+        '''
+        self.pool: FramePool = pool
+        self.sample_rate: int = sample_rate
+        self.resampler: Resampler = resampler or Resampler()
+        self.length: int = 0
+        self._data: np.ndarray = pool.acquire(pool.frame_samples)
+
+    def append(self, samples: np.ndarray, sample_rate: int) -> None:
+        samples = samples.reshape(-1)
+        count = Resampler.length(len(samples), sample_rate, self.sample_rate)
+        if self.length + count > len(self._data):
+            data = self.pool.acquire(max(2 * len(self._data), self.length + count))
+            data[:self.length] = self._data[:self.length]
+            self.pool.release(self._data)
+            self._data = data
+        self.resampler.resample_into(samples, sample_rate, self.sample_rate, self._data[self.length:self.length + count])
+        self.length += count
+
+    def view(self, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+        return self._data[start:self.length if end is None else end]
+
+    def clear(self) -> None:
+        '''
+            Drop the samples, only when no view of them is in use
+        '''
+        self.length = 0
+
+    def release(self) -> None:
+        '''
+            Give the buffer back to the pool, no view of it may be read afterwards
+        '''
+        self.pool.release(self._data)
+        self.length = 0
+
+class PooledReplyOnPause(ReplyOnPause):
+    def __init__(self, fn: Callable, frames: FramePool, **kwargs: Any) -> None:
+        '''
+            ReplyOnPause that accumulates speech in pooled float32 buffers instead of concatenating every frame
+
+            Incoming frames are converted to float32 at input_sample_rate once, in place, so pause detection and speech
+            to text get arrays they use as they are. The utterance is handed to fn as a view of its buffer, speech after
+            the hand over goes to another buffer of frames. From the hand over fn owns the buffer and gives it back with
+            frames.release(audio) once nothing reads it any more, speech that never reaches fn is given back here.
+        '''
+        super().__init__(fn, **kwargs)
+        self.frames: FramePool = frames
+        self._kwargs: Dict[str, Any] = kwargs
+        self._resampler = Resampler()
+        self._speech: Optional[FrameBuffer] = None
+        self._speech_state: Any = None
+        self._handed: Optional[FrameBuffer] = None
+        self._chunk_start: int = 0
+        self._speech_start: int = 0
+
+    def copy(self) -> 'PooledReplyOnPause':
+        # one handler per connection, they share the frame pool and the vad model
+        return PooledReplyOnPause(self.fn, self.frames, **dict(self._kwargs, model=self.model))
+
+    def process_audio(self, audio: AudioChunk, state: Any) -> None:
+        sample_rate, samples = audio
+        if self._speech is None or state is not self._speech_state:
+            # a new state means the last utterance went to fn, which releases it, or was dropped
+            self._drop_speech()
+            self._speech = FrameBuffer(self.frames, self.input_sample_rate, self._resampler)
+            self._speech_state = state
+            self._chunk_start = self._speech_start = 0
+        state.sampling_rate = self.input_sample_rate
+        self._speech.append(samples, sample_rate)
+        state.buffer = self._speech.view(self._chunk_start)
+        state.pause_detected = self.determine_pause(state.buffer, state.sampling_rate, state)
+
+    def _drop_speech(self) -> None:
+        if self._speech is not None and self._speech is not self._handed:
+            self._speech.release()
+        self._speech = self._handed = None
+
+    def emit(self) -> Any:
+        if self.event.is_set() and not self.generator and self.state is self._speech_state:
+            stream = self.state.stream
+            if stream is not None and stream.size > 0:
+                # fn gets a view of the speech buffer and releases it
+                self._handed = self._speech
+        return super().emit()
+
+    def shutdown(self) -> None:
+        super().shutdown()
+        self._drop_speech()
+
+    def determine_pause(self, audio: np.ndarray, sampling_rate: int, state: Any) -> bool:
+        # the pause detection of ReplyOnPause, with the utterance as a view of the speech buffer
+        if len(audio) / sampling_rate < self.algo_options.audio_chunk_duration:
+            return False
+        speech_seconds, _ = self.model.vad((sampling_rate, audio), self.model_options)
+        if speech_seconds > self.algo_options.started_talking_threshold and not state.started_talking:
+            state.started_talking = True
+            self._speech_start = self._chunk_start
+            self.send_message_sync(create_message('log', 'started_talking'))
+        if state.started_talking:
+            state.stream = self._speech.view(self._speech_start)
+            if len(state.stream) / sampling_rate >= self.algo_options.max_continuous_speech_s:
+                return True
+            self._chunk_start = self._speech.length
+        else:
+            # silence before the utterance is not kept
+            self._speech.clear()
+            self._chunk_start = 0
+        state.buffer = None
+        return speech_seconds < self.algo_options.speech_threshold and state.started_talking
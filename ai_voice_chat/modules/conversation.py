@@ -0,0 +1,177 @@
+from typing import AsyncGenerator, List, Optional, Type
+from collections import OrderedDict
+from .ollamawrapper import OllamaWrapper
+from .logger import Logger
+import asyncio
+
+_SUMMARY_PROMPT = (
+    'Summarize the conversation below in a few sentences. '
+    'Keep names, facts, preferences and open questions, drop small talk. '
+    'Reply with the summary only.'
+)
+
+class Conversation:
+    def __init__(self) -> None:
+        '''
+            History of one conversation, older turns are folded into summary
+        '''
+        self.summary: str = ''
+        self.turns: List[dict] = []
+        self.lock = asyncio.Lock()
+
+class ConversationEngine:
+    def __init__(
+        self,
+        ollama_wrapper: OllamaWrapper,
+        model_name: str,
+        system_prompt: Optional[str] = None,
+        logger: Type[Logger] = Logger,
+        token_budget: int = 2048,
+        compact_ratio: float = 0.5,
+        chars_per_token: float = 4.0,
+        summarize: bool = True,
+        max_conversations: int = 256
+    ) -> None:
+        '''
+            Keeps per conversation chat history for the ollama chat endpoint
+
+            Messages always start with the system prompt, then the summary of older turns, then the recent turns in order.
+            History is only rewritten when the estimated prompt size exceeds token_budget, and then it is compacted down to
+            compact_ratio * token_budget in one go. Between compactions every request extends the previous one, so the server
+            can reuse its KV cache and only prefill the new turn.
+            Older turns are summarized with the same model, or simply dropped if summarize is False or summarizing fails,
+            in which case the previous summary is kept.
+            Token counts are estimated as characters / chars_per_token.
+        '''
+        if not 0 < compact_ratio < 1:
+            raise ValueError('compact_ratio must be between 0 and 1')
+        self.ollama_wrapper: OllamaWrapper = ollama_wrapper
+        self.model_name: str = model_name
+        self.system_prompt: Optional[str] = system_prompt
+        self.token_budget: int = token_budget
+        self.compact_ratio: float = compact_ratio
+        self.chars_per_token: float = chars_per_token
+        self.summarize: bool = summarize
+        self.max_conversations: int = max_conversations
+        self.compactions: int = 0
+        self._conversations: 'OrderedDict[str, Conversation]' = OrderedDict()
+        self.logger = logger(name='conversation_engine').get_logger()
+
+    def conversation(self, conversation_id: str) -> Conversation:
+        '''
+            Get or create a conversation, the least recently used one is dropped beyond max_conversations
+        '''
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            conversation = Conversation()
+            self._conversations[conversation_id] = conversation
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+        else:
+            self._conversations.move_to_end(conversation_id)
+        return conversation
+
+    def reset(self, conversation_id: str) -> None:
+        self._conversations.pop(conversation_id, None)
+
+    def history_tokens(self, conversation_id: str) -> int:
+        '''
+            Estimated prompt size of the conversation so far
+        '''
+        return self.estimate_tokens(self.messages(self.conversation(conversation_id)))
+
+    def estimate_tokens(self, messages: List[dict]) -> int:
+        '''
+            Rough prompt size, a few tokens of per message overhead plus the content length
+        '''
+        return sum(4 + int(len(message['content']) / self.chars_per_token) for message in messages)
+
+    def messages(self, conversation: Conversation) -> List[dict]:
+        '''
+            Chat messages for the next request
+        '''
+        messages: List[dict] = []
+        if self.system_prompt:
+            messages.append({'role': 'system', 'content': self.system_prompt})
+        if conversation.summary:
+            messages.append({'role': 'system', 'content': f'Summary of the earlier conversation: {conversation.summary}'})
+        messages.extend(conversation.turns)
+        return messages
+
+    async def compact(self, conversation: Conversation) -> None:
+        '''
+            Fold the oldest turns into the summary until the prompt fits compact_ratio * token_budget
+        '''
+        target = int(self.token_budget * self.compact_ratio)
+        keep = len(conversation.turns)
+        # keep the newest turns that fit next to the system prompt and summary, but always the latest user message
+        kept_tokens = self.estimate_tokens(self.messages(Conversation())) + (target // 2 if self.summarize else 0)
+        for index in range(len(conversation.turns) - 1, -1, -1):
+            kept_tokens += self.estimate_tokens([conversation.turns[index]])
+            if kept_tokens > target and index < len(conversation.turns) - 1:
+                break
+            keep = index
+        dropped = conversation.turns[:keep]
+        if not dropped:
+            return
+
+        summary = conversation.summary
+        if self.summarize:
+            transcript = '\n'.join(f"{turn['role']}: {turn['content']}" for turn in dropped)
+            if conversation.summary:
+                transcript = f'Earlier summary: {conversation.summary}\n{transcript}'
+            generated = await self.ollama_wrapper.generate_chat(self.model_name, [
+                {'role': 'system', 'content': _SUMMARY_PROMPT},
+                {'role': 'user', 'content': transcript}
+            ], cache=False)
+            if generated and generated.strip():
+                # the summary itself must not eat the budget
+                summary = generated.strip()[:int(target * self.chars_per_token / 2)]
+            else:
+                self.logger.warning('unable to summarize %s turns, keeping the previous summary', len(dropped))
+        conversation.summary = summary
+        conversation.turns = conversation.turns[keep:]
+        self.compactions += 1
+        self.logger.info('compacted conversation, folded %s turns, %s kept', len(dropped), len(conversation.turns))
+
+    async def stream_reply(
+        self,
+        conversation_id: str,
+        user_text: str,
+        context: Optional[str] = None,
+        cache: bool = True,
+        model_name: Optional[str] = None
+    ) -> AsyncGenerator[str, None]:
+        '''
+            Async generator: adds the user turn, streams the assistant reply and records it in the history
+
+            context (for example retrieved documents) is only added to this request's user message, not to the history,
+            so it does not grow the prompt of later turns.
+            If the stream is stopped early, only the part of the reply that was produced is kept.
+            Replies are not taken from the response cache when cache is False or context is given.
+            model_name overrides the engine's model for this reply.
+        '''
+        conversation = self.conversation(conversation_id)
+        async with conversation.lock:
+            reply: List[str] = []
+            try:
+                conversation.turns.append({'role': 'user', 'content': user_text})
+                if self.estimate_tokens(self.messages(conversation)) > self.token_budget:
+                    await self.compact(conversation)
+
+                messages = self.messages(conversation)
+                if context:
+                    messages[-1] = {'role': 'user', 'content': f'Use this information if it is relevant:\n{context}\n\n{user_text}'}
+
+                async for chunk in self.ollama_wrapper.generate_chat_stream(
+                    model_name or self.model_name, messages, session_id=conversation_id, cache=cache and not context
+                ):
+                    reply.append(chunk)
+                    yield chunk
+            finally:
+                text = ''.join(reply).strip()
+                if text:
+                    conversation.turns.append({'role': 'assistant', 'content': text})
+                else:
+                    # keep user and assistant turns paired
+                    conversation.turns.pop()
@@ -0,0 +1,159 @@
+from typing import List, Optional, Dict, Type
+from collections import OrderedDict
+from .ollamawrapper import OllamaWrapper
+from .logger import Logger
+import numpy as np
+import asyncio
+import hashlib
+import os
+import threading
+
+class EmbeddingService:
+    def __init__(
+        self,
+        ollama_wrapper: OllamaWrapper,
+        model_name: str,
+        logger: Type[Logger] = Logger,
+        batch_size: int = 32,
+        max_in_flight: int = 4,
+        cache_size: int = 10000,
+        cache_dir: Optional[str] = None
+    ) -> None:
+        '''
+            Batched and cached embeddings on top of OllamaWrapper.generate_embedding
+
+            Inputs are deduplicated, looked up in an in memory LRU cache keyed by a hash of model and text (and in cache_dir
+            if given), and only the misses are sent to ollama in batches of batch_size with at most max_in_flight
+            batches running at once.
+        '''
+        if batch_size < 1 or max_in_flight < 1:
+            raise ValueError('batch_size and max_in_flight must be at least 1')
+        self.ollama_wrapper: OllamaWrapper = ollama_wrapper
+        self.model_name: str = model_name
+        self.batch_size: int = batch_size
+        self.max_in_flight: int = max_in_flight
+        self.cache_size: int = cache_size
+        self.cache_dir: Optional[str] = cache_dir
+        self.cache_hits: int = 0
+        self.cache_misses: int = 0
+        self._cache: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.logger = logger(name='embedding_service').get_logger()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f'{self.model_name}\0{text}'.encode('utf-8')).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[np.ndarray]:
+        with self._cache_lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+            return vector
+
+    def _cache_put(self, key: str, vector: np.ndarray) -> None:
+        with self._cache_lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.npy')
+
+    def _disk_get(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        for key in keys:
+            try:
+                found[key] = np.load(self._disk_path(key))
+            except (OSError, ValueError):
+                continue
+        return found
+
+    def _disk_put(self, vectors: Dict[str, np.ndarray]) -> None:
+        for key, vector in vectors.items():
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # write then rename so a crash never leaves a truncated entry behind
+                temp_path = f'{path}.{threading.get_ident()}.tmp'
+                with open(temp_path, 'wb') as file:
+                    np.save(file, vector)
+                os.replace(temp_path, path)
+            except OSError as e:
+                self.logger.error('error writing embedding cache entry \n %s', e)
+
+    def cache_stats(self) -> dict:
+        with self._cache_lock:
+            return {'hits': self.cache_hits, 'misses': self.cache_misses, 'entries': len(self._cache)}
+
+    async def _embed_batch(self, texts: List[str], in_flight: asyncio.Semaphore) -> Optional[np.ndarray]:
+        async with in_flight:
+            embeddings = await self.ollama_wrapper.generate_embedding(self.model_name, texts)
+        if embeddings is None or len(embeddings) != len(texts):
+            return None
+        return np.asarray(embeddings, dtype=np.float32)
+
+    async def embed(self, texts: List[str]) -> Optional[np.ndarray]:
+        '''
+            Embeds texts, returns a contiguous float32 array with one row per text or None if ollama failed
+        '''
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        keys = [self._key(text) for text in texts]
+        vectors: Dict[str, np.ndarray] = {}
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in missing:
+                continue
+            vector = self._cache_get(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                vectors[key] = vector
+        hits = len(vectors)
+
+        loop = asyncio.get_event_loop()
+        if missing and self.cache_dir:
+            from_disk = await loop.run_in_executor(None, self._disk_get, list(missing))
+            for key, vector in from_disk.items():
+                vectors[key] = vector
+                self._cache_put(key, vector)
+                del missing[key]
+            hits += len(from_disk)
+
+        with self._cache_lock:
+            self.cache_hits += hits
+            self.cache_misses += len(missing)
+
+        if missing:
+            missing_keys = list(missing)
+            in_flight = asyncio.Semaphore(self.max_in_flight)
+            batches = [missing_keys[i:i + self.batch_size] for i in range(0, len(missing_keys), self.batch_size)]
+            results = await asyncio.gather(*[
+                self._embed_batch([missing[key] for key in batch], in_flight) for batch in batches
+            ])
+            computed: Dict[str, np.ndarray] = {}
+            for batch, result in zip(batches, results):
+                if result is None:
+                    self.logger.error('error embedding batch of %s texts with model %s', len(batch), self.model_name)
+                    return None
+                for key, vector in zip(batch, result):
+                    # copy so a cached row does not keep its whole batch alive
+                    vector = vector.copy()
+                    computed[key] = vector
+                    self._cache_put(key, vector)
+            vectors.update(computed)
+            if self.cache_dir:
+                await loop.run_in_executor(None, self._disk_put, computed)
+            self.logger.info('embedded %s new texts in %s batches', len(missing_keys), len(batches))
+
+        return np.stack([vectors[key] for key in keys]).astype(np.float32, copy=False)
+
+    async def embed_one(self, text: str) -> Optional[np.ndarray]:
+        '''
+            Embeds a single text, returns a float32 vector or None if ollama failed
+        '''
+        output = await self.embed([text])
+        return None if output is None else output[0]
@@ -0,0 +1,241 @@
+from typing import Callable, Iterator, List, Optional, Set, Tuple, Type, TypeVar
+from collections import OrderedDict
+from contextlib import contextmanager
+from ollama import Client
+from .logger import Logger
+import threading
+import httpx
+import time
+
+T = TypeVar('T')
+
+def is_connection_error(error: BaseException) -> bool:
+    '''
+        Check if an error means the server could not be reached, as opposed to an error response from it
+    '''
+    return isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError))
+
+class Endpoint:
+    def __init__(self, url: str, client: Client, health_client: Client) -> None:
+        '''
+            One ollama server, latency is an exponential moving average in seconds, None until the first request finished
+        '''
+        self.url: str = url
+        self.client: Client = client
+        self.health_client: Client = health_client
+        self.healthy: bool = True
+        self.in_flight: int = 0
+        self.latency: Optional[float] = None
+        self.requests: int = 0
+        self.failures: int = 0
+        self.models: Set[str] = set()
+        self.last_error: Optional[str] = None
+
+    def load(self) -> Tuple[float, int]:
+        # expected wait for a new request, endpoints without a measured latency are tried first
+        return (self.in_flight + 1) * (self.latency or 0.0), self.in_flight
+
+class EndpointPool:
+    def __init__(
+        self,
+        endpoints: List[str],
+        client: Type[Client],
+        logger: Type[Logger] = Logger,
+        health_interval: float = 10.0,
+        health_timeout: float = 2.0,
+        latency_alpha: float = 0.2,
+        max_sessions: int = 4096
+    ) -> None:
+        '''
+            Routes requests across several ollama servers
+
+            A request goes to the healthy endpoint with the lowest load, in-flight requests weighted by recent latency.
+            Requests of a session stick to the endpoint that served it first, so the server can reuse the KV cache of its
+            conversation. Endpoints are marked unhealthy on connection errors and brought back by the next request that
+            reaches them or by the health checks.
+        '''
+        if not endpoints:
+            raise ValueError('at least one ollama endpoint is required')
+        self.endpoints: List[Endpoint] = [
+            Endpoint(url, client(host=url), client(host=url, timeout=health_timeout)) for url in endpoints
+        ]
+        self.health_interval: float = health_interval
+        self.latency_alpha: float = latency_alpha
+        self.max_sessions: int = max_sessions
+        self.failovers: int = 0
+        self._sessions: 'OrderedDict[str, Endpoint]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread: Optional[threading.Thread] = None
+        self.logger = logger(name='endpoint_pool').get_logger()
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def select(self, model_name: Optional[str] = None, session_id: Optional[str] = None, exclude: Optional[Set[str]] = None) -> Endpoint:
+        '''
+            Endpoint for the next request, prefers endpoints known to have model_name downloaded
+        '''
+        with self._lock:
+            excluded = exclude or set()
+            sticky = self._sessions.get(session_id) if session_id is not None else None
+            if sticky is not None and sticky.healthy and sticky.url not in excluded:
+                self._sessions.move_to_end(session_id)
+                return sticky
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.url not in excluded] or self.endpoints
+            candidates = [endpoint for endpoint in candidates if endpoint.healthy] or candidates
+            if model_name is not None:
+                candidates = [endpoint for endpoint in candidates if model_name in endpoint.models] or candidates
+            endpoint = min(candidates, key=Endpoint.load)
+            if session_id is not None:
+                self._sessions[session_id] = endpoint
+                self._sessions.move_to_end(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            return endpoint
+
+    @contextmanager
+    def lease(self, endpoint: Endpoint) -> Iterator[Callable[[float], None]]:
+        '''
+            Track a request on endpoint, yields a function that records its latency in seconds
+
+            Connection errors mark the endpoint unhealthy before they propagate, a recorded latency marks it healthy.
+        '''
+        with self._lock:
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+
+        def observe(seconds: float) -> None:
+            with self._lock:
+                if endpoint.latency is None:
+                    endpoint.latency = seconds
+                else:
+                    endpoint.latency += self.latency_alpha * (seconds - endpoint.latency)
+            self.mark_healthy(endpoint)
+
+        try:
+            yield observe
+        except BaseException as e:
+            if is_connection_error(e):
+                self.mark_unhealthy(endpoint, e)
+            raise
+        finally:
+            with self._lock:
+                endpoint.in_flight -= 1
+
+    def call(self, call: Callable[[Endpoint], T], model_name: Optional[str] = None, session_id: Optional[str] = None) -> T:
+        '''
+            Run call on the selected endpoint, failing over to the next endpoint on connection errors
+        '''
+        tried: Set[str] = set()
+        while True:
+            endpoint = self.select(model_name, session_id, exclude=tried)
+            tried.add(endpoint.url)
+            start = time.perf_counter()
+            try:
+                with self.lease(endpoint) as observe:
+                    result = call(endpoint)
+                    observe(time.perf_counter() - start)
+                    return result
+            except Exception as e:
+                if not is_connection_error(e) or len(tried) >= len(self.endpoints):
+                    raise
+                self.failovers += 1
+                self.logger.warning('endpoint %s unreachable, failing over', endpoint.url)
+
+    def stream(
+        self,
+        open_stream: Callable[[Endpoint], Iterator[T]],
+        model_name: Optional[str] = None,
+        session_id: Optional[str] = None
+    ) -> Iterator[T]:
+        '''
+            Yield the items of a streaming request, failing over to the next endpoint if it can not be opened
+
+            open_stream must send the request before returning, the endpoint stays in flight until the stream is exhausted
+            or closed and its latency is the time until the stream was open.
+        '''
+        tried: Set[str] = set()
+        while True:
+            endpoint = self.select(model_name, session_id, exclude=tried)
+            tried.add(endpoint.url)
+            start = time.perf_counter()
+            with self.lease(endpoint) as observe:
+                try:
+                    items = open_stream(endpoint)
+                except Exception as e:
+                    if not is_connection_error(e) or len(tried) >= len(self.endpoints):
+                        raise
+                    self.mark_unhealthy(endpoint, e)
+                    self.failovers += 1
+                    self.logger.warning('endpoint %s unreachable, failing over', endpoint.url)
+                    continue
+                observe(time.perf_counter() - start)
+                yield from items
+                return
+
+    def mark_unhealthy(self, endpoint: Endpoint, error: BaseException) -> None:
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.last_error = str(error)
+            if not endpoint.healthy:
+                return
+            endpoint.healthy = False
+        self.logger.error('endpoint %s marked unhealthy \n %s', endpoint.url, error)
+
+    def mark_healthy(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            recovered = not endpoint.healthy
+            endpoint.healthy = True
+        if recovered:
+            self.logger.info('endpoint %s is healthy again', endpoint.url)
+
+    def check_health(self) -> None:
+        '''
+            Query /api/tags of every endpoint, updating its health and downloaded models
+        '''
+        for endpoint in self.endpoints:
+            try:
+                models = {model['model'] for model in endpoint.health_client.list().models}
+            except Exception as e:
+                self.mark_unhealthy(endpoint, e)
+                continue
+            with self._lock:
+                endpoint.models = models
+            self.mark_healthy(endpoint)
+
+    def start_health_checks(self) -> None:
+        '''
+            Check the health of every endpoint every health_interval seconds on a daemon thread
+
+            Also runs with a single endpoint, it is the only way back for an endpoint that gets no requests.
+        '''
+        if self._health_thread is not None:
+            return
+
+        def run() -> None:
+            while not self._stop.wait(self.health_interval):
+                self.check_health()
+
+        self._health_thread = threading.Thread(target=run, name='endpoint-health', daemon=True)
+        self._health_thread.start()
+
+    def stop_health_checks(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'failovers': self.failovers,
+                'sessions': len(self._sessions),
+                'endpoints': {
+                    endpoint.url: {
+                        'healthy': endpoint.healthy,
+                        'in_flight': endpoint.in_flight,
+                        'latency': endpoint.latency,
+                        'requests': endpoint.requests,
+                        'failures': endpoint.failures,
+                    }
+                    for endpoint in self.endpoints
+                }
+            }
@@ -0,0 +1,149 @@
+from typing import AsyncIterator, Callable, Coroutine, Iterator, Optional, TypeVar, Any
+import asyncio
+import concurrent.futures
+import queue
+import threading
+
+T = TypeVar('T')
+
+_ITEM = 0
+_ERROR = 1
+_DONE = 2
+
+class BackgroundLoop:
+    def __init__(self, name: str = 'background-loop') -> None:
+        '''
+            A long lived asyncio event loop running on its own daemon thread
+
+            Synchronous code (like the ReplyOnPause handler) submits coroutines to it instead of creating a new loop per call,
+            so async resources created on this loop can be shared between calls and sessions.
+        '''
+        self.name: str = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        '''
+            The running event loop, started on first use
+        '''
+        self.start()
+        return self._loop
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            ready = threading.Event()
+
+            def run() -> None:
+                self._loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self._loop)
+                ready.set()
+                try:
+                    self._loop.run_forever()
+                finally:
+                    self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+                    self._loop.close()
+
+            self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        '''
+            Stop the loop and wait for its thread to exit
+        '''
+        with self._lock:
+            if self._thread is None or self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> concurrent.futures.Future:
+        '''
+            Schedule a coroutine on the loop from any thread
+        '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        '''
+            Run a coroutine on the loop and block until it returns
+        '''
+        return self.submit(coroutine).result(timeout)
+
+    def iterate(
+        self,
+        async_iterator: AsyncIterator[T],
+        maxsize: int = 8,
+        discard: Optional[Callable[[T], None]] = None
+    ) -> Iterator[T]:
+        '''
+            Generator: drives an async iterator on the loop and yields its items to the calling thread
+
+            At most maxsize items are produced ahead of the caller.
+            Closing the generator early cancels the async iterator on the loop, items produced but never yielded
+            are passed to discard, if given.
+        '''
+        loop = self.loop
+        items: queue.Queue = queue.Queue()
+        slots: Optional[asyncio.Semaphore] = None
+        closed = False
+        lock = threading.Lock()
+
+        def drop(item: T) -> None:
+            if discard is not None:
+                discard(item)
+
+        def deliver(item: T) -> None:
+            with lock:
+                if not closed:
+                    items.put((_ITEM, item))
+                    return
+            drop(item)
+
+        async def pump() -> None:
+            nonlocal slots
+            slots = asyncio.Semaphore(maxsize)
+            try:
+                async for item in async_iterator:
+                    try:
+                        await slots.acquire()
+                    except asyncio.CancelledError:
+                        drop(item)
+                        raise
+                    deliver(item)
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                items.put((_ERROR, e))
+            finally:
+                aclose = getattr(async_iterator, 'aclose', None)
+                if aclose is not None:
+                    await aclose()
+                items.put((_DONE, None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), loop)
+        try:
+            while True:
+                kind, value = items.get()
+                if kind == _DONE:
+                    break
+                if kind == _ERROR:
+                    raise value
+                loop.call_soon_threadsafe(slots.release)
+                yield value
+        finally:
+            if not future.done():
+                future.cancel()
+            with lock:
+                closed = True
+            while True:
+                try:
+                    kind, value = items.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == _ITEM:
+                    drop(value)
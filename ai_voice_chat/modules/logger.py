@@ -1,26 +1,231 @@
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+import threading
 import logging
+import atexit
+import random
+import queue
+import json
+import time
 import sys
+import os
+
+class _Backend:
+    """
+    Process wide log output shared by every Logger, records are written to stdout by a listener thread.
+    """
+    asynchronous: bool = os.getenv("LOG_ASYNC", "true").lower() == "true"
+    json_output: bool = os.getenv("LOG_JSON", "false").lower() == "true"
+    max_chars: int = int(os.getenv("LOG_MAX_CHARS", "2000"))
+    queue_size: int = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    handler: Optional[logging.Handler] = None
+    listener: Optional[QueueListener] = None
+    loggers: set = set()
+    lock = threading.Lock()
+
+    @classmethod
+    def build(cls) -> logging.Handler:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(_TruncatingFormatter(cls.max_chars, cls.json_output))
+        if not cls.asynchronous:
+            return stream_handler
+        log_queue: queue.Queue = queue.Queue(maxsize=cls.queue_size)
+        cls.listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        cls.listener.start()
+        return _NonBlockingQueueHandler(log_queue)
+
+    @classmethod
+    def stop(cls) -> None:
+        if cls.listener is not None:
+            cls.listener.stop()
+        cls.listener = None
+
+class _TruncatingFormatter(logging.Formatter):
+    def __init__(self, max_chars: int, json_output: bool) -> None:
+        super().__init__(
+            fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S"
+        )
+        self.max_chars = max_chars
+        self.json_output = json_output
+
+    def _truncate(self, text: str) -> str:
+        if self.max_chars and len(text) > self.max_chars:
+            return f"{text[:self.max_chars]}... [{len(text) - self.max_chars} chars truncated]"
+        return text
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.message = self._truncate(record.getMessage())
+        # queued records carry their traceback already rendered
+        exception = self.formatException(record.exc_info) if record.exc_info else getattr(record, "traceback_text", None)
+        if self.json_output:
+            payload = {
+                "time": record.created,
+                "name": record.name,
+                "level": record.levelname,
+                "message": record.message,
+                "thread": record.threadName,
+            }
+            if exception:
+                payload["exception"] = self._truncate(exception)
+            return json.dumps(payload, default=str)
+        record.asctime = self.formatTime(record, self.datefmt)
+        text = self.formatMessage(record)
+        if exception:
+            text = f"{text}\n{self._truncate(exception)}"
+        return text
+
+class _NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.traceback_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # like QueueHandler.prepare the message is rendered now: args may change before the listener gets to the record
+        # and a traceback keeps its frames alive, the line itself is still formatted on the listener thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        if record.exc_info:
+            record.traceback_text = self.traceback_formatter.formatException(record.exc_info)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class _SamplingFilter(logging.Filter):
+    def __init__(self, sample_rate: float, rate_limit: Optional[float]) -> None:
+        """
+        Keeps a sample_rate fraction of records and at most rate_limit records per second, warnings and errors always pass.
+        """
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit or 0.0
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.suppressed += 1
+            return False
+        if self.rate_limit:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit)
+                self.updated = now
+                if self.tokens < 1.0:
+                    self.suppressed += 1
+                    return False
+                self.tokens -= 1.0
+        return True
 
 class Logger:
-    def __init__(self, name: str, level: str = "INFO") -> None:
+    def __init__(
+        self,
+        name: str,
+        level: str = "INFO",
+        sample_rate: float = 1.0,
+        rate_limit: Optional[float] = None
+    ) -> None:
         """
         Initializes the custom logger.
 
+        Records go through a bounded queue to a listener thread that formats and writes them, so logging never waits on
+        stdout. Records are dropped instead of blocking when the queue is full.
+
         Args:
             name (str): Name of the logger.
             level (str): Logging level (e.g., "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL").
+            sample_rate (float): Fraction of debug and info records that are kept.
+            rate_limit (float): Maximum debug and info records per second, unlimited when None.
         """
         self.logger = logging.getLogger(name)
         self.logger.setLevel(self._get_log_level(level))
 
         if not self.logger.handlers:
-            handler = logging.StreamHandler(sys.stdout)
-            formatter = logging.Formatter(
-                fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S"
-            )
-            handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
+            self.logger.addHandler(self._get_handler())
+            _Backend.loggers.add(name)
+
+        for existing in [f for f in self.logger.filters if isinstance(f, _SamplingFilter)]:
+            self.logger.removeFilter(existing)
+        if sample_rate < 1.0 or rate_limit:
+            self.logger.addFilter(_SamplingFilter(sample_rate, rate_limit))
+
+    @staticmethod
+    def configure(
+        asynchronous: Optional[bool] = None,
+        json_output: Optional[bool] = None,
+        max_chars: Optional[int] = None,
+        queue_size: Optional[int] = None
+    ) -> None:
+        """
+        Changes the shared log output of all loggers.
+
+        Defaults come from the LOG_ASYNC, LOG_JSON, LOG_MAX_CHARS and LOG_QUEUE_SIZE environment variables.
+
+        Args:
+            asynchronous (bool): Write records on a listener thread instead of the logging thread.
+            json_output (bool): Write one JSON object per record.
+            max_chars (int): Truncate messages and tracebacks longer than this, 0 disables truncation.
+            queue_size (int): Maximum number of records waiting to be written.
+        """
+        with _Backend.lock:
+            if asynchronous is not None:
+                _Backend.asynchronous = asynchronous
+            if json_output is not None:
+                _Backend.json_output = json_output
+            if max_chars is not None:
+                _Backend.max_chars = max_chars
+            if queue_size is not None:
+                _Backend.queue_size = queue_size
+            previous = _Backend.handler
+            if previous is None:
+                return
+            _Backend.stop()
+            _Backend.handler = _Backend.build()
+            for name in _Backend.loggers:
+                logger = logging.getLogger(name)
+                logger.removeHandler(previous)
+                logger.addHandler(_Backend.handler)
+
+    @staticmethod
+    def shutdown() -> None:
+        """
+        Writes all queued records and stops the listener thread, called at exit.
+        """
+        with _Backend.lock:
+            _Backend.stop()
+
+    @staticmethod
+    def dropped() -> int:
+        """
+        Returns:
+            int: Number of records dropped because the queue was full.
+        """
+        handler = _Backend.handler
+        return handler.dropped if isinstance(handler, _NonBlockingQueueHandler) else 0
+
+    def _get_handler(self) -> logging.Handler:
+        """
+        Returns the shared handler, starting the listener thread on first use.
+
+        Returns:
+            logging.Handler: The handler attached to every logger.
+        """
+        with _Backend.lock:
+            if _Backend.handler is None:
+                _Backend.handler = _Backend.build()
+            return _Backend.handler
 
     def _get_log_level(self, level: str):
         """
@@ -49,4 +254,6 @@ class Logger:
         Returns:
             logging.Logger: The logger instance.
         """
-        return self.logger
\ No newline at end of file
+        return self.logger
+
+atexit.register(Logger.shutdown)
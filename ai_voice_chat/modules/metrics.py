@@ -0,0 +1,255 @@
+from typing import Dict, List, Optional, Sequence, Type
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextvars import ContextVar
+from .logger import Logger
+import threading
+import bisect
+import json
+import time
+
+# seconds, also used for real-time factors and tokens per second below 100
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0)
+
+STAGES = {
+    'stt_seconds': 'Speech to text duration',
+    'stt_saved_seconds': 'Speech to text time saved by transcribing while the user speaks',
+    'retrieval_seconds': 'Document retrieval duration',
+    'llm_time_to_first_token_seconds': 'Time from llm request to first token',
+    'llm_tokens_per_second': 'Llm decode speed',
+    'tts_time_to_first_chunk_seconds': 'Time from first sentence to its first synthesized audio chunk',
+    'tts_real_time_factor': 'Synthesis time divided by duration of the synthesized audio',
+    'end_to_end_seconds': 'Time from end of speech to first audio chunk',
+    'turn_seconds': 'Duration of a whole turn',
+    'cancel_latency_seconds': 'Time from cancelling a turn for a new utterance until its task finished unwinding',
+    'model_load_seconds': 'Time to load a model into memory, at startup or by a cold request',
+    'small_model_time_to_first_token_seconds': 'Time to first token of the small model of the router',
+    'large_model_time_to_first_token_seconds': 'Time to first token of the large model of the router',
+    'audio_allocations_per_turn': 'Audio arrays allocated since the previous turn, pool buffers and synthesized chunks outside a pool',
+    'audio_allocated_mb_per_turn': 'Megabytes of audio arrays allocated since the previous turn',
+}
+
+COUNTERS = {
+    'turns_cancelled_total': 'Turns cancelled by a new utterance',
+    'router_large_model_turns_total': 'Turns routed to the large model',
+    'router_small_model_turns_total': 'Turns routed to the small model',
+    'response_cache_hits_total': 'Turns answered from the response cache',
+    'response_cache_misses_total': 'Turns answered by the model after a response cache lookup',
+}
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        '''
+            Cumulative bucket histogram in the Prometheus format
+        '''
+        self.buckets: List[float] = sorted(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        '''
+            Upper bound of the bucket holding the q quantile, None without observations
+        '''
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for position, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank and count:
+                    return self.buckets[position] if position < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            cumulative, total = [], 0
+            for count in self.counts:
+                total += count
+                cumulative.append(total)
+            return {'buckets': list(self.buckets), 'cumulative': cumulative, 'count': self.count, 'sum': self.sum}
+
+class TurnTrace:
+    def __init__(self, session_id: str) -> None:
+        '''
+            Stage timings of one turn, started when the handler receives the utterance (the end of speech)
+        '''
+        self.session_id: str = session_id
+        self.started: float = time.perf_counter()
+        self.wall_time: float = time.time()
+        self.stages: Dict[str, float] = {}
+        self.marks: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    def mark(self, name: str) -> bool:
+        '''
+            Record the first time name happened relative to the turn start, returns False if it was already marked
+        '''
+        if name in self.marks:
+            return False
+        self.marks[name] = time.perf_counter() - self.started
+        return True
+
+    def to_dict(self) -> dict:
+        return {'session_id': self.session_id, 'time': self.wall_time, 'stages': self.stages, 'marks': self.marks, 'counts': self.counts}
+
+_current_trace: ContextVar[Optional[TurnTrace]] = ContextVar('current_trace', default=None)
+
+class Metrics:
+    def __init__(self, enabled: bool = True, trace_path: Optional[str] = None, logger: Type[Logger] = Logger) -> None:
+        '''
+            In-process latency histograms per pipeline stage and event counters, with an optional per-turn trace dump
+
+            The turn being handled is kept in a context variable, so stages deep in the pipeline record into it without
+            passing it around. When disabled every method returns right away and no trace is created.
+            trace_path appends one JSON line per finished turn.
+        '''
+        self.enabled: bool = enabled
+        self.trace_path: Optional[str] = trace_path
+        self.histograms: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        self.counters: Dict[str, int] = {counter: 0 for counter in COUNTERS}
+        self.turns: int = 0
+        self._counter_lock = threading.Lock()
+        self._trace_lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self.logger = logger(name='metrics').get_logger()
+
+    def begin_turn(self, session_id: str) -> Optional[TurnTrace]:
+        '''
+            Start tracing the turn running in the current context
+        '''
+        if not self.enabled:
+            return None
+        trace = TurnTrace(session_id)
+        _current_trace.set(trace)
+        return trace
+
+    @staticmethod
+    def current() -> Optional[TurnTrace]:
+        return _current_trace.get()
+
+    def observe(self, stage: str, value: Optional[float]) -> None:
+        '''
+            Record a value for stage in its histogram and the current turn trace
+        '''
+        if not self.enabled or value is None:
+            return
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, Histogram())
+        histogram.observe(value)
+        trace = _current_trace.get()
+        if trace is not None and stage not in trace.stages:
+            trace.stages[stage] = value
+
+    def increment(self, counter: str, amount: int = 1) -> None:
+        '''
+            Add amount to counter and to its count in the current turn trace
+        '''
+        if not self.enabled:
+            return
+        with self._counter_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.counts[counter] = trace.counts.get(counter, 0) + amount
+
+    def mark(self, name: str) -> Optional[float]:
+        '''
+            Mark an event of the current turn, returns its time since the turn start the first time it happens
+        '''
+        if not self.enabled:
+            return None
+        trace = _current_trace.get()
+        if trace is None or not trace.mark(name):
+            return None
+        return trace.marks[name]
+
+    def end_turn(self, trace: Optional[TurnTrace]) -> None:
+        if trace is None:
+            return
+        self.observe('turn_seconds', time.perf_counter() - trace.started)
+        self.turns += 1
+        if not self.trace_path:
+            return
+        try:
+            with self._trace_lock, open(self.trace_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(trace.to_dict()) + '\n')
+        except OSError as e:
+            self.logger.error('unable to write turn trace \n %s', e)
+
+    def to_json(self) -> dict:
+        stages = {}
+        for stage, histogram in self.histograms.items():
+            snapshot = histogram.snapshot()
+            stages[stage] = {
+                'count': snapshot['count'],
+                'mean': snapshot['sum'] / snapshot['count'] if snapshot['count'] else None,
+                'p50': histogram.quantile(0.5),
+                'p95': histogram.quantile(0.95),
+                'p99': histogram.quantile(0.99),
+            }
+        with self._counter_lock:
+            counters = dict(self.counters)
+        return {'enabled': self.enabled, 'turns': self.turns, 'stages': stages, 'counters': counters}
+
+    def to_prometheus(self, prefix: str = 'voice_chat') -> str:
+        lines: List[str] = []
+        for stage, histogram in self.histograms.items():
+            name = f'{prefix}_{stage}'
+            snapshot = histogram.snapshot()
+            lines.append(f'# HELP {name} {STAGES.get(stage, stage)}')
+            lines.append(f'# TYPE {name} histogram')
+            for bound, count in zip(snapshot['buckets'] + ['+Inf'], snapshot['cumulative']):
+                lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f'{name}_sum {snapshot["sum"]}')
+            lines.append(f'{name}_count {snapshot["count"]}')
+        with self._counter_lock:
+            counters = dict(self.counters)
+        for counter, value in counters.items():
+            name = f'{prefix}_{counter}'
+            lines.append(f'# HELP {name} {COUNTERS.get(counter, counter)}')
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host: str = '0.0.0.0', port: int = 9090) -> None:
+        '''
+            Serve /metrics in the Prometheus text format and /metrics.json on a daemon thread
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.to_prometheus().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.to_json()).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        self.logger.info('serving metrics on %s:%s', host, port)
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,198 @@
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Type
+from dataclasses import dataclass, field
+from collections import deque, Counter
+from .logger import Logger
+import numpy as np
+import threading
+import inspect
+import asyncio
+import time
+import re
+
+SMALL = 'small'
+LARGE = 'large'
+
+DEFAULT_COMPLEX_KEYWORDS = (
+    'explain', 'why', 'how does', 'how do', 'compare', 'difference between', 'plan', 'step by step', 'analyze',
+    'summarize', 'write', 'code', 'calculate', 'pros and cons'
+)
+
+@dataclass
+class RouteDecision:
+    '''
+        Model picked for one turn and why
+
+        reason is keyword, classifier, short or long for the choice by features, slo when the large model was
+        replaced because its recent time to first token is over the latency objective, and default without a small model.
+    '''
+    model: str
+    size: str
+    reason: str
+    words: int
+    history_tokens: int
+    score: Optional[float] = None
+    time: float = field(default_factory=time.time)
+
+class EmbeddingClassifier:
+    def __init__(self, embed: Callable[[List[str]], Any], simple_examples: Sequence[str], complex_examples: Sequence[str]) -> None:
+        '''
+            Scores how complex a prompt is by its similarity to example prompts
+
+            embed returns one vector per text, or an awaitable of them. The score is the cosine similarity to the mean of
+            complex_examples minus the one to the mean of simple_examples, above zero reads as complex. Examples are
+            embedded on first use.
+        '''
+        self.embed: Callable[[List[str]], Any] = embed
+        self.simple_examples: List[str] = list(simple_examples)
+        self.complex_examples: List[str] = list(complex_examples)
+        self._centroids: Optional[np.ndarray] = None
+        self._lock = asyncio.Lock()
+
+    async def _vectors(self, texts: List[str]) -> Optional[np.ndarray]:
+        vectors = self.embed(texts)
+        if inspect.isawaitable(vectors):
+            vectors = await vectors
+        if vectors is None or len(vectors) != len(texts):
+            return None
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    async def score(self, text: str) -> Optional[float]:
+        '''
+            Complexity score of text, None if it could not be embedded
+        '''
+        async with self._lock:
+            if self._centroids is None:
+                examples = await self._vectors(self.simple_examples + self.complex_examples)
+                if examples is None:
+                    return None
+                simple = examples[:len(self.simple_examples)].mean(axis=0)
+                complex_ = examples[len(self.simple_examples):].mean(axis=0)
+                centroids = np.stack([simple, complex_])
+                self._centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+        vector = await self._vectors([text])
+        if vector is None:
+            return None
+        simple_similarity, complex_similarity = self._centroids @ vector[0]
+        return float(complex_similarity - simple_similarity)
+
+class ModelRouter:
+    def __init__(
+        self,
+        large_model: str,
+        small_model: Optional[str] = None,
+        short_words: int = 12,
+        short_history_tokens: int = 1024,
+        complex_keywords: Optional[Sequence[str]] = None,
+        classifier: Optional[EmbeddingClassifier] = None,
+        latency_slo: Optional[float] = None,
+        slo_quantile: float = 0.9,
+        latency_window: float = 60.0,
+        min_samples: int = 3,
+        history: int = 1000,
+        logger: Type[Logger] = Logger
+    ) -> None:
+        '''
+            Picks the small or the large model for every turn from cheap features of the prompt
+
+            A prompt with one of complex_keywords (DEFAULT_COMPLEX_KEYWORDS if None) goes to the large model. Otherwise
+            the classifier decides if there is one, and without it prompts of at most short_words words in a
+            conversation of at most short_history_tokens go to the small model. When the slo_quantile of the large model's time to first token over the last
+            latency_window seconds (with at least min_samples streams) exceeds latency_slo, its turns go to the small
+            model until slow samples age out of the window. Time to first token is fed in with observe.
+        '''
+        self.large_model: str = large_model
+        self.small_model: Optional[str] = small_model
+        self.short_words: int = short_words
+        self.short_history_tokens: int = short_history_tokens
+        self.classifier: Optional[EmbeddingClassifier] = classifier
+        self.latency_slo: Optional[float] = latency_slo
+        self.slo_quantile: float = slo_quantile
+        self.latency_window: float = latency_window
+        self.min_samples: int = min_samples
+        keywords = [keyword.strip().lower() for keyword in (DEFAULT_COMPLEX_KEYWORDS if complex_keywords is None else complex_keywords)]
+        keywords = [keyword for keyword in keywords if keyword]
+        self._keywords: Optional[re.Pattern] = re.compile(
+            r'\b(' + '|'.join(re.escape(keyword) for keyword in keywords) + r')\b'
+        ) if keywords else None
+        self.decisions: Deque[RouteDecision] = deque(maxlen=history)
+        self.counts: Counter = Counter()
+        self._latencies: Dict[str, Deque[Tuple[float, float]]] = {}
+        self._lock = threading.Lock()
+        self.logger = logger(name='model_router').get_logger()
+
+    def observe(self, model_name: str, time_to_first_token: Optional[float]) -> None:
+        '''
+            Record the time to first token of a stream of model_name
+        '''
+        if time_to_first_token is None:
+            return
+        with self._lock:
+            self._latencies.setdefault(model_name, deque(maxlen=1000)).append((time.monotonic(), time_to_first_token))
+
+    def latency(self, model_name: str, quantile: Optional[float] = None) -> Optional[float]:
+        '''
+            quantile (default slo_quantile) of the time to first token of model_name within the latency window,
+            None with fewer than min_samples streams
+        '''
+        cutoff = time.monotonic() - self.latency_window
+        with self._lock:
+            samples = self._latencies.get(model_name)
+            if samples is None:
+                return None
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+            values = sorted(value for _, value in samples)
+        if len(values) < self.min_samples:
+            return None
+        return values[min(int(len(values) * (self.slo_quantile if quantile is None else quantile)), len(values) - 1)]
+
+    def over_slo(self) -> bool:
+        if not self.latency_slo:
+            return False
+        latency = self.latency(self.large_model)
+        return latency is not None and latency > self.latency_slo
+
+    async def route(self, text: str, history_tokens: int = 0) -> RouteDecision:
+        '''
+            Pick the model for a turn with prompt text in a conversation of history_tokens estimated tokens
+        '''
+        words = len(text.split())
+        score = None
+        if not self.small_model:
+            size, reason = LARGE, 'default'
+        elif self._keywords is not None and self._keywords.search(text.lower()):
+            size, reason = LARGE, 'keyword'
+        else:
+            if self.classifier is not None:
+                score = await self.classifier.score(text)
+            if score is not None:
+                size, reason = (LARGE if score > 0 else SMALL), 'classifier'
+            elif words <= self.short_words and history_tokens <= self.short_history_tokens:
+                size, reason = SMALL, 'short'
+            else:
+                size, reason = LARGE, 'long'
+        if size == LARGE and self.small_model and self.over_slo():
+            size, reason = SMALL, 'slo'
+        decision = RouteDecision(
+            self.small_model if size == SMALL else self.large_model, size, reason, words, history_tokens, score
+        )
+        with self._lock:
+            self.decisions.append(decision)
+            self.counts[(decision.size, decision.reason)] += 1
+        self.logger.info('routed turn of %s words to %s model %s (%s)', words, size, decision.model, reason)
+        return decision
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {f'{size}:{reason}': count for (size, reason), count in self.counts.items()}
+        return {
+            'decisions': counts,
+            'large_share': sum(count for key, count in counts.items() if key.startswith(LARGE)) / sum(counts.values()) if counts else None,
+            'time_to_first_token': {
+                model_name: {'p50': self.latency(model_name, 0.5), 'p90': self.latency(model_name, 0.9)}
+                for model_name in filter(None, (self.small_model, self.large_model))
+            },
+            'over_slo': self.over_slo(),
+        }
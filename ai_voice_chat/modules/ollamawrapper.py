@@ -1,112 +1,403 @@
-from typing import Type, List, AsyncGenerator, Optional
-from ollama import Client
+from typing import Type, List, AsyncGenerator, Optional, Callable, TypeVar, Iterator, Any, Deque, Union
+from dataclasses import dataclass
+from collections import deque
+from ollama import Client, ResponseError
 from .logger import Logger
+from .streambridge import iterate_batches_in_thread
+from .endpointpool import EndpointPool, Endpoint
+from .residency import ModelResidency
+from .pullmanager import PullManager, PullTask
+from .responsecache import ResponseCache, context_key
 import time
 import asyncio
+import threading
 import concurrent.futures
 
 _executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
+T = TypeVar('T')
+
+def _is_model_not_found(error: Exception) -> bool:
+    '''
+        Check if an ollama error means the requested model is not on the server
+    '''
+    if not isinstance(error, ResponseError):
+        return False
+    return error.status_code == 404 or 'not found' in str(error.error).lower()
+
+@dataclass
+class StreamStats:
+    '''
+        Timings of a single streamed completion, times are in seconds
+    '''
+    model: str
+    endpoint: Optional[str] = None
+    time_to_first_token: Optional[float] = None
+    duration: float = 0.0
+    chunks: int = 0
+    characters: int = 0
+    eval_count: Optional[int] = None
+    eval_duration: Optional[float] = None
+    prompt_eval_count: Optional[int] = None
+    prompt_eval_duration: Optional[float] = None
+    load_duration: Optional[float] = None
+    completed: bool = False
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        '''
+            Decode rate reported by the server, or the client side chunk rate if the stream ended early
+        '''
+        if self.eval_count and self.eval_duration:
+            return self.eval_count / self.eval_duration
+        if self.time_to_first_token is None or self.chunks < 2:
+            return None
+        decode_time = self.duration - self.time_to_first_token
+        return (self.chunks - 1) / decode_time if decode_time > 0 else None
+
 class OllamaWrapper:
-    def __init__(self, ollama_endpoint: str, client: Type[Client], logger: Type[Logger]) -> None:
+    def __init__(
+        self,
+        ollama_endpoint: Union[str, List[str]],
+        client: Type[Client],
+        logger: Type[Logger],
+        model_cache_ttl: float = 30.0,
+        stream_coalesce_window: float = 0.0,
+        stream_coalesce_tokens: Optional[int] = None,
+        health_interval: float = 10.0,
+        memory_budget: Optional[int] = None,
+        memory_kind: str = 'vram',
+        residency_interval: float = 30.0,
+        pull_timeout: float = 600.0,
+        response_cache: Optional[ResponseCache] = None
+    ) -> None:
         '''
         This class assumes a running ollama server that follows the standard ollama api documentation: https://github.com/ollama/ollama/blob/main/docs/api.md
+
+        ollama_endpoint is one endpoint or a list of them, requests are spread across a list with an EndpointPool
+        model_cache_ttl is the number of seconds the downloaded model list is trusted before /api/tags is queried again
+        stream_coalesce_window and stream_coalesce_tokens are the default token coalescing of generate_completion_stream
+        health_interval is the number of seconds between health checks of the endpoints
+        memory_budget, memory_kind and residency_interval configure which models stay loaded, see ModelResidency
+        pull_timeout is the number of seconds a model pull may take, see PullManager
+        response_cache answers prompts similar to earlier ones without the model, it can also be set later
         '''
-        self.ollama_endpoint: str = ollama_endpoint
-        self.client: Client = client(host=ollama_endpoint)
+        endpoints = [ollama_endpoint] if isinstance(ollama_endpoint, str) else list(ollama_endpoint)
         self.logger = logger(name='ollama_wrapper').get_logger()
         self.logger.info('initializing ollama client')
+        self.pool: EndpointPool = EndpointPool(endpoints, client, logger, health_interval=health_interval)
+        self.ollama_endpoint: str = endpoints[0]
+        self.client: Client = self.pool.endpoints[0].client
+        self.residency: ModelResidency = ModelResidency(
+            self.pool, logger, memory_budget=memory_budget, memory_kind=memory_kind, check_interval=residency_interval
+        )
+        self.pulls: PullManager = PullManager(logger=logger, timeout=pull_timeout)
+        self.response_cache: Optional[ResponseCache] = response_cache
+
+        self.model_cache_ttl: float = model_cache_ttl
+        self._model_cache: List[str] = []
+        self._model_cache_time: Optional[float] = None
+        self._model_cache_lock = threading.Lock()
+        self.model_cache_hits: int = 0
+        self.model_cache_misses: int = 0
 
-    def list_models(self) -> List[str]:
+        self.stream_coalesce_window: float = stream_coalesce_window
+        self.stream_coalesce_tokens: Optional[int] = stream_coalesce_tokens
+        self.recent_streams: Deque[StreamStats] = deque(maxlen=100)
+        self._stream_listeners: List[Callable[[StreamStats], None]] = []
+
+    def list_models(self, refresh: bool = False) -> List[str]:
         '''
-            List available models
+            List available models, served from the model cache while it is fresh
         '''
+        with self._model_cache_lock:
+            if not refresh and self._model_cache_fresh():
+                self.model_cache_hits += 1
+                return list(self._model_cache)
+            self.model_cache_misses += 1
         try:
             output: List[str] = []
-            data = self.client.list()
-            for model in data.models:
-                output.append(model['model'])
+            errors: List[Exception] = []
+            for endpoint in self.pool.endpoints:
+                try:
+                    data = endpoint.client.list()
+                except Exception as e:
+                    self.pool.mark_unhealthy(endpoint, e)
+                    errors.append(e)
+                    continue
+                endpoint.models = {model['model'] for model in data.models}
+                output.extend(model for model in endpoint.models if model not in output)
+            if len(errors) == len(self.pool.endpoints):
+                raise errors[0]
+            with self._model_cache_lock:
+                self._model_cache = output
+                self._model_cache_time = time.monotonic()
             self.logger.info('listed running models')
-            return output
+            return list(output)
         except Exception as e:
             self.logger.error('error listing running models \n %s ', e)
             return []
 
+    def _model_cache_fresh(self) -> bool:
+        '''
+            Check if the cached model list is still within its ttl
+        '''
+        if self._model_cache_time is None:
+            return False
+        return time.monotonic() - self._model_cache_time < self.model_cache_ttl
+
+    def invalidate_model_cache(self) -> None:
+        '''
+            Drop the cached model list so the next lookup queries the server
+        '''
+        with self._model_cache_lock:
+            self._model_cache_time = None
+        self.logger.info('invalidated model cache')
+
+    def model_cache_stats(self) -> dict:
+        '''
+            Model cache hit and miss counters
+        '''
+        with self._model_cache_lock:
+            return {
+                'hits': self.model_cache_hits,
+                'misses': self.model_cache_misses,
+                'cached_models': len(self._model_cache),
+                'fresh': self._model_cache_fresh(),
+            }
+
+    def has_model(self, model_name: str) -> bool:
+        '''
+            Check if model is downloaded, refreshing a stale negative answer once
+        '''
+        with self._model_cache_lock:
+            from_cache = self._model_cache_fresh()
+        if model_name in self.list_models():
+            return True
+        if not from_cache:
+            # the list was just fetched from the server
+            return False
+        return model_name in self.list_models(refresh=True)
+
+    async def _has_model_async(self, model_name: str) -> bool:
+        '''
+            Async version of has_model, only leaves the event loop when the cache must be refreshed
+        '''
+        with self._model_cache_lock:
+            if self._model_cache_fresh() and model_name in self._model_cache:
+                self.model_cache_hits += 1
+                return True
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(_executor, self.has_model, model_name)
+
+    def _with_model_retry(self, model_name: str, call: Callable[[], T]) -> T:
+        '''
+            Run an ollama call, refreshing the model cache and retrying once if the server reports the model missing
+        '''
+        try:
+            return call()
+        except Exception as e:
+            if not _is_model_not_found(e):
+                raise
+            self.logger.info('model %s not found on server, refreshing model cache', model_name)
+            if model_name not in self.list_models(refresh=True):
+                raise
+            return call()
+
+    def _call(self, model_name: str, call: Callable[[Client], T], session_id: Optional[str] = None) -> T:
+        '''
+            Run an ollama call on the endpoint picked by the pool, with model retry and failover
+        '''
+        def run(endpoint: Endpoint) -> T:
+            self.residency.touch(model_name, endpoint)
+            response = self._with_model_retry(model_name, lambda: call(endpoint.client))
+            self.residency.observe_response(model_name, endpoint, response)
+            return response
+
+        return self.pool.call(run, model_name=model_name, session_id=session_id)
+
+    def add_stream_listener(self, listener: Callable[[StreamStats], None]) -> None:
+        '''
+            Register a callback that receives the StreamStats of every finished stream
+        '''
+        self._stream_listeners.append(listener)
+
+    def _record_stream(self, stats: StreamStats) -> None:
+        self.recent_streams.append(stats)
+        for listener in self._stream_listeners:
+            try:
+                listener(stats)
+            except Exception as e:
+                self.logger.error('error in stream listener \n %s', e)
+
+    async def _stream(
+        self,
+        model_name: str,
+        request: Callable[[Client], Iterator[Any]],
+        text_of: Callable[[Any], str],
+        coalesce_window: Optional[float],
+        coalesce_tokens: Optional[int],
+        session_id: Optional[str] = None
+    ) -> AsyncGenerator[str, None]:
+        '''
+            Async generator: runs a streaming ollama request on its own producer thread and yields its text
+
+            Tokens that arrive within coalesce_window seconds of each other, up to coalesce_tokens of them, are yielded as one string.
+        '''
+        window = self.stream_coalesce_window if coalesce_window is None else coalesce_window
+        max_tokens = self.stream_coalesce_tokens if coalesce_tokens is None else coalesce_tokens
+        stats = StreamStats(model=model_name)
+        start = time.perf_counter()
+
+        def stream_sync():
+            yield from self.pool.stream(open_stream, model_name=model_name, session_id=session_id)
+
+        def open_stream(endpoint: Endpoint):
+            # The request is only sent on the first next(), so a missing model or an unreachable server surfaces here
+            def first():
+                stream = iter(request(endpoint.client))
+                return stream, next(stream, None)
+
+            self.residency.touch(model_name, endpoint)
+            stats.endpoint = endpoint.url
+            stream, response = self._with_model_retry(model_name, first)
+            return read_stream(endpoint, stream, response)
+
+        def read_stream(endpoint, stream, response):
+            try:
+                yield from read_responses(endpoint, stream, response)
+            finally:
+                # closes the http response, the server stops decoding once the client is gone
+                close = getattr(stream, 'close', None)
+                if close is not None:
+                    close()
+
+        def read_responses(endpoint, stream, response):
+            while response is not None:
+                if getattr(response, 'done', False):
+                    stats.eval_count = getattr(response, 'eval_count', None)
+                    eval_duration = getattr(response, 'eval_duration', None)
+                    stats.eval_duration = eval_duration / 1e9 if eval_duration else None
+                    stats.prompt_eval_count = getattr(response, 'prompt_eval_count', None)
+                    prompt_eval_duration = getattr(response, 'prompt_eval_duration', None)
+                    stats.prompt_eval_duration = prompt_eval_duration / 1e9 if prompt_eval_duration else None
+                    load_duration = getattr(response, 'load_duration', None)
+                    stats.load_duration = load_duration / 1e9 if load_duration else None
+                    self.residency.observe_response(model_name, endpoint, response)
+                text = text_of(response)
+                if text:
+                    yield text
+                response = next(stream, None)
+
+        try:
+            async for batch in iterate_batches_in_thread(stream_sync, window=window, max_items=max_tokens):
+                if stats.time_to_first_token is None:
+                    stats.time_to_first_token = time.perf_counter() - start
+                text = ''.join(batch)
+                stats.chunks += len(batch)
+                stats.characters += len(text)
+                yield text
+            stats.completed = True
+        finally:
+            stats.duration = time.perf_counter() - start
+            self._record_stream(stats)
+
     def is_active_model(self, model_name: str) -> bool:
         '''
             Check if model is active
         '''
         self.logger.info('checking active model')
-        return model_name in self.list_models()
-        
+        return self.has_model(model_name)
+
+    def start_pull(self, model_name: str) -> List[PullTask]:
+        '''
+            Start pulling model onto every endpoint that does not have it, returns right away with the running pulls
+        '''
+        self.list_models(refresh=True)
+        missing = [endpoint for endpoint in self.pool.endpoints if model_name not in endpoint.models]
+        if not missing:
+            self.logger.info('model %s already downloaded', model_name)
+            return []
+        tasks = [self.pulls.pull(endpoint.url, model_name) for endpoint in missing]
+        for task in tasks:
+            task.add_done_callback(lambda _: self.invalidate_model_cache())
+        return tasks
+
     def pull_model(self, model_name: str) -> bool:
         '''
-            Pull model from ollama registry
+            Pull model from ollama registry, blocking until every endpoint has it
         '''
         try:
-            if model_name in self.list_models():
-                self.logger.info('model %s already downloaded', model_name)
-                return True
-            
-            pulling_model = self.client.pull(model_name, stream=True)
-            self.logger.info('pulling model... \n %s', model_name)
-            start_time = time.time()
-            self.logger.info(next(pulling_model))
-            while True:
-                current_time = time.time()
-                next_digest = next(pulling_model)
-                if  next_digest['status'] == 'success':
-                    self.logger.info('pulled model %s', model_name)
-                    break  
-                elif next_digest['status'] == 'error':
-                    raise Exception('errored out while pulling model')
-                elif current_time - start_time >= 600:
-                    raise Exception('timeout of 10 minutes reached while pulling model')
-            return True
+            return all([task.result() for task in self.start_pull(model_name)])
+        except Exception as e:
+            self.logger.error('error pulling model %s \n %s', model_name, e)
+            self.invalidate_model_cache()
+            return False
+
+    async def pull_model_async(self, model_name: str) -> bool:
+        '''
+            Async version of pull_model
+        '''
+        loop = asyncio.get_event_loop()
+        try:
+            tasks = await loop.run_in_executor(_executor, self.start_pull, model_name)
+            return all(await asyncio.gather(*(task.wait() for task in tasks)))
         except Exception as e:
             self.logger.error('error pulling model %s \n %s', model_name, e)
+            self.invalidate_model_cache()
             return False
-        
+
     def delete_model(self, model_name: str) -> bool:
         '''
             Delete a downloaded model
         '''
         try:
-            if model_name not in self.list_models():
+            if not self.has_model(model_name):
                 self.logger.info('model %s not downloaded', model_name)
                 return False
-            delete_model_status  = self.client.delete(model_name)
-            while delete_model_status.status and delete_model_status.status != 'completed':
-                self.logger.info('deleting model: %s', model_name)
+            for endpoint in self.pool.endpoints:
+                if model_name not in endpoint.models:
+                    continue
+                delete_model_status = endpoint.client.delete(model_name)
+                self.logger.info('deleted model %s on %s: %s', model_name, endpoint.url, delete_model_status.status)
+            self.invalidate_model_cache()
             return True
         except Exception as e:
             self.logger.error('error deleting model %s \n %s', model_name, e)
+            self.invalidate_model_cache()
             return False
-        
+
     async def generate_embedding(self, model_name: str, input_list: list[str]) -> Optional[list[float]]:
         '''
         Async version: Generates an embedding with a downloaded model.
         '''
-        if model_name not in self.list_models():
+        if not await self._has_model_async(model_name):
             self.logger.info('model %s not downloaded', model_name)
             return None
         loop = asyncio.get_event_loop()
         try:
             embeddings = await loop.run_in_executor(
                 _executor,
-                lambda: self.client.embed(model_name, input_list)
+                lambda: self._call(model_name, lambda client: client.embed(model_name, input_list, keep_alive=self.residency.keep_alive(model_name)))
             )
             self.logger.info('generated embedding with model %s', model_name)
             return embeddings['embeddings']
         except Exception as e:
             self.logger.error('error generating embedding for model %s \n %s', model_name, e)
             return None
-        
-    async def generate_completion(self, model_name: str, prompt: str) -> Optional[str]:
+
+    async def generate_completion(self, model_name: str, prompt: str, cache: bool = True) -> Optional[str]:
         '''
         Async version: Generates completion with downloaded model.
+
+        A response cached for a similar prompt is returned instead when cache is True and a response cache is set.
         '''
-        if model_name not in self.list_models():
+        response_cache = self.response_cache if cache else None
+        if response_cache is not None:
+            entry = await response_cache.lookup(prompt, context_key(model_name))
+            if entry is not None:
+                return entry.value
+        if not await self._has_model_async(model_name):
             self.logger.info('model %s not downloaded', model_name)
             return None
         loop = asyncio.get_event_loop()
@@ -114,52 +405,163 @@ class OllamaWrapper:
             # If streaming isn't needed, you can call the synchronous API in a thread.
             response = await loop.run_in_executor(
                 _executor,
-                lambda: self.client.generate(model_name, prompt)
+                lambda: self._call(model_name, lambda client: client.generate(model_name, prompt, keep_alive=self.residency.keep_alive(model_name)))
             )
             self.logger.info('generated completion with model %s \n %s', model_name, response)
+            if response_cache is not None and response.response:
+                await response_cache.store(prompt, response.response, context_key(model_name))
             return response.response
         except Exception as e:
             self.logger.error('error generating completion for model %s \n %s', model_name, e)
             return None
 
-    async def generate_completion_stream(self, model_name: str, prompt: str) -> AsyncGenerator[str, None]:
+    async def generate_completion_stream(
+        self,
+        model_name: str,
+        prompt: str,
+        coalesce_window: Optional[float] = None,
+        coalesce_tokens: Optional[int] = None,
+        cache: bool = True
+    ) -> AsyncGenerator[str, None]:
         '''
         Async generator: streams response tokens as soon as Ollama generates them.
+
+        Each stream gets its own producer thread instead of one executor round trip per token.
+        Timings of the stream are recorded as StreamStats, see add_stream_listener.
+        A response cached for a similar prompt is replayed instead when cache is True and a response cache is set.
+        '''
+        async for chunk in self._cached_stream(
+            model_name,
+            prompt,
+            context_key(model_name),
+            lambda: self._stream(
+                model_name,
+                lambda client: client.generate(model_name, prompt, stream=True, keep_alive=self.residency.keep_alive(model_name)),
+                lambda response: response.response,
+                coalesce_window,
+                coalesce_tokens
+            ),
+            'completion',
+            cache
+        ):
+            yield chunk
+
+    async def _cached_stream(
+        self,
+        model_name: str,
+        prompt: str,
+        context: str,
+        open_stream: Callable[[], AsyncGenerator[str, None]],
+        kind: str,
+        cache: bool,
+        session_id: Optional[str] = None
+    ) -> AsyncGenerator[str, None]:
+        '''
+            Async generator: replays the cached response of a similar prompt, or streams from the model and caches
+            the response once it is complete
         '''
-        if model_name not in self.list_models():
+        response_cache = self.response_cache if cache else None
+        if response_cache is None and self.response_cache is not None and session_id is not None:
+            self.response_cache.forget(session_id)
+        if response_cache is not None:
+            entry = await response_cache.lookup(prompt, context, session_id=session_id)
+            if entry is not None:
+                async for chunk in response_cache.replay(entry.value):
+                    yield chunk
+                return
+        if not await self._has_model_async(model_name):
             self.logger.info('model %s not downloaded', model_name)
             return
-        loop = asyncio.get_event_loop()
+        chunks: List[str] = []
         try:
-            def stream_sync():
-                # This yields objects with .response (string chunk)
-                for response in self.client.generate(model_name, prompt, stream=True):
-                    yield response.response
-
-            # Stream results in an executor
-            iterator = stream_sync()
-            while True:
-                # Get next token in executor:
-                chunk = await loop.run_in_executor(_executor, lambda: next(iterator, None))
-                if chunk is None:
-                    break
+            async for chunk in open_stream():
+                chunks.append(chunk)
                 yield chunk
         except Exception as e:
-            self.logger.error('error generating (stream) completion for model %s \n %s', model_name, e)
+            self.logger.error('error generating (stream) %s for model %s \n %s', kind, model_name, e)
             return
+        text = ''.join(chunks)
+        if response_cache is not None and text.strip():
+            await response_cache.store(prompt, text, context, session_id=session_id)
+
+    async def generate_chat(self, model_name: str, messages: List[dict], cache: bool = True) -> Optional[str]:
+        '''
+        Async version: Generates a chat reply with downloaded model.
+
+        messages are dicts with role ('system', 'user' or 'assistant') and content.
+        A reply cached for a similar last message after the same earlier messages is returned instead when cache is True
+        and a response cache is set.
+        '''
+        response_cache = self.response_cache if cache else None
+        context = context_key(model_name, messages[:-1])
+        if response_cache is not None:
+            entry = await response_cache.lookup(messages[-1]['content'], context)
+            if entry is not None:
+                return entry.value
+        if not await self._has_model_async(model_name):
+            self.logger.info('model %s not downloaded', model_name)
+            return None
+        loop = asyncio.get_event_loop()
+        try:
+            response = await loop.run_in_executor(
+                _executor,
+                lambda: self._call(model_name, lambda client: client.chat(model_name, messages=messages, keep_alive=self.residency.keep_alive(model_name)))
+            )
+            self.logger.info('generated chat reply with model %s', model_name)
+            if response_cache is not None and response.message.content:
+                await response_cache.store(messages[-1]['content'], response.message.content, context)
+            return response.message.content
+        except Exception as e:
+            self.logger.error('error generating chat reply for model %s \n %s', model_name, e)
+            return None
+
+    async def generate_chat_stream(
+        self,
+        model_name: str,
+        messages: List[dict],
+        coalesce_window: Optional[float] = None,
+        coalesce_tokens: Optional[int] = None,
+        session_id: Optional[str] = None,
+        cache: bool = True
+    ) -> AsyncGenerator[str, None]:
+        '''
+        Async generator: streams chat reply tokens as soon as Ollama generates them.
+
+        Sending the same leading messages on every turn lets the server reuse its KV cache for that prefix,
+        requests with the same session_id are sent to the same endpoint for the same reason.
+        A reply cached for a similar last message after the same earlier messages is replayed instead when cache is True
+        and a response cache is set, ResponseCache.recent tells whether the reply of session_id came from the cache.
+        '''
+        async for chunk in self._cached_stream(
+            model_name,
+            messages[-1]['content'],
+            context_key(model_name, messages[:-1]),
+            lambda: self._stream(
+                model_name,
+                lambda client: client.chat(model_name, messages=messages, stream=True, keep_alive=self.residency.keep_alive(model_name)),
+                lambda response: response.message.content,
+                coalesce_window,
+                coalesce_tokens,
+                session_id=session_id
+            ),
+            'chat reply',
+            cache,
+            session_id=session_id
+        ):
+            yield chunk
 
     async def configure_system(self, model_name: str, system_prompt: str) -> Optional[str]:
         '''
             Set system prompt for given model
         '''
-        if model_name not in self.list_models():
+        if not await self._has_model_async(model_name):
             self.logger.info('model %s not downloaded', model_name)
             return None
         loop = asyncio.get_event_loop()
         try:
             response = await loop.run_in_executor(
                 _executor,
-                lambda: self.client.generate(model=model_name, system=system_prompt)
+                lambda: self._call(model_name, lambda client: client.generate(model=model_name, system=system_prompt, keep_alive=self.residency.keep_alive(model_name)))
             )
             self.logger.info('configured system prompt for model %s', model_name)
             return response.response
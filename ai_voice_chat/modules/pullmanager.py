@@ -0,0 +1,260 @@
+from typing import Callable, Dict, List, Optional, Tuple, Type
+from dataclasses import dataclass, field
+from ollama import AsyncClient, ResponseError
+from .logger import Logger
+import concurrent.futures
+import threading
+import asyncio
+import time
+
+QUEUED = 'queued'
+PULLING = 'pulling'
+SUCCESS = 'success'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+class PullStalled(Exception):
+    pass
+
+@dataclass
+class PullProgress:
+    '''
+        Progress of one model pull on one ollama server, sizes are in bytes
+    '''
+    model: str
+    host: str
+    status: str = QUEUED
+    completed: int = 0
+    total: int = 0
+    digest: Optional[str] = None
+    bytes_per_second: Optional[float] = None
+    attempts: int = 0
+    error: Optional[str] = None
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    layers: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+
+    @property
+    def fraction(self) -> Optional[float]:
+        return self.completed / self.total if self.total else None
+
+    def to_dict(self) -> dict:
+        return {
+            'model': self.model,
+            'host': self.host,
+            'status': self.status,
+            'completed': self.completed,
+            'total': self.total,
+            'fraction': self.fraction,
+            'digest': self.digest,
+            'bytes_per_second': self.bytes_per_second,
+            'attempts': self.attempts,
+            'error': self.error,
+            'seconds': (self.finished or time.monotonic()) - self.started if self.started else None,
+        }
+
+class PullTask:
+    def __init__(self, progress: PullProgress, future: concurrent.futures.Future) -> None:
+        '''
+            A running pull, result() blocks and wait() can be awaited on any event loop, both return True once the model is pulled
+        '''
+        self.progress: PullProgress = progress
+        self._future: concurrent.futures.Future = future
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self, timeout: Optional[float] = None) -> bool:
+        try:
+            return self._future.result(timeout)
+        except concurrent.futures.CancelledError:
+            return False
+
+    async def wait(self) -> bool:
+        try:
+            return await asyncio.wrap_future(self._future)
+        except asyncio.CancelledError:
+            if self._future.cancelled():
+                return False
+            raise
+
+    def cancel(self) -> bool:
+        return self._future.cancel()
+
+    def add_done_callback(self, callback: Callable[['PullTask'], None]) -> None:
+        self._future.add_done_callback(lambda _: callback(self))
+
+class PullManager:
+    def __init__(
+        self,
+        client: Type[AsyncClient] = AsyncClient,
+        logger: Type[Logger] = Logger,
+        timeout: float = 600.0,
+        stall_timeout: float = 60.0,
+        retries: int = 3,
+        retry_backoff: float = 2.0,
+        progress_interval: float = 5.0,
+        max_concurrent: int = 2
+    ) -> None:
+        '''
+            Pulls models on a background event loop so callers do not block while a model downloads
+
+            Every pull has a wall clock timeout, one without progress for stall_timeout seconds is restarted. Interrupted pulls
+            are retried up to retries times with exponential backoff, ollama resumes the layers it already downloaded.
+            Progress (bytes, current layer digest and throughput) is logged every progress_interval seconds and passed to
+            progress listeners. At most max_concurrent pulls download at once, a pull of a model that is already being
+            pulled from the same server returns the running task.
+        '''
+        self.client: Type[AsyncClient] = client
+        self.timeout: float = timeout
+        self.stall_timeout: float = stall_timeout
+        self.retries: int = retries
+        self.retry_backoff: float = retry_backoff
+        self.progress_interval: float = progress_interval
+        self.max_concurrent: int = max_concurrent
+        self.tasks: Dict[Tuple[str, str], PullTask] = {}
+        self._clients: Dict[str, AsyncClient] = {}
+        self._progress_listeners: List[Callable[[PullProgress], None]] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self.logger = logger(name='pull_manager').get_logger()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='model-pulls', daemon=True).start()
+            return self._loop
+
+    def add_progress_listener(self, listener: Callable[[PullProgress], None]) -> None:
+        '''
+            Register a callback that receives the progress of every pull, on the pull thread
+        '''
+        self._progress_listeners.append(listener)
+
+    def pull(self, host: str, model_name: str) -> PullTask:
+        '''
+            Start pulling model_name onto the ollama server at host, returns right away
+        '''
+        loop = self._ensure_loop()
+        with self._lock:
+            task = self.tasks.get((host, model_name))
+            if task is not None and not task.done():
+                return task
+            progress = PullProgress(model=model_name, host=host)
+            task = PullTask(progress, asyncio.run_coroutine_threadsafe(self._run(progress), loop))
+            self.tasks[(host, model_name)] = task
+        return task
+
+    def stop(self) -> None:
+        '''
+            Cancel running pulls and stop the pull thread
+        '''
+        with self._lock:
+            tasks, loop, self._loop = list(self.tasks.values()), self._loop, None
+            # both belong to the stopped loop
+            self._semaphore, self._clients = None, {}
+        for task in tasks:
+            task.cancel()
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+
+    def progress(self) -> List[dict]:
+        with self._lock:
+            return [task.progress.to_dict() for task in self.tasks.values()]
+
+    def _notify(self, progress: PullProgress) -> None:
+        for listener in self._progress_listeners:
+            try:
+                listener(progress)
+            except Exception as e:
+                self.logger.error('error in pull progress listener \n %s', e)
+
+    async def _run(self, progress: PullProgress) -> bool:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        try:
+            async with self._semaphore:
+                progress.status = PULLING
+                progress.started = time.monotonic()
+                self.logger.info('pulling model %s on %s', progress.model, progress.host)
+                await asyncio.wait_for(self._pull_with_retries(progress), self.timeout)
+            progress.status = SUCCESS
+            seconds = time.monotonic() - progress.started
+            if progress.completed:
+                progress.bytes_per_second = progress.completed / seconds
+            self.logger.info('pulled model %s on %s, %s MB in %.1fs', progress.model, progress.host, progress.completed // 1_000_000, seconds)
+            return True
+        except asyncio.CancelledError:
+            progress.status = CANCELLED
+            self.logger.info('cancelled pull of model %s on %s', progress.model, progress.host)
+            raise
+        except asyncio.TimeoutError:
+            progress.status = FAILED
+            progress.error = f'timeout of {self.timeout} seconds reached'
+            self.logger.error('error pulling model %s on %s \n %s', progress.model, progress.host, progress.error)
+            return False
+        except Exception as e:
+            progress.status = FAILED
+            progress.error = str(e)
+            self.logger.error('error pulling model %s on %s \n %s', progress.model, progress.host, e)
+            return False
+        finally:
+            progress.finished = time.monotonic()
+            self._notify(progress)
+
+    async def _pull_with_retries(self, progress: PullProgress) -> None:
+        attempt = 0
+        while True:
+            attempt += 1
+            progress.attempts = attempt
+            try:
+                await self._pull_once(progress)
+                return
+            except Exception as e:
+                # a model that is not in the registry will not appear by trying again
+                if attempt > self.retries or (isinstance(e, ResponseError) and 400 <= e.status_code < 500):
+                    raise
+                delay = self.retry_backoff ** (attempt - 1)
+                self.logger.warning(
+                    'pull of model %s on %s interrupted at %s of %s bytes, resuming in %.0fs \n %s',
+                    progress.model, progress.host, progress.completed, progress.total, delay, e
+                )
+                await asyncio.sleep(delay)
+
+    async def _pull_once(self, progress: PullProgress) -> None:
+        client = self._clients.get(progress.host)
+        if client is None:
+            client = self._clients[progress.host] = self.client(host=progress.host)
+        updates = (await client.pull(progress.model, stream=True)).__aiter__()
+        window_bytes, window_start = progress.completed, time.monotonic()
+        try:
+            while True:
+                try:
+                    update = await asyncio.wait_for(updates.__anext__(), self.stall_timeout)
+                except StopAsyncIteration:
+                    raise Exception('pull ended without success')
+                except asyncio.TimeoutError:
+                    raise PullStalled(f'no progress for {self.stall_timeout} seconds')
+                if update.status == SUCCESS:
+                    return
+                if update.digest and update.total:
+                    progress.digest = update.digest
+                    progress.layers[update.digest] = (update.completed or 0, update.total)
+                    progress.completed = sum(completed for completed, _ in progress.layers.values())
+                    progress.total = sum(total for _, total in progress.layers.values())
+                now = time.monotonic()
+                if now - window_start >= self.progress_interval:
+                    progress.bytes_per_second = (progress.completed - window_bytes) / (now - window_start)
+                    window_bytes, window_start = progress.completed, now
+                    self.logger.info(
+                        'pulling model %s: %s of %s MB (%.0f%%) at %.1f MB/s, layer %s',
+                        progress.model, progress.completed // 1_000_000, progress.total // 1_000_000,
+                        (progress.fraction or 0.0) * 100, progress.bytes_per_second / 1_000_000, progress.digest
+                    )
+                    self._notify(progress)
+        finally:
+            aclose = getattr(updates, 'aclose', None)
+            if aclose is not None:
+                await aclose()
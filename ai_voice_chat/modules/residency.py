@@ -0,0 +1,288 @@
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Type, Union
+from dataclasses import dataclass, field
+from collections import deque
+from .endpointpool import EndpointPool, Endpoint, is_connection_error
+from .logger import Logger
+import threading
+import time
+
+KeepAlive = Union[float, str]
+
+def parse_keep_alive(value: Optional[str]) -> Optional[KeepAlive]:
+    '''
+        Keep alive from config, a number of seconds (negative keeps the model loaded) or an ollama duration like 30m
+    '''
+    if value is None or not value.strip():
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value.strip()
+
+def _tagged(model_name: str) -> str:
+    # ollama reports models with their tag
+    return model_name if ':' in model_name else f'{model_name}:latest'
+
+@dataclass
+class ResidencyEvent:
+    '''
+        A model was loaded into or unloaded from the memory of an endpoint, durations are in seconds
+
+        action is load, unload or expired (the server unloaded it), cause is preload, reload, request, budget or manual
+    '''
+    model: str
+    endpoint: str
+    action: str
+    cause: str
+    seconds: Optional[float] = None
+    size: Optional[int] = None
+    time: float = field(default_factory=time.time)
+
+@dataclass
+class ModelPolicy:
+    '''
+        Residency settings of one model, pinned models are kept loaded and never unloaded for the memory budget
+    '''
+    name: str
+    keep_alive: Optional[KeepAlive] = None
+    pinned: bool = False
+    embed: bool = False
+
+class ModelResidency:
+    def __init__(
+        self,
+        pool: EndpointPool,
+        logger: Type[Logger] = Logger,
+        memory_budget: Optional[int] = None,
+        memory_kind: str = 'vram',
+        check_interval: float = 30.0,
+        min_idle: float = 60.0,
+        cold_load_threshold: float = 0.5,
+        history: int = 1000
+    ) -> None:
+        '''
+            Decides which models stay loaded on the ollama servers
+
+            Models are preloaded with their keep_alive, which is also sent with every request so the server timer
+            matches the policy. A monitor thread checks /api/ps every check_interval seconds: pinned models that were
+            unloaded are loaded again, and when the loaded models of an endpoint use more than memory_budget bytes
+            (memory_kind vram or ram), unpinned models idle for min_idle seconds are unloaded least recently used first.
+            Requests whose server side load_duration exceeds cold_load_threshold seconds are recorded as cold loads.
+        '''
+        if memory_kind not in ('vram', 'ram'):
+            raise ValueError(f'unknown memory kind: {memory_kind}')
+        self.pool: EndpointPool = pool
+        self.memory_budget: Optional[int] = memory_budget
+        self.memory_kind: str = memory_kind
+        self.check_interval: float = check_interval
+        self.min_idle: float = min_idle
+        self.cold_load_threshold: float = cold_load_threshold
+        self.policies: Dict[str, ModelPolicy] = {}
+        self.events: Deque[ResidencyEvent] = deque(maxlen=history)
+        self.cold_loads: int = 0
+        self._resident: Dict[str, Dict[str, int]] = {}
+        self._last_used: Dict[Tuple[str, str], float] = {}
+        self._event_listeners: List[Callable[[ResidencyEvent], None]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.logger = logger(name='model_residency').get_logger()
+
+    def configure(self, model_name: str, keep_alive: Optional[KeepAlive] = None, pinned: bool = False, embed: bool = False) -> None:
+        '''
+            Set the residency policy of a model, embed marks embedding models which are loaded through /api/embed
+        '''
+        self.policies[_tagged(model_name)] = ModelPolicy(model_name, keep_alive=keep_alive, pinned=pinned, embed=embed)
+
+    def _policy(self, model_name: str) -> ModelPolicy:
+        return self.policies.get(_tagged(model_name)) or ModelPolicy(model_name)
+
+    def keep_alive(self, model_name: str) -> Optional[KeepAlive]:
+        '''
+            Keep alive to send with requests for model_name, None leaves the server default
+        '''
+        return self._policy(model_name).keep_alive
+
+    def add_event_listener(self, listener: Callable[[ResidencyEvent], None]) -> None:
+        '''
+            Register a callback that receives every load and unload event
+        '''
+        self._event_listeners.append(listener)
+
+    def _record(self, event: ResidencyEvent) -> None:
+        self.events.append(event)
+        self.logger.info(
+            'model %s %s on %s (%s) in %s seconds',
+            event.model, event.action, event.endpoint, event.cause,
+            f'{event.seconds:.3f}' if event.seconds is not None else '-'
+        )
+        for listener in self._event_listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                self.logger.error('error in residency event listener \n %s', e)
+
+    def touch(self, model_name: str, endpoint: Endpoint) -> None:
+        '''
+            Note a request for model_name on endpoint, idle time counts from the last request
+        '''
+        with self._lock:
+            self._last_used[(endpoint.url, _tagged(model_name))] = time.monotonic()
+            self._resident.setdefault(endpoint.url, {}).setdefault(_tagged(model_name), 0)
+
+    def observe_response(self, model_name: str, endpoint: Endpoint, response: Any) -> None:
+        '''
+            Record a cold load if the server had to load the model for this response
+        '''
+        load_duration = getattr(response, 'load_duration', None)
+        if not load_duration or load_duration / 1e9 < self.cold_load_threshold:
+            return
+        with self._lock:
+            self.cold_loads += 1
+        self._record(ResidencyEvent(_tagged(model_name), endpoint.url, 'load', 'request', seconds=load_duration / 1e9))
+
+    def preload(self, model_name: str, cause: str = 'preload') -> bool:
+        '''
+            Load model_name on every healthy endpoint with its keep_alive, on every endpoint when none is healthy
+
+            Returns False if any load failed or the model was not loaded anywhere.
+        '''
+        endpoints = [endpoint for endpoint in self.pool.endpoints if endpoint.healthy] or self.pool.endpoints
+        results = [self._load(model_name, endpoint, cause) for endpoint in endpoints]
+        return all(results) and any(results)
+
+    def _load(self, model_name: str, endpoint: Endpoint, cause: str) -> bool:
+        policy = self._policy(model_name)
+        start = time.perf_counter()
+        try:
+            with self.pool.lease(endpoint):
+                if policy.embed:
+                    # an embed request without input only loads the model
+                    response = endpoint.client.embed(model_name, input=[], keep_alive=policy.keep_alive)
+                else:
+                    # a generate request without prompt only loads the model
+                    response = endpoint.client.generate(model=model_name, keep_alive=policy.keep_alive)
+        except Exception as e:
+            self.logger.error('error loading model %s on %s \n %s', model_name, endpoint.url, e)
+            return False
+        self.pool.mark_healthy(endpoint)
+        seconds = time.perf_counter() - start
+        load_duration = getattr(response, 'load_duration', None)
+        with self._lock:
+            self._last_used[(endpoint.url, _tagged(model_name))] = time.monotonic()
+            self._resident.setdefault(endpoint.url, {}).setdefault(_tagged(model_name), 0)
+        self._record(ResidencyEvent(
+            _tagged(model_name), endpoint.url, 'load', cause,
+            seconds=load_duration / 1e9 if load_duration else seconds
+        ))
+        return True
+
+    def unload(self, model_name: str, endpoint: Endpoint, cause: str = 'manual') -> bool:
+        '''
+            Unload model_name from the memory of endpoint, the model stays downloaded
+        '''
+        policy = self._policy(model_name)
+        start = time.perf_counter()
+        try:
+            if policy.embed:
+                endpoint.client.embed(model_name, input=[], keep_alive=0)
+            else:
+                endpoint.client.generate(model=model_name, keep_alive=0)
+        except Exception as e:
+            self.logger.error('error unloading model %s on %s \n %s', model_name, endpoint.url, e)
+            return False
+        model_name = _tagged(model_name)
+        with self._lock:
+            size = self._resident.get(endpoint.url, {}).pop(model_name, None)
+        self._record(ResidencyEvent(model_name, endpoint.url, 'unload', cause, seconds=time.perf_counter() - start, size=size))
+        return True
+
+    def resident(self, endpoint: Endpoint) -> Dict[str, int]:
+        '''
+            Loaded models of endpoint from /api/ps with the memory they use, in bytes of memory_kind
+        '''
+        models = {}
+        for model in endpoint.health_client.ps().models:
+            size = model.size_vram if self.memory_kind == 'vram' else model.size
+            models[_tagged(model.model or model.name)] = int(size or 0)
+        return models
+
+    def check(self) -> None:
+        '''
+            Refresh the loaded models of every endpoint, reload unloaded pinned models and enforce the memory budget
+        '''
+        for endpoint in self.pool.endpoints:
+            # unhealthy endpoints are polled too, answering brings them back
+            try:
+                current = self.resident(endpoint)
+            except Exception as e:
+                if endpoint.healthy:
+                    self.logger.warning('unable to list loaded models of %s \n %s', endpoint.url, e)
+                if is_connection_error(e):
+                    self.pool.mark_unhealthy(endpoint, e)
+                continue
+            self.pool.mark_healthy(endpoint)
+            with self._lock:
+                previous = self._resident.get(endpoint.url, {})
+                self._resident[endpoint.url] = dict(current)
+            for model_name in previous.keys() - current.keys():
+                self._record(ResidencyEvent(model_name, endpoint.url, 'expired', 'server', size=previous[model_name] or None))
+            for model_name, policy in self.policies.items():
+                # endpoints that do not have the model downloaded are left alone
+                downloaded = not endpoint.models or policy.name in endpoint.models or model_name in endpoint.models
+                if policy.pinned and model_name not in current and downloaded:
+                    self._load(policy.name, endpoint, 'reload')
+            self._enforce_budget(endpoint, current)
+
+    def _enforce_budget(self, endpoint: Endpoint, resident: Dict[str, int]) -> None:
+        if not self.memory_budget:
+            return
+        used = sum(resident.values())
+        if used <= self.memory_budget:
+            return
+        now = time.monotonic()
+        with self._lock:
+            candidates = sorted(
+                (self._last_used.get((endpoint.url, model_name), 0.0), model_name)
+                for model_name in resident
+                if not self._policy(model_name).pinned
+            )
+        for last_used, model_name in candidates:
+            if used <= self.memory_budget:
+                break
+            if now - last_used < self.min_idle:
+                continue
+            if self.unload(model_name, endpoint, cause='budget'):
+                used -= resident[model_name]
+        if used > self.memory_budget:
+            self.logger.warning(
+                'loaded models on %s use %s bytes of %s, over the budget of %s', endpoint.url, used, self.memory_kind, self.memory_budget
+            )
+
+    def start(self) -> None:
+        '''
+            Run check every check_interval seconds on a daemon thread
+        '''
+        if self._thread is not None or not self.check_interval:
+            return
+
+        def run() -> None:
+            while not self._stop.wait(self.check_interval):
+                self.check()
+
+        self._thread = threading.Thread(target=run, name='model-residency', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            loads = [event.seconds for event in self.events if event.action == 'load' and event.seconds is not None]
+            return {
+                'cold_loads': self.cold_loads,
+                'loads': len(loads),
+                'load_seconds_max': max(loads) if loads else None,
+                'unloads': sum(1 for event in self.events if event.action in ('unload', 'expired')),
+                'resident': {url: dict(models) for url, models in self._resident.items()},
+            }
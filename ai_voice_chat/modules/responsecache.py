@@ -0,0 +1,244 @@
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple, Type
+from collections import OrderedDict
+from .logger import Logger
+import numpy as np
+import threading
+import hashlib
+import inspect
+import json
+import time
+import re
+
+AudioChunk = Tuple[int, np.ndarray]
+
+def normalize_prompt(prompt: str) -> str:
+    '''
+        Lower case prompt without punctuation and repeated whitespace, so near identical phrasings embed the same
+    '''
+    return ' '.join(re.sub(r"[^\w\s']", ' ', prompt.lower()).split())
+
+def context_key(*parts: Any) -> str:
+    '''
+        Key of everything besides the prompt that shapes a response (model, system prompt, earlier messages)
+    '''
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class CachedResponse:
+    def __init__(self, prompt: str, context: str, value: Any, slot: int, expires: float) -> None:
+        '''
+            A cached response, audio holds synthesized speech of it per voice
+        '''
+        self.prompt: str = prompt
+        self.context: str = context
+        self.value: Any = value
+        self.slot: int = slot
+        self.expires: float = expires
+        self.created: float = time.time()
+        self.hits: int = 0
+        self.audio: Dict[Any, List[AudioChunk]] = {}
+
+    @property
+    def audio_bytes(self) -> int:
+        return sum(chunk.nbytes for chunks in self.audio.values() for _, chunk in chunks)
+
+class ResponseCache:
+    def __init__(
+        self,
+        embed: Callable[[str], Any],
+        threshold: float = 0.9,
+        ttl: Optional[float] = 3600.0,
+        max_entries: int = 1000,
+        max_audio_bytes: int = 64 * 1024 * 1024,
+        max_sessions: int = 1024,
+        logger: Type[Logger] = Logger
+    ) -> None:
+        '''
+            Semantic cache of responses, a prompt phrased differently than a cached one still hits
+
+            Prompts are normalized and embedded with embed (a function returning a vector, or an awaitable of one). A lookup
+            returns the most similar entry with the same context key whose cosine similarity is at least threshold.
+            Entries expire after ttl seconds and the least recently used one is evicted beyond max_entries. Audio of
+            cached responses is kept up to max_audio_bytes, dropping the audio of least recently used entries first.
+            The entry of the last lookup or store of a session is remembered, see recent.
+        '''
+        if not 0 < threshold <= 1:
+            raise ValueError('threshold must be between 0 and 1')
+        self.embed: Callable[[str], Any] = embed
+        self.threshold: float = threshold
+        self.ttl: Optional[float] = ttl
+        self.max_entries: int = max_entries
+        self.max_audio_bytes: int = max_audio_bytes
+        self.max_sessions: int = max_sessions
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+        self.audio_hits: int = 0
+        self.audio_bytes: int = 0
+        self._entries: 'OrderedDict[int, CachedResponse]' = OrderedDict()
+        # one row per slot, so a lookup is a single matrix product
+        self._vectors: Optional[np.ndarray] = None
+        self._contexts: List[Optional[str]] = [None] * max_entries
+        self._free: List[int] = list(range(max_entries - 1, -1, -1))
+        self._sessions: 'OrderedDict[str, Tuple[CachedResponse, bool]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.logger = logger(name='response_cache').get_logger()
+
+    async def _embed(self, prompt: str) -> Optional[np.ndarray]:
+        try:
+            vector = self.embed(normalize_prompt(prompt))
+            if inspect.isawaitable(vector):
+                vector = await vector
+        except Exception as e:
+            self.logger.error('error embedding prompt for the response cache \n %s', e)
+            return None
+        if vector is None:
+            return None
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    async def lookup(self, prompt: str, context: str = '', session_id: Optional[str] = None) -> Optional[CachedResponse]:
+        '''
+            Cached response of the most similar prompt with the same context, or None
+        '''
+        vector = await self._embed(prompt)
+        with self._lock:
+            entry, similarity = self._nearest(vector, context) if vector is not None else (None, None)
+            if entry is None:
+                self.misses += 1
+                if session_id is not None:
+                    self._sessions.pop(session_id, None)
+                return None
+            self.hits += 1
+            entry.hits += 1
+            self._entries.move_to_end(entry.slot)
+            if session_id is not None:
+                self._remember(session_id, entry, True)
+        self.logger.info('response cache hit, similarity %.3f to: %s', similarity, entry.prompt)
+        return entry
+
+    def _nearest(self, vector: np.ndarray, context: str) -> Tuple[Optional[CachedResponse], Optional[float]]:
+        self._expire()
+        if self._vectors is None or not self._entries or self._vectors.shape[1] != len(vector):
+            return None, None
+        scores = self._vectors @ vector
+        for slot, slot_context in enumerate(self._contexts):
+            if slot_context != context:
+                scores[slot] = -1.0
+        slot = int(np.argmax(scores))
+        if scores[slot] < self.threshold:
+            return None, None
+        return self._entries[slot], float(scores[slot])
+
+    async def store(self, prompt: str, value: Any, context: str = '', session_id: Optional[str] = None) -> Optional[CachedResponse]:
+        '''
+            Cache value as the response to prompt, returns the entry or None if the prompt could not be embedded
+        '''
+        vector = await self._embed(prompt)
+        if vector is None:
+            return None
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._clear()
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            self._expire()
+            if not self._free:
+                self._evict(next(iter(self._entries)))
+                self.evictions += 1
+            slot = self._free.pop()
+            entry = CachedResponse(prompt, context, value, slot, time.monotonic() + self.ttl if self.ttl else float('inf'))
+            self._vectors[slot] = vector
+            self._contexts[slot] = context
+            self._entries[slot] = entry
+            if session_id is not None:
+                self._remember(session_id, entry, False)
+        return entry
+
+    def _remember(self, session_id: str, entry: CachedResponse, hit: bool) -> None:
+        self._sessions[session_id] = (entry, hit)
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def recent(self, session_id: str) -> Optional[Tuple[CachedResponse, bool]]:
+        '''
+            Entry of the last lookup hit or store of session_id and whether it was a hit, None after a miss
+        '''
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def forget(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for slot in [slot for slot, entry in self._entries.items() if entry.expires <= now]:
+            self._evict(slot)
+            self.expirations += 1
+
+    def _evict(self, slot: int) -> None:
+        entry = self._entries.pop(slot)
+        self.audio_bytes -= entry.audio_bytes
+        self._contexts[slot] = None
+        self._free.append(slot)
+
+    def _clear(self) -> None:
+        for slot in list(self._entries):
+            self._evict(slot)
+
+    def audio(self, entry: CachedResponse, key: Any) -> Optional[List[AudioChunk]]:
+        '''
+            Cached audio of entry for key (usually the voice options), or None
+        '''
+        with self._lock:
+            chunks = entry.audio.get(key)
+            if chunks is not None:
+                self.audio_hits += 1
+            return chunks
+
+    def put_audio(self, entry: CachedResponse, key: Any, chunks: List[AudioChunk]) -> bool:
+        '''
+            Keep the audio of entry for key, returns False if the entry is gone or the audio is over the budget
+        '''
+        nbytes = sum(chunk.nbytes for _, chunk in chunks)
+        if not chunks or nbytes > self.max_audio_bytes:
+            return False
+        with self._lock:
+            if self._entries.get(entry.slot) is not entry:
+                return False
+            previous = entry.audio.pop(key, None)
+            if previous is not None:
+                self.audio_bytes -= sum(chunk.nbytes for _, chunk in previous)
+            for other in self._entries.values():
+                if self.audio_bytes + nbytes <= self.max_audio_bytes:
+                    break
+                if other is not entry:
+                    self.audio_bytes -= other.audio_bytes
+                    other.audio.clear()
+            entry.audio[key] = chunks
+            self.audio_bytes += nbytes
+        return True
+
+    @staticmethod
+    async def replay(text: str) -> AsyncGenerator[str, None]:
+        '''
+            Async generator: a cached text word by word, like a model stream
+        '''
+        for word in re.findall(r'\S+\s*', text):
+            yield word
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'entries': len(self._entries),
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'audio_hits': self.audio_hits,
+                'audio_bytes': self.audio_bytes,
+            }
@@ -0,0 +1,86 @@
+from typing import List, Optional, Type
+from .embeddings import EmbeddingService
+from .vectorindex import VectorIndex, SearchResult
+from .logger import Logger
+import asyncio
+
+def split_text(text: str, max_chars: int = 800) -> List[str]:
+    '''
+        Split a document into paragraph chunks of at most max_chars characters
+    '''
+    chunks: List[str] = []
+    current = ''
+    for paragraph in (part.strip() for part in text.split('\n\n')):
+        if not paragraph:
+            continue
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(' ', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            chunks.append(current)
+            current = ''
+        current = f'{current}\n\n{paragraph}' if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+class Retriever:
+    def __init__(
+        self,
+        embedding_service: EmbeddingService,
+        index: VectorIndex,
+        logger: Type[Logger] = Logger,
+        top_k: int = 4,
+        min_score: float = 0.3
+    ) -> None:
+        '''
+            Retrieval step over a VectorIndex, embeds queries and documents with the EmbeddingService
+        '''
+        self.embedding_service: EmbeddingService = embedding_service
+        self.index: VectorIndex = index
+        self.top_k: int = top_k
+        self.min_score: float = min_score
+        self.logger = logger(name='retriever').get_logger()
+
+    async def add_documents(self, documents: List[str], metadata: Optional[List[dict]] = None, max_chars: int = 800) -> int:
+        '''
+            Split, embed and index documents, returns the number of chunks added
+        '''
+        texts: List[str] = []
+        chunk_metadata: List[dict] = []
+        for position, document in enumerate(documents):
+            for chunk in split_text(document, max_chars):
+                texts.append(chunk)
+                chunk_metadata.append(dict(metadata[position]) if metadata else {})
+        if not texts:
+            return 0
+        vectors = await self.embedding_service.embed(texts)
+        if vectors is None:
+            self.logger.error('unable to embed %s document chunks', len(texts))
+            return 0
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.index.add, vectors, texts, chunk_metadata)
+        self.logger.info('indexed %s document chunks', len(texts))
+        return len(texts)
+
+    async def retrieve(self, query: str) -> List[SearchResult]:
+        '''
+            Most similar indexed chunks for query, empty if the index is empty or embedding failed
+        '''
+        if not len(self.index):
+            return []
+        vector = await self.embedding_service.embed_one(query)
+        if vector is None:
+            return []
+        loop = asyncio.get_event_loop()
+        # a search over a large index is a big matrix product, keep it off the event loop
+        return await loop.run_in_executor(None, lambda: self.index.search(vector, k=self.top_k, min_score=self.min_score))
+
+    @staticmethod
+    def format_context(results: List[SearchResult]) -> str:
+        return '\n\n'.join(result.text for result in results)
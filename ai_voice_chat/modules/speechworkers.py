@@ -0,0 +1,346 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Type
+from multiprocessing import shared_memory
+from functools import partial
+from .audioframes import FramePool, convert_into
+from .logger import Logger
+import multiprocessing
+import numpy as np
+import itertools
+import threading
+import queue
+import os
+
+AudioChunk = Tuple[int, np.ndarray]
+
+def load_stt_model(model: str) -> Any:
+    from fastrtc import get_stt_model
+    return get_stt_model(model=model)
+
+def load_tts_model(model: str) -> Any:
+    from fastrtc import get_tts_model
+    return get_tts_model(model=model)
+
+def _serve(kind: str, loader: Callable[[], Any], conn, shm_name: str, slot_bytes: int, slots: int, free_slots, nice: int) -> None:
+    '''
+        Worker process: loads its model once, then runs the jobs it receives until it gets None
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        if nice:
+            os.nice(nice)
+        model = loader()
+    except Exception as e:
+        conn.send(('failed', repr(e)))
+        return
+    conn.send(('ready', None))
+    slot = 0
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        if message[0] != 'job':
+            # cancel of a job that already finished
+            continue
+        _, job_id, payload = message
+        try:
+            if kind == 'stt':
+                sample_rate, dtype, shape, inline = payload
+                audio = inline if inline is not None else np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                text = model.stt((sample_rate, audio))
+                del audio
+                conn.send((job_id, 'done', text))
+                continue
+            text, options = payload
+            for sample_rate, chunk in model.stream_tts_sync(text, options=options):
+                if conn.poll() and conn.recv() == ('cancel', job_id):
+                    break
+                chunk = np.ascontiguousarray(chunk)
+                if chunk.nbytes > slot_bytes:
+                    conn.send((job_id, 'chunk', (sample_rate, None, None, None, chunk)))
+                    continue
+                free_slots.acquire()
+                offset = slot * slot_bytes
+                np.ndarray(chunk.shape, dtype=chunk.dtype, buffer=shm.buf, offset=offset)[...] = chunk
+                conn.send((job_id, 'chunk', (sample_rate, chunk.dtype.str, chunk.shape, offset, None)))
+                slot = (slot + 1) % slots
+            conn.send((job_id, 'done', None))
+        except Exception as e:
+            conn.send((job_id, 'error', repr(e)))
+    shm.close()
+
+class _Job:
+    def __init__(self, job_id: int, kind: str, payload: Any) -> None:
+        self.id: int = job_id
+        self.kind: str = kind
+        self.payload: Any = payload
+        self.results: queue.Queue = queue.Queue()
+        self.worker: Optional['_Worker'] = None
+        self.cancelled: bool = False
+        self.finished: bool = False
+        self.lock = threading.Lock()
+
+class _Worker:
+    def __init__(self, kind: str, index: int, context, loader: Callable[[], Any], buffer_bytes: int, slots: int, nice: int) -> None:
+        self.kind: str = kind
+        self.name: str = f'{kind}-worker-{index}'
+        self.shm = shared_memory.SharedMemory(create=True, size=buffer_bytes)
+        self.slots: int = slots
+        self.slot_bytes: int = buffer_bytes // slots
+        self.free_slots = context.Semaphore(slots)
+        self.conn, child_conn = context.Pipe()
+        self.send_lock = threading.Lock()
+        self.job: Optional[_Job] = None
+        self.jobs: int = 0
+        self.process = context.Process(
+            target=_serve,
+            args=(kind, loader, child_conn, self.shm.name, self.slot_bytes, slots, self.free_slots, nice),
+            name=self.name,
+            daemon=True
+        )
+
+    def send(self, message: Any) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+class SpeechWorkerPool:
+    def __init__(
+        self,
+        stt_loader: Callable[[], Any] = partial(load_stt_model, 'moonshine/base'),
+        tts_loader: Callable[[], Any] = partial(load_tts_model, 'kokoro'),
+        stt_workers: int = 1,
+        tts_workers: int = 2,
+        stt_buffer_bytes: int = 16 * 1024 * 1024,
+        tts_buffer_bytes: int = 8 * 1024 * 1024,
+        tts_slots: int = 4,
+        tts_nice: int = 5,
+        tts_frames: Optional[FramePool] = None,
+        logger: Type[Logger] = Logger
+    ) -> None:
+        '''
+            Runs speech to text and text to speech in worker processes, so sessions do not share one GIL
+
+            Every worker loads its model once. Audio goes through a shared memory block per worker instead of being
+            pickled, text to speech chunks through tts_slots slots of that block. Speech to text and text to speech have
+            their own workers and queues, so a long synthesis never delays a transcription; text to speech workers also
+            run with a lower cpu priority (tts_nice). Within a queue lower priority values run first.
+            Text to speech chunks are converted to float32 straight out of their slot into frames of tts_frames (by
+            default 16 frames of 15 seconds at 24kHz), so steady state synthesis allocates no audio arrays. The consumer
+            of stream_tts_sync gives every chunk back with frames.release once it is played, chunks of a cancelled
+            synthesis that were not delivered are given back here.
+            The pool offers stt() and stream_tts_sync() like the fastrtc models it replaces. Loaders must be picklable.
+        '''
+        self._loaders: Dict[str, Callable[[], Any]] = {'stt': stt_loader, 'tts': tts_loader}
+        self._counts: Dict[str, int] = {'stt': stt_workers, 'tts': tts_workers}
+        self._buffers: Dict[str, Tuple[int, int]] = {'stt': (stt_buffer_bytes, 1), 'tts': (tts_buffer_bytes, tts_slots)}
+        self._nice: Dict[str, int] = {'stt': 0, 'tts': tts_nice}
+        self._context = multiprocessing.get_context('spawn')
+        self._workers: Dict[str, List[_Worker]] = {'stt': [], 'tts': []}
+        self._queues: Dict[str, queue.PriorityQueue] = {'stt': queue.PriorityQueue(), 'tts': queue.PriorityQueue()}
+        self._idle: Dict[str, queue.Queue] = {'stt': queue.Queue(), 'tts': queue.Queue()}
+        self._ids = itertools.count()
+        self.pickled_chunks: int = 0
+        self.pickled_bytes: int = 0
+        self.frames: FramePool = tts_frames or FramePool(frame_samples=15 * 24000, max_frames=16)
+        self.logger = logger(name='speech_workers').get_logger()
+
+    def start_stt(self) -> 'SpeechWorkerPool':
+        '''
+            Start the speech to text workers and wait until their models are loaded
+        '''
+        self._start('stt')
+        return self
+
+    def start_tts(self) -> 'SpeechWorkerPool':
+        '''
+            Start the text to speech workers and wait until their models are loaded
+        '''
+        self._start('tts')
+        return self
+
+    def _start(self, kind: str) -> None:
+        if self._workers[kind]:
+            return
+        buffer_bytes, slots = self._buffers[kind]
+        workers = [
+            _Worker(kind, index, self._context, self._loaders[kind], buffer_bytes, slots, self._nice[kind])
+            for index in range(self._counts[kind])
+        ]
+        for worker in workers:
+            worker.process.start()
+        for worker in workers:
+            try:
+                status, error = worker.conn.recv()
+            except EOFError:
+                status, error = 'failed', f'exit code {worker.process.exitcode}'
+            if status != 'ready':
+                self._close(workers)
+                raise RuntimeError(f'{worker.name} failed to load its model: {error}')
+        self._workers[kind] = workers
+        for worker in workers:
+            threading.Thread(target=self._read, args=(worker,), name=f'{worker.name}-reader', daemon=True).start()
+            self._idle[kind].put(worker)
+        threading.Thread(target=self._dispatch, args=(kind,), name=f'{kind}-dispatcher', daemon=True).start()
+        self.logger.info('started %s %s workers', len(workers), kind)
+
+    def _dispatch(self, kind: str) -> None:
+        while True:
+            worker = self._idle[kind].get()
+            if worker is None:
+                return
+            while True:
+                _, _, job = self._queues[kind].get()
+                if job is None:
+                    return
+                if not job.cancelled:
+                    break
+            job.worker = worker
+            worker.job = worker_job = job
+            worker.jobs += 1
+            payload = job.payload
+            if kind == 'stt':
+                sample_rate, audio = payload
+                audio = np.ascontiguousarray(audio)
+                if audio.nbytes <= worker.slot_bytes:
+                    np.ndarray(audio.shape, dtype=audio.dtype, buffer=worker.shm.buf)[...] = audio
+                    payload = (sample_rate, audio.dtype.str, audio.shape, None)
+                else:
+                    payload = (sample_rate, None, None, audio)
+            try:
+                worker.send(('job', worker_job.id, payload))
+            except (OSError, ValueError) as e:
+                worker_job.results.put(('error', repr(e)))
+
+    def _read(self, worker: _Worker) -> None:
+        while True:
+            try:
+                job_id, status, data = worker.conn.recv()
+            except (EOFError, OSError):
+                job = worker.job
+                if job is not None:
+                    job.results.put(('error', f'{worker.name} exited'))
+                if worker.process.exitcode not in (None, 0):
+                    self.logger.error('%s exited with code %s', worker.name, worker.process.exitcode)
+                return
+            job = worker.job
+            if job is None or job.id != job_id:
+                continue
+            if status == 'chunk':
+                sample_rate, dtype, shape, offset, inline = data
+                if inline is None:
+                    # copy out right away so the worker can reuse the slot
+                    source = np.ndarray(shape, dtype=np.dtype(dtype), buffer=worker.shm.buf, offset=offset)
+                    chunk = convert_into(source, self.frames.acquire(source.size).reshape(shape))
+                    del source
+                    worker.free_slots.release()
+                else:
+                    chunk = inline
+                    self.pickled_chunks += 1
+                    self.pickled_bytes += chunk.nbytes
+                with job.lock:
+                    if job.cancelled:
+                        self.frames.release(chunk)
+                    else:
+                        job.results.put(('chunk', (sample_rate, chunk)))
+                continue
+            worker.job = None
+            job.results.put((status, data))
+            self._idle[worker.kind].put(worker)
+
+    def _submit(self, kind: str, payload: Any, priority: int) -> _Job:
+        if not self._workers[kind]:
+            raise RuntimeError(f'{kind} workers are not started')
+        job = _Job(next(self._ids), kind, payload)
+        self._queues[kind].put((priority, job.id, job))
+        return job
+
+    def _cancel(self, job: _Job) -> None:
+        with job.lock:
+            job.cancelled = True
+        # chunks nobody will read anymore
+        while True:
+            try:
+                status, data = job.results.get_nowait()
+            except queue.Empty:
+                break
+            if status == 'chunk':
+                self.frames.release(data[1])
+        worker = job.worker
+        if worker is not None and worker.job is job:
+            try:
+                worker.send(('cancel', job.id))
+            except (OSError, ValueError):
+                pass
+
+    def stt(self, audio: AudioChunk, priority: int = 0) -> str:
+        '''
+            Transcribe (sample_rate, samples) on a speech to text worker
+        '''
+        job = self._submit('stt', audio, priority)
+        try:
+            status, data = job.results.get()
+            job.finished = True
+            if status == 'error':
+                raise RuntimeError(data)
+            return data
+        finally:
+            if not job.finished:
+                self._cancel(job)
+
+    def stream_tts_sync(self, text: str, options: Any = None, priority: int = 1) -> Iterator[AudioChunk]:
+        '''
+            Synthesize text on a text to speech worker, yields audio chunks as they are produced
+
+            Chunks may be pooled frames, give each back with frames.release once it is no longer read.
+            Closing the generator early cancels the synthesis.
+        '''
+        job = self._submit('tts', (text, options), priority)
+        try:
+            while True:
+                status, data = job.results.get()
+                if status == 'chunk':
+                    yield data
+                    continue
+                job.finished = True
+                if status == 'error':
+                    raise RuntimeError(data)
+                return
+        finally:
+            if not job.finished:
+                self._cancel(job)
+
+    def stats(self) -> dict:
+        return {
+            kind: {
+                'workers': len(workers),
+                'alive': sum(1 for worker in workers if worker.process.is_alive()),
+                'queued': self._queues[kind].qsize(),
+                'busy': sum(1 for worker in workers if worker.job is not None),
+                'jobs': sum(worker.jobs for worker in workers),
+            }
+            for kind, workers in self._workers.items()
+        } | {'pickled_chunks': self.pickled_chunks, 'pickled_bytes': self.pickled_bytes, 'frames': self.frames.stats()}
+
+    def stop(self, timeout: float = 5.0) -> None:
+        '''
+            Stop all workers and release their shared memory
+        '''
+        for kind in self._workers:
+            self._idle[kind].put(None)
+            self._queues[kind].put((-1, -1, None))
+        for workers in self._workers.values():
+            self._close(workers, timeout)
+        self._workers = {'stt': [], 'tts': []}
+
+    @staticmethod
+    def _close(workers: List[_Worker], timeout: float = 5.0) -> None:
+        for worker in workers:
+            try:
+                worker.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.shm.close()
+            worker.shm.unlink()
@@ -0,0 +1,149 @@
+from typing import Callable, Dict, List, Optional, Any, Type
+from .logger import Logger
+import threading
+import time
+
+PENDING = 'pending'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+class _Component:
+    def __init__(self, name: str, load: Callable[[], Any], depends_on: List[str], required: bool) -> None:
+        self.name: str = name
+        self.load: Callable[[], Any] = load
+        self.depends_on: List[str] = depends_on
+        self.required: bool = required
+        self.state: str = PENDING
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.seconds: Optional[float] = None
+        self.done = threading.Event()
+
+class StartupOrchestrator:
+    def __init__(self, logger: Type[Logger] = Logger) -> None:
+        '''
+            Loads application components concurrently, each on its own thread
+
+            A component only starts once the components it depends on are ready, otherwise everything loads at once,
+            so cold start takes as long as the slowest chain instead of the sum of all components. The application is
+            ready once every required component is, optional components that fail only cost their feature.
+        '''
+        self._components: Dict[str, _Component] = {}
+        self._started: Optional[float] = None
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self.total_seconds: Optional[float] = None
+        self.logger = logger(name='startup').get_logger()
+
+    def add(self, name: str, load: Callable[[], Any], depends_on: Optional[List[str]] = None, required: bool = True) -> None:
+        '''
+            Register a component, load is called without arguments and its return value is kept as the component result,
+            an optional component (required False) does not hold back ready
+        '''
+        if self._started is not None:
+            raise RuntimeError('components must be added before start()')
+        for dependency in depends_on or []:
+            if dependency not in self._components:
+                raise ValueError(f'unknown dependency {dependency} of {name}')
+        self._components[name] = _Component(name, load, list(depends_on or []), required)
+
+    def _run(self, component: _Component) -> None:
+        for dependency in component.depends_on:
+            self._components[dependency].done.wait()
+            if self._components[dependency].state != READY:
+                component.state = FAILED
+                component.error = RuntimeError(f'dependency {dependency} failed')
+                self.logger.error('not loading %s, dependency %s failed', component.name, dependency)
+                component.done.set()
+                self._check_finished()
+                return
+        component.state = LOADING
+        start = time.perf_counter()
+        try:
+            component.result = component.load()
+            component.state = READY
+            self.logger.info('%s ready', component.name)
+        except BaseException as e:
+            component.error = e
+            component.state = FAILED
+            self.logger.error('unable to load %s: \n %s', component.name, e)
+        finally:
+            component.seconds = time.perf_counter() - start
+            component.done.set()
+            self._check_finished()
+
+    def _check_finished(self) -> None:
+        with self._lock:
+            if self._finished.is_set() or not all(component.done.is_set() for component in self._components.values()):
+                return
+            self.total_seconds = time.perf_counter() - self._started
+            self._finished.set()
+            breakdown = ', '.join(
+                f'{component.name}={component.state} {component.seconds or 0:.2f}s' for component in self._components.values()
+            )
+            self.logger.info('startup finished in %.2fs: %s', self.total_seconds, breakdown)
+
+    def start(self) -> None:
+        '''
+            Start loading all components in the background, returns immediately
+        '''
+        if self._started is not None:
+            return
+        self._started = time.perf_counter()
+        if not self._components:
+            self._check_finished()
+        for component in self._components.values():
+            threading.Thread(target=self._run, args=(component,), name=f'startup-{component.name}', daemon=True).start()
+
+    @property
+    def ready(self) -> bool:
+        return all(component.state == READY for component in self._components.values() if component.required)
+
+    @property
+    def failed(self) -> bool:
+        '''
+            A required component failed, the application will not become ready
+        '''
+        return any(component.state == FAILED for component in self._components.values() if component.required)
+
+    def is_ready(self, name: str) -> bool:
+        component = self._components.get(name)
+        return component is not None and component.state == READY
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        '''
+            Block until every component finished loading, returns ready
+        '''
+        self._finished.wait(timeout)
+        return self.ready
+
+    def result(self, name: str, timeout: Optional[float] = None) -> Any:
+        '''
+            Result of a component, waits for it to load and raises if it failed
+        '''
+        component = self._components[name]
+        if not component.done.wait(timeout):
+            raise TimeoutError(f'{name} is still loading')
+        if component.state != READY:
+            raise RuntimeError(f'{name} failed to load') from component.error
+        return component.result
+
+    def status(self) -> dict:
+        '''
+            State and load time in seconds of every component
+        '''
+        return {
+            'ready': self.ready,
+            'failed': self.failed,
+            'total_seconds': self.total_seconds,
+            'components': {
+                component.name: {
+                    'state': component.state,
+                    'required': component.required,
+                    'seconds': component.seconds,
+                    'error': str(component.error) if component.error else None
+                }
+                for component in self._components.values()
+            }
+        }
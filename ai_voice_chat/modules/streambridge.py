@@ -0,0 +1,209 @@
+from typing import Callable, Iterator, AsyncGenerator, Optional, TypeVar, Generic, List
+from concurrent.futures import Executor
+import asyncio
+import threading
+
+T = TypeVar('T')
+
+_DONE = object()
+
+class _ProducerError:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+class ThreadBridge(Generic[T]):
+    def __init__(
+        self,
+        make_iterator: Callable[[], Iterator[T]],
+        executor: Optional[Executor] = None,
+        maxsize: int = 4,
+        discard: Optional[Callable[[T], None]] = None
+    ) -> None:
+        '''
+            Runs a blocking iterator in a worker thread and hands its items to the event loop
+
+            At most maxsize items are buffered ahead of the consumer, the producer thread waits for the consumer beyond that.
+            close() tells the producer to stop, the blocking iterator is then closed from its own thread. Items produced
+            but never delivered are passed to discard, if given.
+            The iterator runs on the given executor, or on a dedicated thread if none is given.
+            Must be created and consumed on the same running event loop.
+        '''
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self._make_iterator = make_iterator
+        self._executor = executor
+        self._discard = discard
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._slots = threading.Semaphore(maxsize)
+        self._stop = threading.Event()
+        self._finished = False
+
+    def _put(self, item) -> bool:
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, item)
+            return True
+        except RuntimeError:
+            # event loop is closed, nobody is listening anymore
+            return False
+
+    def _deliver(self, item) -> None:
+        if self._stop.is_set():
+            self._drop(item)
+        else:
+            self._queue.put_nowait(item)
+
+    def _drop(self, item) -> None:
+        if self._discard is not None and item is not _DONE and not isinstance(item, _ProducerError):
+            self._discard(item)
+
+    def _produce(self) -> None:
+        iterator = None
+        try:
+            if self._stop.is_set():
+                # consumer went away while this job was still queued on the executor
+                return
+            iterator = iter(self._make_iterator())
+            for item in iterator:
+                while not self._slots.acquire(timeout=0.1):
+                    if self._stop.is_set():
+                        self._drop(item)
+                        return
+                if self._stop.is_set() or not self._put(item):
+                    self._drop(item)
+                    return
+        except BaseException as e:
+            if not self._stop.is_set():
+                self._put(_ProducerError(e))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    pass
+            self._put(_DONE)
+
+    def start(self) -> None:
+        if self._executor is not None:
+            self._executor.submit(self._produce)
+        else:
+            threading.Thread(target=self._produce, name='stream-bridge', daemon=True).start()
+
+    def _unwrap(self, item) -> T:
+        if item is _DONE:
+            self._finished = True
+            raise StopAsyncIteration
+        if isinstance(item, _ProducerError):
+            self._finished = True
+            raise item.error
+        self._slots.release()
+        return item
+
+    async def get(self) -> T:
+        '''
+            Wait for the next item, raises StopAsyncIteration once the iterator is exhausted
+        '''
+        if self._finished:
+            raise StopAsyncIteration
+        return self._unwrap(await self._queue.get())
+
+    def get_nowait(self) -> T:
+        '''
+            Next item if one is already buffered, raises asyncio.QueueEmpty otherwise
+        '''
+        if self._finished:
+            raise StopAsyncIteration
+        return self._unwrap(self._queue.get_nowait())
+
+    def close(self) -> None:
+        '''
+            Stop the producer, call on the event loop
+        '''
+        self._stop.set()
+        self._slots.release()
+        while True:
+            try:
+                self._drop(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+async def iterate_in_thread(
+    make_iterator: Callable[[], Iterator[T]],
+    executor: Optional[Executor] = None,
+    maxsize: int = 4,
+    discard: Optional[Callable[[T], None]] = None
+) -> AsyncGenerator[T, None]:
+    '''
+        Async generator: runs a blocking iterator in a worker thread and yields each item as soon as it is produced,
+        items still buffered when the consumer stops are passed to discard
+    '''
+    bridge = ThreadBridge(make_iterator, executor=executor, maxsize=maxsize, discard=discard)
+    bridge.start()
+    try:
+        while True:
+            try:
+                item = await bridge.get()
+            except StopAsyncIteration:
+                break
+            yield item
+    finally:
+        bridge.close()
+
+async def iterate_batches_in_thread(
+    make_iterator: Callable[[], Iterator[T]],
+    executor: Optional[Executor] = None,
+    maxsize: int = 256,
+    window: float = 0.0,
+    max_items: Optional[int] = None
+) -> AsyncGenerator[List[T], None]:
+    '''
+        Async generator: like iterate_in_thread, but yields lists of items
+
+        Every item already buffered is taken with the first one, and for up to window seconds after the first item
+        more items are awaited. A batch is yielded early once it holds max_items items.
+        With window=0 batching never adds latency, it only merges items that arrived while the consumer was busy.
+    '''
+    loop = asyncio.get_running_loop()
+    bridge = ThreadBridge(make_iterator, executor=executor, maxsize=maxsize)
+    bridge.start()
+    pending: Optional[asyncio.Future] = None
+    try:
+        finished = False
+        while not finished:
+            try:
+                batch = [await bridge.get()]
+            except StopAsyncIteration:
+                break
+            deadline = loop.time() + window
+            while max_items is None or len(batch) < max_items:
+                try:
+                    batch.append(bridge.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                except StopAsyncIteration:
+                    finished = True
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                pending = asyncio.ensure_future(bridge.get())
+                done, _ = await asyncio.wait({pending}, timeout=remaining)
+                if not done:
+                    # leaving the queue.get pending would swallow the next item
+                    pending.cancel()
+                    pending = None
+                    break
+                try:
+                    batch.append(pending.result())
+                except StopAsyncIteration:
+                    finished = True
+                    break
+                finally:
+                    pending = None
+            yield batch
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+        bridge.close()
@@ -0,0 +1,203 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+from concurrent.futures import Executor, Future
+from fastrtc.utils import get_current_context
+from .audioframes import FramePool, PooledReplyOnPause
+from .logger import Logger
+import numpy as np
+import threading
+import time
+
+AudioChunk = Tuple[int, np.ndarray]
+
+class Utterance:
+    def __init__(self, sample_rate: int, state: Any) -> None:
+        '''
+            Audio of one utterance that is transcribed segment by segment while it is spoken
+        '''
+        self.sample_rate: int = sample_rate
+        self.state: Any = state
+        self.end: int = 0  # samples covered by segments
+        self.segments: List[Tuple[int, int, Future]] = []
+
+    @property
+    def pending(self) -> bool:
+        return any(not future.done() for _, _, future in self.segments)
+
+    def hypothesis(self) -> str:
+        '''
+            Running transcript of the segments finished so far
+        '''
+        texts = []
+        for _, _, future in self.segments:
+            if not future.done() or future.exception() is not None:
+                break
+            texts.append(future.result())
+        return _join(texts)
+
+class Transcript:
+    def __init__(self, text: str, audio_seconds: float, tail_seconds: float, finalize_seconds: float, saved_seconds: Optional[float]) -> None:
+        '''
+            Final transcript of an utterance, saved_seconds is the estimated time saved over transcribing it whole
+        '''
+        self.text: str = text
+        self.audio_seconds: float = audio_seconds
+        self.tail_seconds: float = tail_seconds
+        self.finalize_seconds: float = finalize_seconds
+        self.saved_seconds: Optional[float] = saved_seconds
+
+def _join(texts: List[str]) -> str:
+    return ' '.join(text.strip() for text in texts if text and text.strip())
+
+class StreamingTranscriber:
+    def __init__(
+        self,
+        stt: Callable[[AudioChunk], str],
+        executor: Executor,
+        is_ready: Callable[[], bool] = lambda: True,
+        segment_seconds: float = 3.0,
+        boundary_search_seconds: float = 0.6,
+        frame_seconds: float = 0.02,
+        rtf_alpha: float = 0.2,
+        logger: Type[Logger] = Logger
+    ) -> None:
+        '''
+            Transcribes speech in segments while it is still arriving, so only the tail is left when the pause is detected
+
+            A segment is cut once segment_seconds of audio are not covered yet, at the quietest frame of the last
+            boundary_search_seconds so words are rarely split. One segment per utterance is transcribed at a time on executor.
+            The time saved per turn is estimated from the measured speech to text real-time factor: transcribing the whole
+            utterance would have taken about rtf * duration, finalizing took finalize_seconds.
+        '''
+        self.stt = stt
+        self.executor: Executor = executor
+        self.is_ready: Callable[[], bool] = is_ready
+        self.segment_seconds: float = segment_seconds
+        self.boundary_search_seconds: float = boundary_search_seconds
+        self.frame_seconds: float = frame_seconds
+        self.rtf_alpha: float = rtf_alpha
+        self.real_time_factor: Optional[float] = None
+        self._completed: Dict[str, Utterance] = {}
+        self._lock = threading.Lock()
+        self.logger = logger(name='streaming_stt').get_logger()
+
+    def feed(self, utterance: Optional[Utterance], sample_rate: int, stream: np.ndarray, state: Any) -> Optional[Utterance]:
+        '''
+            Look at the speech of state received so far, starting the transcription of a segment when enough is uncovered
+        '''
+        if not self.is_ready():
+            return utterance
+        if utterance is None or utterance.state is not state:
+            utterance = Utterance(sample_rate, state)
+        if utterance.pending or len(stream) - utterance.end < self.segment_seconds * sample_rate:
+            return utterance
+        self.logger.debug('hypothesis: %s', utterance.hypothesis())
+        start = utterance.end
+        end = self._boundary(stream, sample_rate, start)
+        utterance.segments.append((start, end, self.executor.submit(self._transcribe, sample_rate, stream[start:end])))
+        utterance.end = end
+        return utterance
+
+    def _boundary(self, stream: np.ndarray, sample_rate: int, start: int) -> int:
+        # cut in the middle of the quietest frame near the end, a pause between words if there is one
+        frame = max(int(self.frame_seconds * sample_rate), 1)
+        search_start = max(len(stream) - int(self.boundary_search_seconds * sample_rate), start)
+        frames = (len(stream) - search_start) // frame
+        if frames < 2:
+            return len(stream)
+        window = stream[search_start:search_start + frames * frame].astype(np.float32, copy=False).reshape(frames, frame)
+        quietest = int(np.argmin(np.einsum('ij,ij->i', window, window)))
+        return search_start + quietest * frame + frame // 2
+
+    def _transcribe(self, sample_rate: int, samples: np.ndarray) -> str:
+        start = time.perf_counter()
+        text = self.stt((sample_rate, samples.reshape(1, -1)))
+        seconds = len(samples) / sample_rate
+        if seconds:
+            rtf = (time.perf_counter() - start) / seconds
+            with self._lock:
+                if self.real_time_factor is None:
+                    self.real_time_factor = rtf
+                else:
+                    self.real_time_factor += self.rtf_alpha * (rtf - self.real_time_factor)
+        return text
+
+    def complete(self, session_id: str, utterance: Optional[Utterance]) -> None:
+        '''
+            Hand the utterance of a session to the reply function, called when the pause was detected
+        '''
+        with self._lock:
+            if utterance is None or not utterance.segments:
+                self._completed.pop(session_id, None)
+            else:
+                self._completed[session_id] = utterance
+
+    def take(self, session_id: str) -> Optional[Utterance]:
+        with self._lock:
+            return self._completed.pop(session_id, None)
+
+    def finish(self, utterance: Utterance, audio: AudioChunk) -> Optional[Transcript]:
+        '''
+            Blocking: wait for the transcribed segments and transcribe the rest of audio,
+            None if audio is not the audio the utterance was cut from
+        '''
+        start = time.perf_counter()
+        sample_rate, samples = audio
+        samples = np.asarray(samples).reshape(-1)
+        if sample_rate != utterance.sample_rate or len(samples) < utterance.end:
+            self.logger.warning('utterance does not match the received audio, transcribing it whole')
+            return None
+        texts = []
+        # segments were submitted before this call, so they never wait behind it on the executor
+        for _, _, future in utterance.segments:
+            texts.append(future.result())
+        tail = samples[utterance.end:]
+        if len(tail):
+            texts.append(self._transcribe(sample_rate, tail))
+        finalize_seconds = time.perf_counter() - start
+        audio_seconds = len(samples) / sample_rate
+        saved = self.real_time_factor * audio_seconds - finalize_seconds if self.real_time_factor is not None else None
+        return Transcript(_join(texts), audio_seconds, len(tail) / sample_rate, finalize_seconds, saved)
+
+class StreamingReplyOnPause(PooledReplyOnPause):
+    def __init__(self, fn: Callable, transcriber: StreamingTranscriber, frames: FramePool, **kwargs: Any) -> None:
+        '''
+            PooledReplyOnPause that feeds the speech it accumulates to a streaming transcriber
+
+            When the pause is detected the utterance is handed to the transcriber under the connection's webrtc id,
+            the reply function takes it from there with StreamingTranscriber.take.
+        '''
+        super().__init__(fn, frames, **kwargs)
+        self.transcriber: StreamingTranscriber = transcriber
+        self._utterance: Optional[Utterance] = None
+        self._completed_state: Any = None
+        self._utterance_lock = threading.Lock()
+
+    def copy(self) -> 'StreamingReplyOnPause':
+        # one handler per connection, they share the transcriber and the vad model
+        return StreamingReplyOnPause(self.fn, self.transcriber, self.frames, **dict(self._kwargs, model=self.model))
+
+    def determine_pause(self, audio: np.ndarray, sampling_rate: int, state: Any) -> bool:
+        pause = super().determine_pause(audio, sampling_rate, state)
+        if not pause and state.stream is not None:
+            with self._utterance_lock:
+                # frames that arrive while emit hands the utterance over still belong to the old state
+                if state is not self._completed_state:
+                    self._utterance = self.transcriber.feed(self._utterance, sampling_rate, state.stream, state)
+        return pause
+
+    def emit(self) -> Any:
+        if self.event.is_set() and not self.generator:
+            with self._utterance_lock:
+                self._completed_state = self.state
+                utterance, self._utterance = self._utterance, None
+            try:
+                session_id = get_current_context().webrtc_id
+            except RuntimeError:
+                session_id = 'default'
+            self.transcriber.complete(session_id, utterance)
+        return super().emit()
+
+    def reset(self) -> None:
+        super().reset()
+        with self._utterance_lock:
+            self._utterance = None
@@ -0,0 +1,133 @@
+from typing import AsyncIterator, AsyncGenerator, Optional
+import asyncio
+import re
+
+# end of a sentence: terminal punctuation, optional closing quotes/brackets, then whitespace
+_SENTENCE_END = re.compile(r'[.!?…]+["\')\]]*\s+')
+# end of a clause: a pause character followed by whitespace
+_CLAUSE_END = re.compile(r'[,;:—]\s+|\s+[–-]\s+')
+_WHITESPACE = re.compile(r'\s+')
+
+class SentenceChunker:
+    def __init__(
+        self,
+        min_chars: int = 40,
+        max_chars: int = 250,
+        flush_timeout: float = 0.6,
+        first_chunk_min_chars: int = 12
+    ) -> None:
+        '''
+            Buffers a stream of llm tokens into speakable chunks for text to speech
+
+            A chunk is emitted at a sentence boundary once it holds at least min_chars characters.
+            Chunks longer than max_chars are split at the last clause boundary, or whitespace if there is none.
+            If no token arrives for flush_timeout seconds the buffer is flushed as is.
+            The first chunk of a stream only needs first_chunk_min_chars characters and may end at a clause boundary
+            so the first audio is synthesized as early as possible.
+        '''
+        if min_chars < 1 or max_chars < min_chars:
+            raise ValueError('expected 1 <= min_chars <= max_chars')
+        self.min_chars: int = min_chars
+        self.max_chars: int = max_chars
+        self.flush_timeout: float = flush_timeout
+        self.first_chunk_min_chars: int = min(first_chunk_min_chars, min_chars)
+        self.tokens_in: int = 0
+        self.chunks_out: int = 0
+
+    def _split_point(self, buffer: str, first: bool) -> Optional[int]:
+        '''
+            Index at which the buffer should be cut, or None to keep buffering
+        '''
+        min_chars = self.first_chunk_min_chars if first else self.min_chars
+        cut = None
+        for match in _SENTENCE_END.finditer(buffer):
+            if match.end() > self.max_chars:
+                break
+            cut = match.end()
+        if first and cut is None:
+            for match in _CLAUSE_END.finditer(buffer):
+                if match.end() > self.max_chars:
+                    break
+                cut = match.end()
+        if cut is not None and len(buffer[:cut].strip()) >= min_chars:
+            return cut
+
+        if len(buffer) <= self.max_chars:
+            return None
+        # buffer is too long to wait for a sentence boundary, fall back to a clause or a word
+        for pattern in (_CLAUSE_END, _WHITESPACE):
+            cut = None
+            for match in pattern.finditer(buffer, 0, self.max_chars):
+                cut = match.end()
+            if cut:
+                return cut
+        return self.max_chars
+
+    def split(self, buffer: str, first: bool = False) -> tuple[list[str], str]:
+        '''
+            Split all ready chunks off the buffer, returns the chunks and the remaining buffer
+        '''
+        chunks: list[str] = []
+        while buffer:
+            cut = self._split_point(buffer, first and not chunks)
+            if cut is None:
+                break
+            chunk = buffer[:cut].strip()
+            buffer = buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+        return chunks, buffer
+
+    async def chunk(self, token_stream: AsyncIterator[str]) -> AsyncGenerator[str, None]:
+        '''
+            Async generator: yields speakable text chunks from an async token stream
+        '''
+        buffer = ''
+        first = True
+        tokens = 0
+        chunks = 0
+        iterator = token_stream.__aiter__()
+        pending: Optional[asyncio.Future] = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                timeout = self.flush_timeout if buffer.strip() else None
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    # the model stalled, speak what we have so far
+                    chunk = buffer.strip()
+                    buffer = ''
+                    if chunk:
+                        first = False
+                        chunks += 1
+                        yield chunk
+                    continue
+
+                try:
+                    token = pending.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    pending = None
+                if not token:
+                    continue
+                tokens += 1
+                buffer += token
+                ready, buffer = self.split(buffer, first)
+                for chunk in ready:
+                    first = False
+                    chunks += 1
+                    yield chunk
+
+            chunk = buffer.strip()
+            if chunk:
+                chunks += 1
+                yield chunk
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+                # the token stream is only closed once the read in flight stopped
+                await asyncio.wait({pending})
+            self.tokens_in += tokens
+            self.chunks_out += chunks
@@ -0,0 +1,103 @@
+from typing import Callable, Deque, Dict, List, Optional, Type
+from collections import deque
+from .logger import Logger
+import asyncio
+import time
+
+class Turn:
+    def __init__(self, session_id: str, task: asyncio.Task) -> None:
+        '''
+            One response of a session, runs as task on the event loop
+        '''
+        self.session_id: str = session_id
+        self.task: asyncio.Task = task
+        self.started: float = time.perf_counter()
+        self.cancel_requested: Optional[float] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_requested is not None
+
+class TurnManager:
+    def __init__(self, logger: Type[Logger] = Logger, history: int = 1000) -> None:
+        '''
+            Tracks the in-flight turn of every session so a new utterance can cancel the previous response
+
+            Cancelling a turn cancels its task, which closes the llm stream (and with it the http connection, so the
+            server stops decoding) and stops the text to speech producers before they synthesize anything else.
+            Cancellation latency, from the cancel request until the cancelled task finished unwinding, is recorded in seconds.
+            All methods except cancel_threadsafe must be called on the event loop that runs the turns.
+        '''
+        self._turns: Dict[str, Turn] = {}
+        self.cancellations: int = 0
+        self.cancel_latencies: Deque[float] = deque(maxlen=history)
+        self._cancel_listeners: List[Callable[[Turn, float], None]] = []
+        self.logger = logger(name='turn_manager').get_logger()
+
+    def add_cancel_listener(self, listener: Callable[[Turn, float], None]) -> None:
+        '''
+            Register a callback that receives every cancelled turn and its cancellation latency
+        '''
+        self._cancel_listeners.append(listener)
+
+    def begin(self, session_id: str) -> Turn:
+        '''
+            Start a turn for the current task, cancelling the session's previous turn if it is still running
+        '''
+        task = asyncio.current_task()
+        if task is None:
+            raise RuntimeError('begin() must be called from a task')
+        previous = self._turns.get(session_id)
+        # a task that runs several turns one after the other has finished the previous one
+        if previous is None or previous.task is not task:
+            self.cancel(session_id)
+        turn = Turn(session_id, task)
+        self._turns[session_id] = turn
+        task.add_done_callback(lambda _: self._finished(turn))
+        return turn
+
+    def cancel(self, session_id: str) -> bool:
+        '''
+            Cancel the running turn of a session, returns True if there was one
+        '''
+        turn = self._turns.get(session_id)
+        if turn is None or turn.task.done() or turn.cancelled:
+            return False
+        turn.cancel_requested = time.perf_counter()
+        self.cancellations += 1
+        turn.task.cancel()
+        self.logger.info('cancelling turn of session %s', session_id)
+        return True
+
+    def cancel_threadsafe(self, session_id: str, loop: asyncio.AbstractEventLoop) -> None:
+        '''
+            Cancel the running turn of a session from another thread
+        '''
+        loop.call_soon_threadsafe(self.cancel, session_id)
+
+    def is_running(self, session_id: str) -> bool:
+        turn = self._turns.get(session_id)
+        return turn is not None and not turn.task.done()
+
+    def _finished(self, turn: Turn) -> None:
+        if self._turns.get(turn.session_id) is turn:
+            del self._turns[turn.session_id]
+        if turn.cancel_requested is None:
+            return
+        latency = time.perf_counter() - turn.cancel_requested
+        self.cancel_latencies.append(latency)
+        self.logger.info('turn of session %s cancelled in %.4fs', turn.session_id, latency)
+        for listener in self._cancel_listeners:
+            try:
+                listener(turn, latency)
+            except Exception as e:
+                self.logger.error('error in cancel listener \n %s', e)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.cancel_latencies)
+        return {
+            'running': sum(1 for turn in self._turns.values() if not turn.task.done()),
+            'cancellations': self.cancellations,
+            'cancel_latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'cancel_latency_max': latencies[-1] if latencies else None,
+        }
@@ -0,0 +1,319 @@
+from typing import Iterator, List, Optional, Tuple, Union
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+import numpy as np
+import shutil
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_META_FILE = 'meta.json'
+_VECTORS_FILE = 'vectors.f32'
+_DELETED_FILE = 'deleted.u8'
+_ENTRIES_FILE = 'entries.jsonl'
+_OFFSETS_FILE = 'offsets.u64'
+_COMPACT_DIR = 'compact'
+_LOCK_FILE = 'lock'
+_FILES = (_VECTORS_FILE, _DELETED_FILE, _OFFSETS_FILE, _ENTRIES_FILE)
+
+@dataclass
+class SearchResult:
+    id: int
+    score: float
+    text: str
+    metadata: dict = field(default_factory=dict)
+
+class VectorIndex:
+    def __init__(self, path: Optional[str] = None, dim: Optional[int] = None, initial_capacity: int = 1024) -> None:
+        '''
+            Cosine similarity index over float32 vectors
+
+            Vectors are normalized when added, so a search is one matrix vector product over all rows followed by a partial sort.
+            With a path the vectors live in a memory mapped file that grows as rows are appended, and an existing index at
+            that path is opened without reading the vectors into memory. Texts and metadata are kept in an append only jsonl file
+            and only read for search hits, through a memory mapped table of line offsets.
+            Deleted rows are only flagged, compact() rewrites the index without them. A compaction that was interrupted is
+            finished or discarded when the index is opened again, the index is never left half rewritten.
+            Ids are row numbers and stay valid until compact() is called.
+            Opening and every change hold a lock file in the directory, so several processes can add to the same index,
+            each picks up what the others wrote before it changes anything.
+        '''
+        self.path: Optional[str] = path
+        self.dim: Optional[int] = dim
+        self.count: int = 0
+        self._capacity: int = 0
+        self._initial_capacity: int = max(1, initial_capacity)
+        self._vectors: Optional[np.ndarray] = None
+        self._deleted: Optional[np.ndarray] = None
+        self._offsets: Optional[np.ndarray] = None
+        self._texts: List[str] = []
+        self._metadata: List[dict] = []
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._meta_stamp: Optional[Tuple[int, int]] = None
+        if path:
+            os.makedirs(path, exist_ok=True)
+            with self._exclusive():
+                self._recover_compaction()
+                if os.path.exists(self._file(_META_FILE)):
+                    self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self._deleted is None:
+                return 0
+            return self.count - int(np.count_nonzero(self._deleted[:self.count]))
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        '''
+            Hold the index against other threads and, through the lock file, other processes
+        '''
+        with self._lock:
+            if not self.path or fcntl is None or self._lock_file is not None:
+                yield
+                return
+            with open(self._file(_LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._lock_file = lock_file
+                try:
+                    yield
+                finally:
+                    # closing the file releases the lock
+                    self._lock_file = None
+
+    def _stamp(self) -> Tuple[int, int]:
+        # the metadata is replaced on every change, so its inode and time tell if another process changed the index
+        stat = os.stat(self._file(_META_FILE))
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _refresh(self) -> None:
+        '''
+            Reopen the index if another process changed it, only while holding _exclusive()
+        '''
+        if self.path and os.path.exists(self._file(_META_FILE)) and self._stamp() != self._meta_stamp:
+            self._load()
+
+    def _recover_compaction(self) -> None:
+        '''
+            Finish the swap of a compacted index that was completely written, discard one that was not
+        '''
+        compacted = self._file(_COMPACT_DIR)
+        if not os.path.isdir(compacted):
+            return
+        if os.path.exists(os.path.join(compacted, _META_FILE)):
+            self._swap_in(compacted)
+        else:
+            shutil.rmtree(compacted)
+
+    def _swap_in(self, compacted: str) -> None:
+        # the compacted metadata goes last, until it is moved the swap can be finished from the compacted directory
+        for name in _FILES + (_META_FILE,):
+            source = os.path.join(compacted, name)
+            if os.path.exists(source):
+                os.replace(source, self._file(name))
+        shutil.rmtree(compacted)
+
+    def _load(self) -> None:
+        with open(self._file(_META_FILE)) as file:
+            meta = json.load(file)
+        self.dim = meta['dim']
+        self.count = meta['count']
+        self._capacity = meta['capacity']
+        self._vectors = np.memmap(self._file(_VECTORS_FILE), dtype=np.float32, mode='r+', shape=(self._capacity, self.dim))
+        self._deleted = np.memmap(self._file(_DELETED_FILE), dtype=np.uint8, mode='r+', shape=(self._capacity,))
+        self._offsets = np.memmap(self._file(_OFFSETS_FILE), dtype=np.uint64, mode='r+', shape=(self._capacity + 1,))
+        self._meta_stamp = self._stamp()
+        # entries after the indexed ones are from an add that was interrupted before its metadata update, the next add
+        # writes over them, only a torn last line is cut so the file stays valid jsonl
+        with open(self._file(_ENTRIES_FILE), 'rb+') as file:
+            end = int(self._offsets[self.count])
+            file.seek(end)
+            tail = file.read()
+            if tail and not tail.endswith(b'\n'):
+                file.truncate(end + tail.rfind(b'\n') + 1)
+
+    def _entry(self, index: int) -> tuple:
+        '''
+            Text and metadata of a row
+        '''
+        if not self.path:
+            return self._texts[index], self._metadata[index]
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        with open(self._file(_ENTRIES_FILE), 'rb') as file:
+            file.seek(start)
+            entry = json.loads(file.read(end - start))
+        return entry['text'], entry.get('metadata') or {}
+
+    def _save_meta(self) -> None:
+        meta_path = self._file(_META_FILE)
+        with open(f'{meta_path}.tmp', 'w') as file:
+            json.dump({'dim': self.dim, 'count': self.count, 'capacity': self._capacity}, file)
+        os.replace(f'{meta_path}.tmp', meta_path)
+        self._meta_stamp = self._stamp()
+
+    def _grow(self, needed: int) -> None:
+        '''
+            Make room for needed rows, capacity doubles so appends stay amortized O(1)
+        '''
+        if needed <= self._capacity:
+            return
+        capacity = max(self._initial_capacity, self._capacity)
+        while capacity < needed:
+            capacity *= 2
+        if not self.path:
+            vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+            deleted = np.zeros(capacity, dtype=np.uint8)
+            if self._vectors is not None:
+                vectors[:self.count] = self._vectors[:self.count]
+                deleted[:self.count] = self._deleted[:self.count]
+        else:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._deleted.flush()
+                self._offsets.flush()
+            self._vectors = self._deleted = self._offsets = None
+            for name, size in ((_VECTORS_FILE, capacity * self.dim * 4), (_DELETED_FILE, capacity), (_OFFSETS_FILE, (capacity + 1) * 8)):
+                with open(self._file(name), 'ab') as file:
+                    file.truncate(size)
+            vectors = np.memmap(self._file(_VECTORS_FILE), dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+            deleted = np.memmap(self._file(_DELETED_FILE), dtype=np.uint8, mode='r+', shape=(capacity,))
+            self._offsets = np.memmap(self._file(_OFFSETS_FILE), dtype=np.uint64, mode='r+', shape=(capacity + 1,))
+        self._vectors, self._deleted, self._capacity = vectors, deleted, capacity
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def add(self, vectors: np.ndarray, texts: List[str], metadata: Optional[List[dict]] = None) -> List[int]:
+        '''
+            Append vectors with their texts, returns the new ids
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[None, :]
+        if len(vectors) != len(texts) or (metadata is not None and len(metadata) != len(texts)):
+            raise ValueError('vectors, texts and metadata must have the same length')
+        if not len(texts):
+            return []
+        with self._exclusive():
+            self._refresh()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f'expected vectors of dimension {self.dim}, got {vectors.shape[1]}')
+            start = self.count
+            end = start + len(texts)
+            self._grow(end)
+            self._vectors[start:end] = self._normalize(vectors)
+            self._deleted[start:end] = 0
+            metadata = metadata or [{} for _ in texts]
+            if self.path:
+                lines = [(json.dumps({'text': text, 'metadata': meta}) + '\n').encode('utf-8') for text, meta in zip(texts, metadata)]
+                offset = int(self._offsets[start])
+                self._offsets[start + 1:end + 1] = offset + np.cumsum([len(line) for line in lines], dtype=np.uint64)
+                # written at the offset of the first new row, not appended, over anything an interrupted add left
+                with open(self._file(_ENTRIES_FILE), 'r+b' if os.path.exists(self._file(_ENTRIES_FILE)) else 'wb') as file:
+                    file.seek(offset)
+                    file.writelines(lines)
+                    file.truncate()
+                self._vectors.flush()
+                self._deleted.flush()
+                self._offsets.flush()
+            else:
+                self._texts.extend(texts)
+                self._metadata.extend(metadata)
+            self.count = end
+            if self.path:
+                self._save_meta()
+            return list(range(start, end))
+
+    def delete(self, ids: List[int]) -> int:
+        '''
+            Flag rows as deleted, returns the number of rows that were live
+        '''
+        with self._exclusive():
+            self._refresh()
+            ids = np.asarray([i for i in ids if 0 <= i < self.count], dtype=np.int64)
+            if not len(ids):
+                return 0
+            removed = int(np.count_nonzero(self._deleted[ids] == 0))
+            self._deleted[ids] = 1
+            if self.path:
+                self._deleted.flush()
+            return removed
+
+    def search(self, query: np.ndarray, k: int = 5, min_score: Optional[float] = None) -> Union[List[SearchResult], List[List[SearchResult]]]:
+        '''
+            Top k rows by cosine similarity, a 2d query returns one result list per row
+        '''
+        query = np.asarray(query, dtype=np.float32)
+        single = query.ndim == 1
+        queries = self._normalize(query[None, :] if single else query)
+        with self._lock:
+            if not self.count or k < 1:
+                return [] if single else [[] for _ in queries]
+            # (queries, rows) scores in one BLAS call, deleted rows can never win
+            scores = queries @ self._vectors[:self.count].T
+            scores[:, self._deleted[:self.count].astype(bool)] = -np.inf
+            k = min(k, self.count)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            results: List[List[SearchResult]] = []
+            for row, candidates in enumerate(top):
+                order = candidates[np.argsort(-scores[row, candidates])]
+                hits = []
+                for index in order:
+                    score = float(scores[row, index])
+                    if score == -np.inf or (min_score is not None and score < min_score):
+                        break
+                    text, metadata = self._entry(index)
+                    hits.append(SearchResult(int(index), score, text, metadata))
+                results.append(hits)
+        return results[0] if single else results
+
+    def compact(self) -> None:
+        '''
+            Rewrite the index without deleted rows, this renumbers ids
+
+            With a path the compacted index is written to a directory inside it and then moved over the old files, its
+            metadata last, so a crash leaves either the old or the compacted index.
+        '''
+        with self._exclusive():
+            self._refresh()
+            if self._deleted is None:
+                return
+            live = np.flatnonzero(self._deleted[:self.count] == 0)
+            vectors = np.array(self._vectors[live])
+            entries = [self._entry(i) for i in live]
+            texts = [text for text, _ in entries]
+            metadata = [meta for _, meta in entries]
+            if not self.path:
+                self._vectors = self._deleted = self._offsets = None
+                self.count = self._capacity = 0
+                self._texts, self._metadata = [], []
+                self.add(vectors, texts, metadata)
+                return
+            compacted_path = self._file(_COMPACT_DIR)
+            if os.path.isdir(compacted_path):
+                shutil.rmtree(compacted_path)
+            compacted = VectorIndex(compacted_path, dim=self.dim, initial_capacity=self._initial_capacity)
+            if len(live):
+                compacted.add(vectors, texts, metadata)
+            else:
+                compacted._grow(1)
+                open(compacted._file(_ENTRIES_FILE), 'ab').close()
+                compacted._save_meta()
+            del compacted
+            self._vectors = self._deleted = self._offsets = None
+            self._swap_in(compacted_path)
+            self._load()
@@ -0,0 +1,37 @@
+import asyncio
+import numpy as np
+from modules.audioframes import FramePool
+from modules.streambridge import iterate_in_thread
+
+def test_frame_is_reused_only_after_release():
+    pool = FramePool(frame_samples=16, max_frames=1)
+    first = pool.acquire(8)
+    view = first.reshape(1, -1)
+    second = pool.acquire(8)
+    assert not np.shares_memory(first, second)
+    assert pool.release(view)
+    assert not pool.release(second)
+    third = pool.acquire(16)
+    assert np.shares_memory(first, third)
+    assert pool.stats()['busy'] == 1
+    assert pool.allocations == 2
+
+def test_items_left_in_the_bridge_are_discarded():
+    pool = FramePool(frame_samples=4, max_frames=8)
+    produced = []
+
+    def frames():
+        for _ in range(8):
+            produced.append(pool.acquire(4))
+            yield produced[-1]
+
+    async def main():
+        async for frame in iterate_in_thread(frames, maxsize=4, discard=pool.release):
+            await asyncio.sleep(0.05)
+            pool.release(frame)
+            break
+        await asyncio.sleep(0.3)
+
+    asyncio.run(main())
+    assert produced
+    assert pool.stats()['busy'] == 0
@@ -0,0 +1,24 @@
+import asyncio
+from modules.conversation import ConversationEngine
+
+class FailingSummaries:
+    async def generate_chat(self, model_name, messages, cache=True):
+        return None
+
+    async def generate_chat_stream(self, model_name, messages, session_id=None, cache=True):
+        yield 'a reply'
+
+def test_failed_summary_keeps_the_previous_summary():
+    engine = ConversationEngine(FailingSummaries(), 'model', token_budget=64)
+    conversation = engine.conversation('session')
+    conversation.summary = 'the user is called Ada'
+
+    async def main():
+        for _ in range(4):
+            async for _ in engine.stream_reply('session', 'tell me something long ' * 8):
+                pass
+
+    asyncio.run(main())
+    assert engine.compactions > 0
+    assert conversation.summary == 'the user is called Ada'
+    assert len(conversation.turns) % 2 == 0
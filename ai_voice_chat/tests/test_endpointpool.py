@@ -0,0 +1,29 @@
+import httpx
+import pytest
+from modules.endpointpool import EndpointPool
+
+class FakeClient:
+    def __init__(self, host, timeout=None):
+        self.host = host
+
+def test_endpoint_recovers_after_successful_request():
+    pool = EndpointPool(['http://localhost:11434'], FakeClient)
+    endpoint = pool.endpoints[0]
+
+    def unreachable(endpoint):
+        raise httpx.ConnectError('connection refused')
+
+    with pytest.raises(httpx.ConnectError):
+        pool.call(unreachable)
+    assert not endpoint.healthy
+
+    assert pool.call(lambda endpoint: 'ok') == 'ok'
+    assert endpoint.healthy
+
+def test_stream_recovers_after_successful_request():
+    pool = EndpointPool(['http://localhost:11434'], FakeClient)
+    endpoint = pool.endpoints[0]
+    pool.mark_unhealthy(endpoint, httpx.ConnectError('connection refused'))
+
+    assert list(pool.stream(lambda endpoint: iter([1, 2]))) == [1, 2]
+    assert endpoint.healthy
@@ -0,0 +1,16 @@
+import logging
+import queue
+from modules.logger import _NonBlockingQueueHandler
+
+def test_queued_record_is_rendered_when_logged():
+    handler = _NonBlockingQueueHandler(queue.Queue())
+    value = {'a': 1}
+    try:
+        raise ValueError('boom')
+    except ValueError as e:
+        record = logging.LogRecord('test', logging.ERROR, __file__, 1, 'value %s', (value,), (type(e), e, e.__traceback__))
+    queued = handler.prepare(record)
+    value['a'] = 2
+    assert queued.getMessage() == "value {'a': 1}"
+    assert queued.args is None and queued.exc_info is None
+    assert 'ValueError: boom' in queued.traceback_text
@@ -0,0 +1,12 @@
+from modules.metrics import Metrics
+
+def test_counters_are_exported_as_counters():
+    metrics = Metrics()
+    trace = metrics.begin_turn('session')
+    metrics.increment('turns_cancelled_total')
+    metrics.end_turn(trace)
+    assert metrics.to_json()['counters']['turns_cancelled_total'] == 1
+    assert trace.counts == {'turns_cancelled_total': 1}
+    text = metrics.to_prometheus()
+    assert '# TYPE voice_chat_turns_cancelled_total counter' in text
+    assert 'voice_chat_turns_cancelled_total 1' in text
@@ -0,0 +1,40 @@
+import httpx
+from types import SimpleNamespace
+from modules.endpointpool import EndpointPool
+from modules.residency import ModelResidency
+
+class FakeClient:
+    reachable = True
+
+    def __init__(self, host, timeout=None):
+        self.host = host
+
+    def generate(self, model, keep_alive=None):
+        if not FakeClient.reachable:
+            raise httpx.ConnectError('connection refused')
+        return SimpleNamespace(load_duration=None)
+
+    def ps(self):
+        if not FakeClient.reachable:
+            raise httpx.ConnectError('connection refused')
+        return SimpleNamespace(models=[])
+
+def test_preload_fails_when_nothing_was_loaded():
+    FakeClient.reachable = False
+    pool = EndpointPool(['http://localhost:11434'], FakeClient)
+    residency = ModelResidency(pool)
+    assert not residency.preload('llama3')
+    assert not pool.endpoints[0].healthy
+    assert not residency.preload('llama3')
+
+    FakeClient.reachable = True
+    assert residency.preload('llama3')
+    assert pool.endpoints[0].healthy
+
+def test_check_restores_unhealthy_endpoint():
+    FakeClient.reachable = True
+    pool = EndpointPool(['http://localhost:11434'], FakeClient)
+    residency = ModelResidency(pool)
+    pool.mark_unhealthy(pool.endpoints[0], httpx.ConnectError('connection refused'))
+    residency.check()
+    assert pool.endpoints[0].healthy
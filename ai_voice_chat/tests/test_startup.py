@@ -0,0 +1,21 @@
+from modules.startup import StartupOrchestrator, FAILED
+
+def fail():
+    raise Exception('unable to load')
+
+def test_failed_optional_component_does_not_block_ready():
+    startup = StartupOrchestrator()
+    startup.add('tts', lambda: 'tts')
+    startup.add('audio_cache', fail, depends_on=['tts'], required=False)
+    startup.start()
+    assert startup.wait(timeout=5)
+    assert not startup.failed
+    assert startup.status()['components']['audio_cache']['state'] == FAILED
+
+def test_failed_required_component_is_reported():
+    startup = StartupOrchestrator()
+    startup.add('llm', fail)
+    startup.add('embeddings', lambda: 'embeddings', required=False)
+    startup.start()
+    assert not startup.wait(timeout=5)
+    assert startup.failed
@@ -0,0 +1,25 @@
+import asyncio
+from modules.metrics import Metrics
+from modules.turns import TurnManager
+
+def test_cancel_latency_reaches_metrics():
+    metrics = Metrics()
+    turns = TurnManager()
+    turns.add_cancel_listener(lambda turn, latency: metrics.observe('cancel_latency_seconds', latency))
+
+    async def respond():
+        turns.begin('session')
+        await asyncio.sleep(10)
+
+    async def main():
+        first = asyncio.create_task(respond())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(respond())
+        await asyncio.sleep(0)
+        await asyncio.gather(first, return_exceptions=True)
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+
+    asyncio.run(main())
+    assert turns.cancellations == 1
+    assert metrics.histograms['cancel_latency_seconds'].count == 1
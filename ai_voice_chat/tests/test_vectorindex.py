@@ -0,0 +1,66 @@
+import os
+import numpy as np
+from modules import vectorindex
+from modules.vectorindex import VectorIndex
+
+def test_compact_keeps_live_rows(tmp_path):
+    index = VectorIndex(str(tmp_path))
+    index.add(np.eye(3), ['a', 'b', 'c'])
+    index.delete([1])
+    index.compact()
+    reopened = VectorIndex(str(tmp_path))
+    assert len(reopened) == 2
+    assert [hit.text for hit in reopened.search(np.array([0, 0, 1.0]), k=1)] == ['c']
+
+def test_interrupted_compaction_keeps_an_index(tmp_path, monkeypatch):
+    index = VectorIndex(str(tmp_path))
+    index.add(np.eye(3), ['a', 'b', 'c'])
+    index.delete([0])
+    replace = os.replace
+    calls = []
+
+    def crash(source, target):
+        calls.append(target)
+        if len(calls) == 2:
+            raise OSError('crash')
+        replace(source, target)
+
+    monkeypatch.setattr(vectorindex.os, 'replace', crash)
+    try:
+        index.compact()
+    except OSError:
+        pass
+    monkeypatch.setattr(vectorindex.os, 'replace', replace)
+    reopened = VectorIndex(str(tmp_path))
+    assert len(reopened) == 2
+    assert [hit.text for hit in reopened.search(np.array([0, 1.0, 0]), k=1)] == ['b']
+
+def test_compact_everything_deleted(tmp_path):
+    index = VectorIndex(str(tmp_path))
+    index.add(np.eye(2), ['a', 'b'])
+    index.delete([0, 1])
+    index.compact()
+    assert len(VectorIndex(str(tmp_path))) == 0
+
+def test_opening_keeps_entries_of_another_writer(tmp_path):
+    writer = VectorIndex(str(tmp_path))
+    writer.add(np.eye(3)[:1], ['a'])
+    reader = VectorIndex(str(tmp_path))
+    writer.add(np.eye(3)[1:], ['b', 'c'])
+    VectorIndex(str(tmp_path))
+    reader.add(np.ones(3), ['d'])
+    reopened = VectorIndex(str(tmp_path))
+    assert len(reopened) == 4
+    assert [hit.text for hit in reopened.search(np.array([0, 0, 1.0]), k=1)] == ['c']
+
+def test_torn_entry_is_cut_and_written_over(tmp_path):
+    index = VectorIndex(str(tmp_path))
+    index.add(np.eye(2), ['a', 'b'])
+    entries = tmp_path / 'entries.jsonl'
+    with open(entries, 'ab') as file:
+        file.write(b'{"text": "orphan", "metadata": {}}\n{"text": "to')
+    reopened = VectorIndex(str(tmp_path))
+    assert entries.read_bytes().endswith(b'"orphan", "metadata": {}}\n')
+    reopened.add(np.array([1.0, 1.0]), ['c'])
+    assert [hit.text for hit in VectorIndex(str(tmp_path)).search(np.array([1.0, 1.0]), k=1)] == ['c']
+    assert b'orphan' not in entries.read_bytes()
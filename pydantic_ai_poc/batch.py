@@ -0,0 +1,332 @@
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from pydantic_ai.messages import RetryPromptPart
+from modules import Logger
+
+logger = Logger(name='batch').get_logger()
+
+def read_prompts(path, field):
+    '''
+        Stream (index, id, prompt) from a JSON lines or CSV file, a JSON line is an object with the prompt field or a plain string
+    '''
+    with open(path, newline='', encoding='utf-8') as file:
+        if os.path.splitext(path)[1].lower() == '.csv':
+            rows = csv.DictReader(file)
+        else:
+            rows = (json.loads(line) for line in file if line.strip())
+        for index, row in enumerate(rows):
+            if isinstance(row, str):
+                yield index, None, row
+            else:
+                yield index, row.get('id'), row[field]
+
+class Checkpoint:
+    def __init__(self, path, output_path):
+        '''
+            Which prompts already have a result in the output file, saved after every written result
+
+            done_below is the number of leading prompts that are done, done holds the ones after it (completion order
+            leaves gaps). output_bytes is the size of the output file at the time of the checkpoint, a resumed run cuts
+            the output back to it so results written after the last checkpoint are not duplicated.
+            Prompts whose result was an error are kept in failed and run again when resuming, their new result is
+            appended and takes the place of the error record once the batch finished (see compact_output).
+        '''
+        self.path = path
+        self.output_path = output_path
+        self.done_below = 0
+        self.done = set()
+        self.failed = set()
+        self.output_bytes = 0
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                state = json.load(file)
+            self.done_below = state['done_below']
+            self.done = set(state['done'])
+            self.failed = set(state.get('failed', []))
+            self.output_bytes = state['output_bytes']
+
+    @property
+    def resumed(self):
+        return self.done_below > 0 or bool(self.done)
+
+    def is_done(self, index):
+        return (index < self.done_below or index in self.done) and index not in self.failed
+
+    def mark(self, index, output_bytes, failed=False):
+        if index >= self.done_below:
+            self.done.add(index)
+        if failed:
+            self.failed.add(index)
+        else:
+            self.failed.discard(index)
+        while self.done_below in self.done:
+            self.done.remove(self.done_below)
+            self.done_below += 1
+        self.save(output_bytes)
+
+    def save(self, output_bytes):
+        self.output_bytes = output_bytes
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump({'output': self.output_path, 'done_below': self.done_below, 'done': sorted(self.done), 'failed': sorted(self.failed), 'output_bytes': output_bytes}, file)
+        os.replace(temporary, self.path)
+
+class Stats:
+    def __init__(self, window=1000):
+        '''
+            Batch counters, latency percentiles are over the last window results so memory stays flat
+        '''
+        self.start = time.perf_counter()
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.validation_retries = 0
+        self.output_tokens = 0
+        self.cached = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, record):
+        if record['error'] is None:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        self.validation_retries += record['retries'] or 0
+        self.output_tokens += record['output_tokens'] or 0
+        self.cached += record['cached']
+        self.latencies.append(record['seconds'])
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        completed = self.succeeded + self.failed
+        latencies = sorted(self.latencies)
+        return {
+            'completed': completed,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'validation_retries': self.validation_retries,
+            'cached': self.cached,
+            'seconds': elapsed,
+            'prompts_per_second': completed / elapsed if elapsed else 0.0,
+            'output_tokens_per_second': self.output_tokens / elapsed if elapsed else 0.0,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+            'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else None,
+        }
+
+def validation_retries(result):
+    '''
+        Number of times the model was asked to fix a response that failed validation
+    '''
+    return sum(
+        1 for message in result.all_messages() for part in getattr(message, 'parts', []) if isinstance(part, RetryPromptPart)
+    )
+
+async def run_prompt(agent, model, index, prompt_id, prompt, cache=None):
+    '''
+        Agent result for one prompt as an output record, cache is the frontend module when the response cache is used
+    '''
+    start = time.perf_counter()
+    try:
+        cached = await cache.cached_response(prompt, model) if cache else None
+        if cached is not None:
+            return {
+                'index': index,
+                'id': prompt_id,
+                'result': cached.model_dump(),
+                'error': None,
+                'retries': 0,
+                'output_tokens': 0,
+                'cached': True,
+                'seconds': time.perf_counter() - start,
+            }
+        result = await agent.run(prompt, model=model)
+        if cache:
+            await cache.cache_response(prompt, model, result.data)
+        return {
+            'index': index,
+            'id': prompt_id,
+            'result': result.data.model_dump(),
+            'error': None,
+            'retries': validation_retries(result),
+            'output_tokens': result.usage().response_tokens,
+            'cached': False,
+            'seconds': time.perf_counter() - start,
+        }
+    except Exception as e:
+        logger.error('prompt %s failed: \n %s', index, e)
+        return {
+            'index': index,
+            'id': prompt_id,
+            'result': None,
+            'error': str(e),
+            'retries': None,
+            'output_tokens': None,
+            'cached': False,
+            'seconds': time.perf_counter() - start,
+        }
+
+async def run_batch(agent, model_of, prompts, output, checkpoint, stats, concurrency, ordered, window, progress_interval, cache=None):
+    '''
+        Run prompts with at most concurrency agent runs at once, appending each result to output as a JSON line
+
+        In input order a result waits for the results of earlier prompts, at most window prompts are started ahead of
+        the oldest unwritten one. Prompts are read as they are scheduled, so memory does not grow with the input.
+    '''
+    running = asyncio.Semaphore(concurrency)
+    held = asyncio.Semaphore(window if ordered else concurrency)
+    order = deque()
+    finished = {}
+    last_progress = time.perf_counter()
+
+    def write(record):
+        nonlocal last_progress
+        output.write(json.dumps(record) + '\n')
+        output.flush()
+        checkpoint.mark(record['index'], output.tell(), failed=record['error'] is not None)
+        stats.record(record)
+        held.release()
+        if time.perf_counter() - last_progress >= progress_interval:
+            last_progress = time.perf_counter()
+            summary = stats.summary()
+            logger.info(
+                '%s done (%s failed), %.2f prompts/s, %s validation retries',
+                summary['completed'], summary['failed'], summary['prompts_per_second'], summary['validation_retries']
+            )
+
+    async def process(index, prompt_id, prompt):
+        async with running:
+            record = await run_prompt(agent, model_of(), index, prompt_id, prompt, cache)
+        if not ordered:
+            write(record)
+            return
+        finished[index] = record
+        while order and order[0] in finished:
+            write(finished.pop(order.popleft()))
+
+    tasks = set()
+    try:
+        for index, prompt_id, prompt in prompts:
+            if checkpoint.is_done(index):
+                stats.skipped += 1
+                continue
+            await held.acquire()
+            order.append(index)
+            task = asyncio.create_task(process(index, prompt_id, prompt))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        # an interrupted batch stops its runs before the output is closed
+        for task in tasks:
+            task.cancel()
+
+def open_output(path, checkpoint):
+    '''
+        Output file positioned for appending, cut back to the last checkpoint when resuming
+    '''
+    if not checkpoint.resumed:
+        return open(path, 'w', encoding='utf-8')
+    output = open(path, 'a', encoding='utf-8')
+    # a compacted output is shorter than the checkpoint if the run stopped before saving it
+    size = min(checkpoint.output_bytes, os.path.getsize(path))
+    output.truncate(size)
+    output.seek(size)
+    return output
+
+def compact_output(path):
+    '''
+        Rewrite the output with one record per prompt, the last record of an index takes the place of its first one,
+        so retried prompts keep their position. Returns the new size of the output
+    '''
+    last = {}
+    records = 0
+    with open(path, 'rb') as file:
+        offset = 0
+        for line in file:
+            last[json.loads(line)['index']] = offset
+            offset += len(line)
+            records += 1
+    if records == len(last):
+        return offset
+    temporary = f'{path}.tmp'
+    with open(path, 'rb') as source, open(path, 'rb') as latest, open(temporary, 'wb') as target:
+        written = set()
+        for line in source:
+            index = json.loads(line)['index']
+            if index in written:
+                continue
+            written.add(index)
+            latest.seek(last[index])
+            target.write(latest.readline())
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(temporary, path)
+    logger.info('replaced %s failed results with their retries', records - len(last))
+    return os.path.getsize(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a file of prompts through the agent and write the structured results')
+    parser.add_argument('input', help='.jsonl file of prompts (objects with the prompt field or strings) or .csv file with a prompt column')
+    parser.add_argument('--output', help='JSON lines results, defaults to <input>.results.jsonl')
+    parser.add_argument('--field', default='prompt', help='prompt field or column name')
+    parser.add_argument('--concurrency', type=int, default=4, help='agent runs at once')
+    parser.add_argument('--order', choices=['input', 'completion'], default='input', help='order of the written results')
+    parser.add_argument('--window', type=int, default=None, help='prompts started ahead of the oldest unwritten one in input order, defaults to 8 x concurrency')
+    parser.add_argument('--checkpoint', help='checkpoint file, defaults to <output>.checkpoint')
+    parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='seconds between progress logs')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the response cache (RESPONSE_CACHE=true)')
+    args = parser.parse_args()
+
+    output_path = args.output or f'{os.path.splitext(args.input)[0]}.results.jsonl'
+    checkpoint_path = args.checkpoint or f'{output_path}.checkpoint'
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    try:
+        import frontend
+        frontend.startup.start()
+        if not frontend.startup.wait():
+            raise Exception(f'startup failed: {frontend.startup.status()}')
+        checkpoint = Checkpoint(checkpoint_path, output_path)
+        if checkpoint.resumed:
+            logger.info(
+                'resuming %s, %s prompts done, retrying %s failed ones',
+                args.input, checkpoint.done_below + len(checkpoint.done) - len(checkpoint.failed), len(checkpoint.failed)
+            )
+        stats = Stats()
+        finished = False
+        with open_output(output_path, checkpoint) as output:
+            try:
+                asyncio.run(run_batch(
+                    frontend.agent,
+                    frontend.active_model,
+                    read_prompts(args.input, args.field),
+                    output,
+                    checkpoint,
+                    stats,
+                    concurrency=args.concurrency,
+                    ordered=args.order == 'input',
+                    window=args.window or args.concurrency * 8,
+                    progress_interval=args.progress_interval,
+                    cache=None if args.no_cache else frontend
+                ))
+                finished = True
+            except KeyboardInterrupt:
+                logger.info('interrupted, run again to resume from %s', checkpoint_path)
+        if finished and checkpoint.resumed:
+            checkpoint.save(compact_output(output_path))
+        summary = stats.summary()
+        print(json.dumps(summary, indent=2))
+        logger.info('wrote results to %s', output_path)
+        if summary['failed']:
+            sys.exit(1)
+    except Exception as e:
+        logger.error('batch failed: \n %s', e)
+        sys.exit(1)
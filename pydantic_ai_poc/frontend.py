@@ -1,18 +1,40 @@
 import os
-from modules import OllamaWrapper, Logger
+from modules import OllamaWrapper, Logger, VectorIndex, StartupOrchestrator, StructuredStreamer, ResponseCache, context_key
 from ollama import Client
 from pydantic_ai import Agent
 from pydantic_ai.models.openai import OpenAIModel
 from pydantic_ai.providers.openai import OpenAIProvider
 from pydantic import BaseModel
+import numpy as np
+import asyncio
 
 ollama_endpoint = str(os.getenv("OLLAMA_ENDPOINT"))
 model_name = str(os.getenv("MODEL_NAME")) # model selected must support tools
+fallback_model_name = os.getenv("FALLBACK_MODEL_NAME") # answers while model_name downloads, if already downloaded
+pull_timeout = float(os.getenv("MODEL_PULL_TIMEOUT", "600"))
 system_prompt = str(os.getenv("SYSTEM_PROMPT"))
+embedding_model = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+index_path = os.getenv("INDEX_PATH") # retrieval is disabled when unset
+stream_responses = os.getenv("STREAM_RESPONSES", "false").lower() == "true" # print fields as they are generated
+response_cache_enabled = os.getenv("RESPONSE_CACHE", "false").lower() == "true" # answer near duplicate prompts from a cache
+response_cache_threshold = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.9")) # cosine similarity of the prompts
+response_cache_ttl = float(os.getenv("RESPONSE_CACHE_TTL", "3600")) # never expire when 0
+response_cache_entries = int(os.getenv("RESPONSE_CACHE_ENTRIES", "1000"))
 
 logger = Logger(name='frontend').get_logger()
-ollama_wrapper = OllamaWrapper(ollama_endpoint=ollama_endpoint, client=Client, logger=Logger)
+ollama_wrapper = OllamaWrapper(ollama_endpoint=ollama_endpoint, client=Client, logger=Logger, pull_timeout=pull_timeout)
+vector_index = VectorIndex(path=index_path) if index_path else None
 ollama_model = OpenAIModel(model_name=model_name, provider=OpenAIProvider(base_url=f'{ollama_endpoint}/v1', api_key='fake-api-key')) # api_key is needed even when running locally
+fallback_model = OpenAIModel(model_name=fallback_model_name, provider=OpenAIProvider(base_url=f'{ollama_endpoint}/v1', api_key='fake-api-key')) if fallback_model_name else None
+model_pull = None # pull of model_name while the fallback model answers
+response_cache = ResponseCache(
+    # embedded on a thread so batch runs keep going meanwhile
+    embed=lambda text: asyncio.to_thread(lambda: next(iter(ollama_wrapper.generate_embedding(embedding_model, [text])), None)),
+    threshold=response_cache_threshold,
+    ttl=response_cache_ttl or None,
+    max_entries=response_cache_entries,
+    logger=Logger
+) if response_cache_enabled else None
 
 class GenericResponse(BaseModel):
     message: str
@@ -21,32 +43,109 @@ def configure_services():
     '''
         configure services
     '''
+    global model_pull
     logger.info('configuring services')
     try:
         if not model_name:
             raise Exception('no model name was found')
 
-        if not ollama_wrapper.pull_model(model_name):
+        pull = ollama_wrapper.start_pull(model_name)
+
+        if pull and fallback_model and ollama_wrapper.has_model(fallback_model_name):
+            logger.info('answering with model %s while %s downloads', fallback_model_name, model_name)
+            model_pull = pull
+        elif pull and not pull.result():
             raise Exception(f'unable to pull model: {model_name}')
 
         logger.info('services are properly configured')
 
     except Exception as e:  
         logger.error('unable to configure services: \n %s', e)
+        raise
+
+def configure_embeddings():
+    '''
+        pull the embedding model, without it document search and the response cache find nothing
+    '''
+    pull = ollama_wrapper.start_pull(embedding_model)
+    if pull and not pull.result():
+        raise Exception(f'unable to pull model: {embedding_model}')
 
-configure_services()
+# model pulls run in the background so the prompt is available right away
+startup = StartupOrchestrator(logger=Logger)
+startup.add('llm', configure_services)
+if vector_index or response_cache:
+    startup.add('embeddings', configure_embeddings, required=False)
+
+def active_model():
+    '''
+        Model that answers prompts, the fallback model until model_name is downloaded
+    '''
+    if model_pull is not None and not (model_pull.done() and model_pull.result()):
+        return fallback_model
+    return ollama_model
+
+async def cached_response(prompt, model, cache=True):
+    '''
+        Response cached for a prompt similar to prompt by the same model, or None
+    '''
+    if response_cache is None or not cache:
+        return None
+    entry = await response_cache.lookup(prompt, context_key(model.model_name, system_prompt))
+    return GenericResponse.model_validate(entry.value) if entry is not None else None
+
+async def cache_response(prompt, model, response, cache=True):
+    if response_cache is not None and cache:
+        await response_cache.store(prompt, response.model_dump(), context_key(model.model_name, system_prompt))
 
 agent = Agent(ollama_model, result_type=GenericResponse, system_prompt=system_prompt)
+streamer = StructuredStreamer(agent, logger=Logger)
+
+if vector_index:
+    @agent.tool_plain
+    def search_documents(query: str) -> list[str]:
+        '''
+            Search the document index for passages relevant to the query
+        '''
+        embeddings = ollama_wrapper.generate_embedding(embedding_model, [query])
+        if not embeddings or not len(vector_index):
+            return []
+        results = vector_index.search(np.asarray(embeddings[0], dtype=np.float32), k=4, min_score=0.3)
+        logger.info('retrieved %s document chunks', len(results))
+        return [result.text for result in results]
 
 def main():
     try:
+        startup.start()
         while True:
             user_input = input("Enter something (type 'exit' to quit): ")
             if user_input.lower() == 'exit':
                 logger.info("Exiting the program.")
                 break
-            result = agent.run_sync(user_input)
-            logger.info(result.data)
+            if startup.failed:
+                logger.error('unable to start, exiting: %s', startup.status())
+                break
+            if not startup.ready:
+                logger.info('still warming up, please try again in a moment: %s', startup.status())
+                continue
+            # a leading ! skips the response cache
+            cache = not user_input.startswith('!')
+            user_input = user_input.lstrip('!')
+            model = active_model()
+            cached = asyncio.run(cached_response(user_input, model, cache))
+            if cached is not None:
+                logger.info(cached)
+                continue
+            if stream_responses:
+                result = asyncio.run(streamer.run(user_input, model=model, on_field=lambda name, value: logger.info('%s: %s', name, value)))
+                logger.info(
+                    'first field after %.2fs, answered in %.2fs, %s attempts abandoned early',
+                    result.first_field_seconds or result.seconds, result.seconds, result.aborted
+                )
+            else:
+                result = agent.run_sync(user_input, model=model)
+                logger.info(result.data)
+            asyncio.run(cache_response(user_input, model, result.data, cache))
 
     except Exception as e:
         logger.error('error generating response: %s', e)
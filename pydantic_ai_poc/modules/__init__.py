@@ -1,4 +1,9 @@
-__all__ = ["OllamaWrapper", "Logger"]
+__all__ = ["OllamaWrapper", "PullManager", "PullTask", "Logger", "VectorIndex", "SearchResult", "StartupOrchestrator", "StructuredStreamer", "StreamedResult", "SchemaViolation", "ResponseCache", "CachedResponse", "context_key"]
 
 from .ollamawrapper import OllamaWrapper
-from .logger import Logger
\ No newline at end of file
+from .pullmanager import PullManager, PullTask
+from .logger import Logger
+from .vectorindex import VectorIndex, SearchResult
+from .startup import StartupOrchestrator
+from .structuredstream import StructuredStreamer, StreamedResult, SchemaViolation
+from .responsecache import ResponseCache, CachedResponse, context_key
\ No newline at end of file
@@ -1,70 +1,151 @@
-from typing import Type
-from ollama import Client
+from typing import Type, Callable, TypeVar, Optional
+from ollama import Client, ResponseError
 from .logger import Logger
+from .pullmanager import PullManager, PullTask
 import time
+import threading
 import concurrent.futures
 
+T = TypeVar('T')
+
+def _is_model_not_found(error: Exception) -> bool:
+    '''
+        Check if an ollama error means the requested model is not on the server
+    '''
+    if not isinstance(error, ResponseError):
+        return False
+    return error.status_code == 404 or 'not found' in str(error.error).lower()
+
 class OllamaWrapper:
-    def __init__(self, ollama_endpoint: str, client: Type[Client], logger: Type[Logger]) -> None:
+    def __init__(self, ollama_endpoint: str, client: Type[Client], logger: Type[Logger], model_cache_ttl: float = 30.0, pull_timeout: float = 600.0) -> None:
         '''
             This class assumes a running ollama server that follows the standard ollama api documentation: https://github.com/ollama/ollama/blob/main/docs/api.md
+
+            model_cache_ttl is the number of seconds the downloaded model list is trusted before /api/tags is queried again
+            pull_timeout is the number of seconds a model pull may take, see PullManager
         '''
         self.ollama_endpoint: str = ollama_endpoint
         self.client: Client = client(host=ollama_endpoint)
         self.logger = logger(name='ollama_wrapper').get_logger()
         self.logger.info('initializing ollama client')
 
-    def list_models(self) -> list[str]:
+        self.model_cache_ttl: float = model_cache_ttl
+        self._model_cache: list[str] = []
+        self._model_cache_time: Optional[float] = None
+        self._model_cache_lock = threading.Lock()
+        self.model_cache_hits: int = 0
+        self.model_cache_misses: int = 0
+        self.pulls: PullManager = PullManager(logger=logger, timeout=pull_timeout)
+
+    def list_models(self, refresh: bool = False) -> list[str]:
         '''
-            Lists all downloaded models
+            Lists all downloaded models, served from the model cache while it is fresh
         '''
+        with self._model_cache_lock:
+            if not refresh and self._model_cache_fresh():
+                self.model_cache_hits += 1
+                return list(self._model_cache)
+            self.model_cache_misses += 1
+
         try:
             output: list[str] = []
             data = self.client.list()
             for model in data.models:
                 output.append(model['model'])
+            with self._model_cache_lock:
+                self._model_cache = output
+                self._model_cache_time = time.monotonic()
             self.logger.info('listed running models')
-            return output
+            return list(output)
         
         except Exception as e:
             self.logger.error('error listing running models \n %s ', e)
             return []
 
+    def _model_cache_fresh(self) -> bool:
+        '''
+            Checks if the cached model list is still within its ttl
+        '''
+        if self._model_cache_time is None:
+            return False
+        return time.monotonic() - self._model_cache_time < self.model_cache_ttl
+
+    def invalidate_model_cache(self) -> None:
+        '''
+            Drops the cached model list so the next lookup queries the server
+        '''
+        with self._model_cache_lock:
+            self._model_cache_time = None
+        self.logger.info('invalidated model cache')
+
+    def model_cache_stats(self) -> dict:
+        '''
+            Model cache hit and miss counters
+        '''
+        with self._model_cache_lock:
+            return {
+                'hits': self.model_cache_hits,
+                'misses': self.model_cache_misses,
+                'cached_models': len(self._model_cache),
+                'fresh': self._model_cache_fresh(),
+            }
+
+    def has_model(self, model_name: str) -> bool:
+        '''
+            Checks if model is downloaded, refreshing a stale negative answer once
+        '''
+        with self._model_cache_lock:
+            from_cache = self._model_cache_fresh()
+        if model_name in self.list_models():
+            return True
+        if not from_cache:
+            # the list was just fetched from the server
+            return False
+        return model_name in self.list_models(refresh=True)
+
+    def _with_model_retry(self, model_name: str, call: Callable[[], T]) -> T:
+        '''
+            Runs an ollama call, refreshing the model cache and retrying once if the server reports the model missing
+        '''
+        try:
+            return call()
+        except Exception as e:
+            if not _is_model_not_found(e):
+                raise
+            self.logger.info('model %s not found on server, refreshing model cache', model_name)
+            if model_name not in self.list_models(refresh=True):
+                raise
+            return call()
+
     def is_active_model(self, model_name: str) -> bool:
         '''
             Check if model is active
         '''
         self.logger.info('checking active model')
-        return model_name in self.list_models()
+        return self.has_model(model_name)
         
+    def start_pull(self, model_name: str) -> Optional[PullTask]:
+        '''
+            Starts pulling model in the background, None if it is already downloaded
+        '''
+        if self.has_model(model_name):
+            self.logger.info('model %s already downloaded', model_name)
+            return None
+        task = self.pulls.pull(self.ollama_endpoint, model_name)
+        task.add_done_callback(lambda _: self.invalidate_model_cache())
+        return task
+
     def pull_model(self, model_name: str) -> bool:
         '''
-            Pulls model from ollama
+            Pulls model from ollama, blocking until it is downloaded
         '''
         try:
-            if model_name in self.list_models():
-                self.logger.info('model %s already downloaded', model_name)
-                return True
-            
-            pulling_model = self.client.pull(model_name, stream=True)
-            self.logger.info('pulling model... \n %s', model_name)
-            start_time = time.time()
-            self.logger.info(next(pulling_model))
-            while True:
-                current_time = time.time()
-                next_digest = next(pulling_model)
-                if  next_digest['status'] == 'success':
-                    self.logger.info('pulled model %s', model_name)
-                    break  
-                elif next_digest['status'] == 'error':
-                    raise Exception('errored out while pulling model')
-                elif current_time - start_time >= 600:
-                    raise Exception('timeout of 10 minutes reached while pulling model')
-            
-            return True
+            task = self.start_pull(model_name)
+            return task is None or task.result()
 
         except Exception as e:
             self.logger.error('error pulling model %s \n %s', model_name, e)
+            self.invalidate_model_cache()
             return False
         
     def delete_model(self, model_name: str) -> bool:
@@ -72,18 +153,18 @@ class OllamaWrapper:
             Deletes a downloaded model
         '''
         try:
-            if model_name not in self.list_models():
+            if not self.has_model(model_name):
                 self.logger.info('model %s not downloaded', model_name)
                 return False
             
-            delete_model_status  = self.client.delete(model_name)
-            
-            while delete_model_status.status != None and delete_model_status.status != 'completed':
-                self.logger.info('deleting model: %s', model_name)
+            delete_model_status = self.client.delete(model_name)
+            self.invalidate_model_cache()
+            self.logger.info('deleted model %s: %s', model_name, delete_model_status.status)
             return True
 
         except Exception as e:
             self.logger.error('error deleting model %s \n %s', model_name, e)
+            self.invalidate_model_cache()
             return False
         
     def generate_embedding(self, model_name: str, input_list: list[str]) -> list[float]:
@@ -91,12 +172,12 @@ class OllamaWrapper:
             Generates an embedding with a downloaded model
         '''
         try:
-            if model_name not in self.list_models():
+            if not self.has_model(model_name):
                 self.logger.info('model %s not downloaded', model_name)
                 return []
             
             with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                embeddings_future = executor.submit(self.client.embed, model_name, input_list)
+                embeddings_future = executor.submit(self._with_model_retry, model_name, lambda: self.client.embed(model_name, input_list))
                 embeddings = embeddings_future.result()
                 self.logger.info('generated embedding with model %s', model_name)
                 return embeddings['embeddings']
@@ -110,12 +191,12 @@ class OllamaWrapper:
             Generates completion with downloaded model
         '''
         try:
-            if model_name not in self.list_models():
+            if not self.has_model(model_name):
                 self.logger.info('model %s not downloaded', model_name)
                 return ''
 
             with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                response_future = executor.submit(self.client.generate, model_name, prompt)
+                response_future = executor.submit(self._with_model_retry, model_name, lambda: self.client.generate(model_name, prompt))
                 response = response_future.result()
                 self.logger.info('generated completion with model %s \n %s', model_name, response)
                 return response.response
@@ -129,11 +210,11 @@ class OllamaWrapper:
             Set system prompt for downloaded model
         '''
         try:
-            if model_name not in self.list_models():
+            if not self.has_model(model_name):
                 self.logger.info('model %s not downloaded', model_name)
                 return ''
 
-            response = self.client.generate(model=model_name, system=system_prompt)
+            response = self._with_model_retry(model_name, lambda: self.client.generate(model=model_name, system=system_prompt))
 
             self.logger.info('configured system prompt for model %s', model_name)
             return response.response
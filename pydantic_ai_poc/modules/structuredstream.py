@@ -0,0 +1,129 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+from dataclasses import dataclass
+from pydantic import ValidationError
+from pydantic_ai import Agent
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, RetryPromptPart, ToolCallPart
+from pydantic_core import from_json
+from .logger import Logger
+import time
+
+@dataclass
+class StreamedResult:
+    '''
+        Outcome of a streamed run, durations are in seconds
+
+        first_field_seconds is when the first complete field was surfaced, aborted counts the attempts stopped early
+        because they already failed the schema and aborted_seconds is the decode time they used.
+    '''
+    data: Any
+    attempts: int
+    aborted: int
+    seconds: float
+    first_field_seconds: Optional[float] = None
+    aborted_seconds: float = 0.0
+
+class SchemaViolation(Exception):
+    def __init__(self, call: ToolCallPart, arguments: Dict[str, Any], errors: List[dict]) -> None:
+        super().__init__(f'response does not match the schema: {errors}')
+        self.call: ToolCallPart = call
+        self.arguments: Dict[str, Any] = arguments
+        self.errors: List[dict] = errors
+
+def _result_call(message: ModelResponse) -> Optional[ToolCallPart]:
+    # a streamed result starts with the call of the result tool
+    calls = [part for part in message.parts if isinstance(part, ToolCallPart)]
+    return calls[-1] if calls else None
+
+def _partial_arguments(call: ToolCallPart, final: bool) -> Tuple[Dict[str, Any], Optional[str]]:
+    '''
+        Arguments received so far and the key that may still be incomplete, None once the call is complete
+    '''
+    if isinstance(call.args, dict):
+        return call.args, None
+    try:
+        arguments = from_json(call.args or '{}', allow_partial=not final and 'trailing-strings')
+    except ValueError:
+        return {}, None
+    if not isinstance(arguments, dict):
+        return {}, None
+    return arguments, None if final or not arguments else list(arguments)[-1]
+
+class StructuredStreamer:
+    def __init__(
+        self,
+        agent: Agent,
+        retries: int = 1,
+        debounce: Optional[float] = None,
+        logger: Type[Logger] = Logger
+    ) -> None:
+        '''
+            Streams structured responses of agent, validating the partial JSON as it arrives
+
+            Fields are passed to on_field as soon as the model has moved past them. A response that already breaks the
+            schema (a wrong type, an unknown field, invalid JSON) is abandoned right away and the model is asked to fix
+            it, like the agent does with complete responses, up to retries times. Errors of the field that is still
+            arriving and of fields that have not arrived yet wait for the end of the response.
+            debounce groups tokens for that many seconds before validating, None validates on every token.
+        '''
+        self.agent: Agent = agent
+        self.retries: int = retries
+        self.debounce: Optional[float] = debounce
+        self.logger = logger(name='structured_stream').get_logger()
+
+    async def run(
+        self,
+        prompt: str,
+        model: Any = None,
+        on_field: Optional[Callable[[str, Any], None]] = None
+    ) -> StreamedResult:
+        '''
+            Run prompt, raises the last SchemaViolation when no attempt produced a valid response
+        '''
+        start = time.perf_counter()
+        first_field = None
+        aborted, aborted_seconds = 0, 0.0
+        history: Optional[List[ModelMessage]] = None
+        for attempt in range(1, self.retries + 2):
+            attempt_start = time.perf_counter()
+            surfaced = set()
+            try:
+                async with self.agent.run_stream(None if history else prompt, message_history=history, model=model) as result:
+                    messages = result.all_messages()
+                    async for message, final in result.stream_structured(debounce_by=self.debounce):
+                        call = _result_call(message)
+                        if call is None:
+                            continue
+                        arguments, arriving = _partial_arguments(call, final)
+                        try:
+                            data = await result.validate_structured_result(message, allow_partial=not final)
+                        except ValidationError as e:
+                            errors = [
+                                error for error in e.errors(include_url=False)
+                                if final or not (error['type'] == 'missing' or (error['loc'] and error['loc'][0] == arriving))
+                            ]
+                            if errors:
+                                raise SchemaViolation(call, arguments, errors)
+                            data = None
+                        for name, value in arguments.items():
+                            if name == arriving or name in surfaced:
+                                continue
+                            surfaced.add(name)
+                            if first_field is None:
+                                first_field = time.perf_counter() - start
+                            if on_field is not None:
+                                on_field(name, value)
+                        if final:
+                            return StreamedResult(data, attempt, aborted, time.perf_counter() - start, first_field, aborted_seconds)
+            except SchemaViolation as e:
+                aborted += 1
+                aborted_seconds += time.perf_counter() - attempt_start
+                if attempt > self.retries:
+                    raise
+                self.logger.warning('attempt %s does not match the schema, retrying \n %s', attempt, e.errors)
+                # the partial call is sent back as valid JSON, servers reject malformed tool arguments
+                call = ToolCallPart(e.call.tool_name, e.arguments, tool_call_id=e.call.tool_call_id)
+                history = messages + [
+                    ModelResponse(parts=[call]),
+                    ModelRequest(parts=[RetryPromptPart(content=e.errors, tool_name=call.tool_name, tool_call_id=call.tool_call_id)])
+                ]
+        raise Exception('streamed run ended without a result')